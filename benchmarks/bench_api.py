@@ -0,0 +1,51 @@
+"""Latency of the v3.1 API through webtest, including historical data queries
+of synthetic recorded_values tables. Table sizes are set with --rows."""
+import datetime
+
+import pytest
+
+from conftest import last_collected_at, peak_memory
+
+
+def record_memory(benchmark, request):
+    benchmark.extra_info["peak_memory"] = peak_memory(request)
+
+
+@pytest.mark.benchmark(group="api")
+def bench_sensor_values(benchmark, api_server):
+    client = api_server("sqlite://")
+
+    def request():
+        return client.get("/sensors/")
+
+    response = benchmark(request)
+    assert len(response.json["sensors"]) == 7
+    record_memory(benchmark, request)
+
+
+@pytest.mark.benchmark(group="historical")
+@pytest.mark.parametrize("hours", [1, 24])
+def bench_historical(benchmark, api_server, synthetic_database, rows, hours):
+    """The most recent values, so the whole table must be indexed to be fast"""
+    client = api_server(synthetic_database)
+    end = last_collected_at(rows)
+    start = end - datetime.timedelta(hours=hours)
+
+    def request():
+        return client.get(f"/historical/{start.isoformat()}/{end.isoformat()}")
+
+    response = benchmark(request)
+    assert response.json["sensors"]
+    record_memory(benchmark, request)
+
+
+@pytest.mark.benchmark(group="historical")
+def bench_latest(benchmark, api_server, synthetic_database, rows):
+    client = api_server(synthetic_database)
+
+    def request():
+        return client.get("/latest")
+
+    response = benchmark(request)
+    assert len(response.json["sensors"]) == min(rows, 7)
+    record_memory(benchmark, request)
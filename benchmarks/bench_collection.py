@@ -0,0 +1,37 @@
+"""The cost of finding the installed sensors and reading each one, with the
+hardware faked so only the Python overhead is measured."""
+import pytest
+
+from apd.sensors import cli, sensors
+
+
+SENSORS = [
+    sensors.PythonVersion,
+    sensors.IPAddresses,
+    sensors.CPULoad,
+    sensors.RAMAvailable,
+    sensors.ACStatus,
+    sensors.Temperature,
+    sensors.RelativeHumidity,
+]
+
+
+@pytest.mark.benchmark(group="get_sensors")
+def bench_get_sensors(benchmark):
+    found = benchmark(cli.get_sensors)
+    assert found
+
+
+@pytest.mark.benchmark(group="value")
+@pytest.mark.parametrize("sensor_class", SENSORS, ids=lambda cls: cls.name)
+def bench_value(benchmark, fake_hardware, sensor_class):
+    sensor = sensor_class()
+    benchmark(sensor.value)
+
+
+@pytest.mark.benchmark(group="format")
+@pytest.mark.parametrize("sensor_class", SENSORS, ids=lambda cls: cls.name)
+def bench_format(benchmark, fake_hardware, sensor_class):
+    sensor = sensor_class()
+    value = sensor.value()
+    benchmark(sensor.format, value)
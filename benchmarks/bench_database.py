@@ -0,0 +1,48 @@
+"""Throughput of storing values, as sensors --save and the ingest API do."""
+import pytest
+
+from apd.sensors import database, sensors
+
+from conftest import synthetic_rows
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = database.create_engine(f"sqlite:///{tmp_path / 'sensor_data.sqlite'}")
+    database.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.benchmark(group="store")
+def bench_store_sensor_data(benchmark, engine, fake_hardware):
+    from sqlalchemy.orm import sessionmaker
+
+    sensor = sensors.RAMAvailable()
+    value = sensor.value()
+    session = sessionmaker(engine)()
+
+    def store():
+        # As sensors --save does, a transaction for each value
+        database.store_sensor_data(sensor, value, session)
+        session.commit()
+
+    benchmark(store)
+    session.close()
+    # There are no stats with --benchmark-disable
+    if benchmark.stats:
+        benchmark.extra_info["rows_per_second"] = 1 / benchmark.stats.stats.mean
+
+
+@pytest.mark.benchmark(group="store")
+def bench_store_readings(benchmark, engine):
+    batch = list(synthetic_rows(1000))
+
+    def store():
+        with engine.begin() as connection:
+            database.store_readings(connection, batch)
+
+    benchmark(store)
+    if benchmark.stats:
+        rows_per_second = len(batch) / benchmark.stats.stats.mean
+        benchmark.extra_info["rows_per_second"] = rows_per_second
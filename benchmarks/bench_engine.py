@@ -0,0 +1,104 @@
+"""Compare SQLAlchemy's default SQLite engine with database.create_engine()
+under a concurrent workload.
+
+One thread stores readings, as sensors --save does, while other threads make
+historical range queries, as the API server does:
+
+    python benchmarks/bench_engine.py --readers 4 --duration 5
+"""
+import datetime
+import tempfile
+import threading
+import time
+import typing as t
+
+import click
+import sqlalchemy
+
+from apd.sensors.database import create_engine, metadata, sensor_values
+
+
+def run(engine: t.Any, readers: int, duration: float) -> t.Dict[str, int]:
+    metadata.create_all(engine)
+    start = datetime.datetime(2020, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(
+            sensor_values.insert(),
+            [
+                {
+                    "sensor_name": "CPULoad",
+                    "collected_at": start + datetime.timedelta(minutes=i),
+                    "data": 0.5,
+                }
+                for i in range(10000)
+            ],
+        )
+    counts = {"writes": 0, "reads": 0, "errors": 0}
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def count(name: str) -> None:
+        with lock:
+            counts[name] += 1
+
+    def write() -> None:
+        while time.monotonic() < stop:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        sensor_values.insert().values(
+                            sensor_name="CPULoad",
+                            collected_at=datetime.datetime.now(),
+                            data=0.5,
+                        )
+                    )
+            except sqlalchemy.exc.OperationalError:
+                count("errors")
+            else:
+                count("writes")
+
+    def read() -> None:
+        query = sensor_values.select().where(
+            sensor_values.c.collected_at.between(
+                start, start + datetime.timedelta(days=1)
+            )
+        )
+        while time.monotonic() < stop:
+            try:
+                with engine.connect() as connection:
+                    connection.execute(query).fetchall()
+            except sqlalchemy.exc.OperationalError:
+                count("errors")
+            else:
+                count("reads")
+
+    threads = [threading.Thread(target=write)]
+    threads += [threading.Thread(target=read) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return counts
+
+
+@click.command()
+@click.option("--readers", type=int, default=4, show_default=True)
+@click.option("--duration", type=float, default=5.0, show_default=True)
+def main(readers: int, duration: float) -> None:
+    for name, factory in (
+        ("default", sqlalchemy.create_engine),
+        ("tuned", create_engine),
+    ):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = factory(f"sqlite:///{directory}/sensor_data.sqlite")
+            counts = run(engine, readers, duration)
+        click.echo(
+            f"{name:<8} {counts['writes'] / duration:10,.0f} writes/s "
+            f"{counts['reads'] / duration:10,.0f} reads/s "
+            f"{counts['errors']:6} errors"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Compare the SQL and time series storage backends.
+
+Stores the same readings in an SQLite database and a time series store, then
+times range queries of different sizes against each:
+
+    python benchmarks/bench_storage.py --readings 1000000
+"""
+import datetime
+import tempfile
+import time
+import typing as t
+
+import click
+from sqlalchemy import create_engine
+
+from apd.sensors.database import metadata, sensor_values, store_readings
+from apd.sensors.timeseries import TimeSeriesStore
+
+
+SENSORS = ("CPULoad", "RelativeHumidity", "RAMAvailable")
+START = datetime.datetime(2020, 1, 1)
+
+
+def timed(function: t.Callable[[], t.Any]) -> t.Tuple[float, t.Any]:
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+
+def readings(count: int) -> t.List[t.Tuple[str, datetime.datetime, float]]:
+    # One reading of each sensor a minute
+    return [
+        (
+            SENSORS[i % len(SENSORS)],
+            START + datetime.timedelta(minutes=i // len(SENSORS)),
+            (i % 1000) / 1000,
+        )
+        for i in range(count)
+    ]
+
+
+def report(name: str, elapsed: float, rows: int) -> None:
+    rate = rows / elapsed if elapsed else 0.0
+    click.echo(f"{name:<40} {elapsed * 1000:10.1f}ms {rate:14,.0f} rows/s")
+
+
+@click.command()
+@click.option("--readings", "count", type=int, default=300000, show_default=True)
+@click.option("--repeat", type=int, default=5, show_default=True)
+def main(count: int, repeat: int) -> None:
+    data = readings(count)
+    end = data[-1][1]
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{directory}/sensor_data.sqlite")
+        metadata.create_all(engine)
+        store = TimeSeriesStore(f"{directory}/timeseries")
+
+        def write_sql() -> None:
+            rows = [
+                {"sensor_name": name, "collected_at": collected_at, "data": value}
+                for name, collected_at, value in data
+            ]
+            with engine.begin() as connection:
+                store_readings(connection, rows)
+
+        def write_timeseries() -> None:
+            for sensor_name in SENSORS:
+                store.append_many(
+                    sensor_name,
+                    [(at, value) for name, at, value in data if name == sensor_name],
+                )
+
+        report("write: sql", timed(write_sql)[0], count)
+        report("write: timeseries", timed(write_timeseries)[0], count)
+
+        for fraction in (0.001, 0.01, 0.1, 1.0):
+            start = end - (end - START) * fraction
+
+            def read_sql() -> int:
+                query = sensor_values.select().where(
+                    sensor_values.c.collected_at.between(start, end)
+                )
+                with engine.connect() as connection:
+                    return len(
+                        [
+                            (row.sensor_name, row.collected_at, row.data)
+                            for row in connection.execute(query)
+                        ]
+                    )
+
+            def read_timeseries() -> int:
+                return len(list(store.values(start, end, SENSORS)))
+
+            for name, function in (("sql", read_sql), ("timeseries", read_timeseries)):
+                best, rows = min(timed(function) for _ in range(repeat))
+                report(f"read {fraction:.1%} of range: {name}", best, rows)
+
+        store.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
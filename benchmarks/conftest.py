@@ -0,0 +1,188 @@
+import datetime
+import pathlib
+import socket
+import tracemalloc
+import typing as t
+import uuid
+from unittest import mock
+
+import pytest
+
+from apd.sensors import sensors
+
+
+# Values of each built-in sensor, in the form they are stored in
+JSON_VALUES: t.Dict[str, t.Any] = {
+    "PythonVersion": [3, 8, 2, "final", 0],
+    "IPAddresses": [["AF_INET", "192.168.1.10"], ["AF_INET6", "fe80::1"]],
+    "CPULoad": 0.25,
+    "RAMAvailable": 2 * 1024 ** 3,
+    "ACStatus": True,
+    "Temperature": {"magnitude": 21.5, "unit": "degC"},
+    "RelativeHumidity": 48.0,
+}
+START = datetime.datetime(2020, 1, 1)
+DEFAULT_ROWS = "10000"
+
+
+def pytest_addoption(parser: t.Any) -> None:
+    parser.addoption(
+        "--rows",
+        default=DEFAULT_ROWS,
+        help="Comma separated sizes of the synthetic recorded_values tables, "
+        "such as 10000,1000000,10000000",
+    )
+
+
+def pytest_generate_tests(metafunc: t.Any) -> None:
+    if "rows" in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption("rows").split(",")]
+        metafunc.parametrize("rows", sizes, scope="session")
+
+
+class FakeDHT:
+    temperature = 21.5
+    humidity = 48.0
+
+
+@pytest.fixture
+def fake_hardware() -> t.Iterator[None]:
+    """Replace psutil, DNS and the DHT22 with fakes that return fixed values
+    immediately, so results don't depend on the machine or its load."""
+    memory = mock.Mock(available=JSON_VALUES["RAMAvailable"])
+    battery = mock.Mock(power_plugged=True)
+    addresses = [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.168.1.10", 0)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("fe80::1", 0, 0, 0)),
+    ]
+    with mock.patch("psutil.cpu_percent", return_value=25.0), mock.patch(
+        "psutil.virtual_memory", return_value=memory
+    ), mock.patch("psutil.sensors_battery", return_value=battery), mock.patch(
+        "socket.gethostname", return_value="benchmark"
+    ), mock.patch(
+        "socket.getaddrinfo", return_value=addresses
+    ), mock.patch.object(
+        sensors, "dht_sensor", FakeDHT()
+    ):
+        yield
+
+
+@pytest.fixture
+def installed_sensors(fake_hardware: None) -> t.Iterator[t.List[t.Any]]:
+    """Serve the built-in sensors without looking up entry points"""
+    installed = [
+        sensors.PythonVersion(),
+        sensors.IPAddresses(),
+        sensors.CPULoad(),
+        sensors.RAMAvailable(),
+        sensors.ACStatus(),
+        sensors.Temperature(),
+        sensors.RelativeHumidity(),
+    ]
+    with mock.patch("apd.sensors.cli.get_sensors", return_value=installed):
+        yield installed
+
+
+def synthetic_rows(count: int) -> t.Iterator[t.Dict[str, t.Any]]:
+    """Yield rows with a value of every sensor each minute from START"""
+    names = list(JSON_VALUES)
+    for i in range(count):
+        name = names[i % len(names)]
+        yield {
+            "sensor_name": name,
+            "collected_at": START + datetime.timedelta(minutes=i // len(names)),
+            "data": JSON_VALUES[name],
+        }
+
+
+def last_collected_at(rows: int) -> datetime.datetime:
+    return START + datetime.timedelta(minutes=(rows - 1) // len(JSON_VALUES))
+
+
+@pytest.fixture(scope="session")
+def synthetic_database(request: t.Any, rows: int) -> str:
+    """Return the URI of an SQLite database with a recorded_values table of
+    the given size. Databases are kept in the pytest cache, as large ones
+    take minutes to build."""
+    import itertools
+
+    import sqlalchemy
+    from apd.sensors.backfill import apply_bulk_pragmas, indexes_dropped, insert_rows
+    from apd.sensors.database import metadata, rebuild_latest_values
+
+    directory = pathlib.Path(request.config.cache.mkdir("apd-sensors-tables"))
+    path = directory / f"recorded_values-{rows}.sqlite"
+    uri = f"sqlite:///{path}"
+    if path.exists():
+        return uri
+    building = path.with_suffix(".building")
+    if building.exists():
+        building.unlink()
+    engine = sqlalchemy.create_engine(f"sqlite:///{building}")
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        apply_bulk_pragmas(connection)
+        with indexes_dropped(connection):
+            generated = synthetic_rows(rows)
+            while True:
+                batch = list(itertools.islice(generated, 50000))
+                if not batch:
+                    break
+                with connection.begin():
+                    insert_rows(connection, batch)
+        with connection.begin():
+            rebuild_latest_values(connection)
+    engine.dispose()
+    building.rename(path)
+    return uri
+
+
+@pytest.fixture
+def api_key() -> str:
+    return uuid.uuid4().hex
+
+
+@pytest.fixture
+def api_server(api_key: str, installed_sensors: t.Any) -> t.Iterator[t.Any]:
+    """Return a webtest client for the v3.1 API, as in the tests, using the
+    same database engine configuration as the production server."""
+    import flask
+    from webtest import TestApp
+    from apd.sensors import wsgi
+    from apd.sensors.database import metadata
+    from apd.sensors.wsgi import set_up_config, v31
+
+    def client(db_uri: str) -> t.Any:
+        app = flask.Flask("benchmarks")
+        app.register_blueprint(v31.version)
+        set_up_config(
+            {
+                "APD_SENSORS_API_KEY": api_key,
+                "APD_SENSORS_DEPLOYMENT_ID": uuid.uuid4().hex,
+                "APD_SENSORS_DB_URI": db_uri,
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+            },
+            to_configure=app,
+        )
+        db = wsgi.TunedSQLAlchemy(app, metadata=metadata)
+        engines.append(db)
+        wsgi.db = db
+        return TestApp(app, extra_environ={"HTTP_X_API_KEY": api_key})
+
+    original = wsgi.db
+    engines: t.List[t.Any] = []
+    yield client
+    wsgi.db = original
+    for db in engines:
+        with db.get_app().app_context():
+            db.engine.dispose()
+
+
+def peak_memory(function: t.Callable[[], t.Any]) -> int:
+    """Return the peak memory allocated by Python while calling function"""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,293 @@
+"""A load generator, which fills a database with readings from the synthetic
+sensors and replays concurrent API traffic against a server, for measuring
+the limits of storage and the API.
+"""
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import math
+import random
+import time
+import typing as t
+import urllib.parse
+
+import click
+
+from .sensors import SENSORS, SyntheticSensor
+
+
+DEFAULT_ROWS = 1_000_000
+DEFAULT_BATCH_SIZE = 50000
+
+Row = t.Dict[str, t.Any]
+# The label used in reports, the path and the relative frequency of a request
+Request = t.Tuple[str, str, float]
+
+
+class RequestStats(t.NamedTuple):
+    # Seconds taken by each request, in ascending order
+    latencies: t.List[float]
+    errors: int
+
+
+def synthetic_rows(
+    rows: int, end: datetime.datetime, rate: float, seed: int
+) -> t.Iterator[Row]:
+    """Yield rows of the recorded_values table for the synthetic sensors,
+    interleaved in the order they would have been collected, finishing at
+    end."""
+    sensors = [sensor_class(seed, rate, 0.0) for sensor_class in SENSORS]
+    per_sensor = math.ceil(rows / len(sensors))
+    start = end - datetime.timedelta(seconds=per_sensor / rate)
+    streams = [sensor_rows(sensor, start, end) for sensor in sensors]
+    merged = heapq.merge(*streams, key=lambda row: row["collected_at"])
+    return itertools.islice(merged, rows)
+
+
+def sensor_rows(
+    sensor: SyntheticSensor[t.Any], start: datetime.datetime, end: datetime.datetime
+) -> t.Iterator[Row]:
+    for collected_at, value in sensor.samples(start, end):
+        yield {
+            "sensor_name": sensor.name,
+            "collected_at": collected_at,
+            "data": sensor.to_json_compatible(value),
+        }
+
+
+def percentile(latencies: t.Sequence[float], percent: float) -> float:
+    """Return a percentile of sorted latencies, using the nearest rank method"""
+    if not latencies:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(latencies))
+    return latencies[max(rank, 1) - 1]
+
+
+def default_requests(now: datetime.datetime) -> t.List[Request]:
+    """A mix of traffic like that of a dashboard, which mostly polls recent
+    values, and an aggregator, which replicates stored values"""
+    start = urllib.parse.quote((now - datetime.timedelta(hours=1)).isoformat())
+    end = urllib.parse.quote(now.isoformat())
+    return [
+        ("sensors", "/v/3.1/sensors/", 1.0),
+        ("latest", "/v/3.1/latest", 4.0),
+        ("historical", f"/v/3.1/historical/{start}/{end}", 4.0),
+        ("changes", "/v/3.1/changes?limit=1000", 1.0),
+    ]
+
+
+def run_worker(
+    url: str,
+    api_key: str,
+    requests: t.Sequence[Request],
+    deadline: float,
+    seed: int,
+) -> t.List[t.Tuple[str, float, bool]]:
+    """Make requests one after another until the deadline, returning the
+    label, latency and success of each."""
+    from apd.sensors.client import ConnectionPool
+
+    pool = ConnectionPool(url)
+    generator = random.Random(seed)
+    weights = [weight for label, path, weight in requests]
+    headers = {"X-API-Key": api_key, "Accept-Encoding": "gzip"}
+    results = []
+    try:
+        while time.monotonic() < deadline:
+            label, path, weight = generator.choices(requests, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, body = pool.request(path, headers)
+            except OSError:
+                succeeded = False
+            else:
+                succeeded = status == 200
+            results.append((label, time.perf_counter() - started, succeeded))
+    finally:
+        pool.close()
+    return results
+
+
+def replay_traffic(
+    url: str,
+    api_key: str,
+    requests: t.Sequence[Request],
+    concurrency: int,
+    duration: float,
+    seed: int = 0,
+) -> t.Dict[str, RequestStats]:
+    """Make requests from concurrency threads for duration seconds, choosing
+    each request at random by weight."""
+    deadline = time.monotonic() + duration
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(run_worker, url, api_key, requests, deadline, seed + i)
+            for i in range(concurrency)
+        ]
+        results = [result for future in futures for result in future.result()]
+    latencies: t.Dict[str, t.List[float]] = {label: [] for label, _, _ in requests}
+    errors = {label: 0 for label in latencies}
+    for label, latency, succeeded in results:
+        latencies[label].append(latency)
+        if not succeeded:
+            errors[label] += 1
+    return {
+        label: RequestStats(sorted(latencies[label]), errors[label])
+        for label in latencies
+    }
+
+
+@click.group(help="Generates load for apd.sensors from synthetic sensors")
+def load() -> None:
+    pass
+
+
+@load.command(help="Fills the recorded_values table with synthetic readings")
+@click.option(
+    "--db",
+    metavar="<CONNECTION_STRING>",
+    default="sqlite:///sensor_data.sqlite",
+    help="The connection string to a database",
+    envvar="APD_SENSORS_DB_URI",
+)
+@click.option(
+    "--rows", type=click.IntRange(min=1), default=DEFAULT_ROWS, show_default=True
+)
+@click.option(
+    "--end",
+    type=click.DateTime(),
+    help="The collection time of the last readings, by default now",
+)
+@click.option(
+    "--rate",
+    type=click.FloatRange(min=0.0001),
+    default=1 / 60,
+    help="Readings per second from each sensor, by default one a minute",
+)
+@click.option("--seed", type=int, default=0, envvar="APD_SYNTHETIC_SEED")
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_BATCH_SIZE,
+    show_default=True,
+)
+@click.option(
+    "--drop-indexes",
+    is_flag=True,
+    help="Rebuild the indexes after filling, rather than updating them",
+)
+def fill(
+    db: str,
+    rows: int,
+    end: t.Optional[datetime.datetime],
+    rate: float,
+    seed: int,
+    batch_size: int,
+    drop_indexes: bool,
+) -> None:
+    import contextlib
+
+    from apd.sensors import backfill
+    from apd.sensors.database import create_engine, metadata, rebuild_latest_values
+
+    if end is None:
+        end = datetime.datetime.now()
+    generated = synthetic_rows(rows, end, rate, seed)
+    engine = create_engine(db)
+    started = time.perf_counter()
+    inserted = 0
+    try:
+        metadata.create_all(engine)
+        with engine.connect() as connection:
+            backfill.apply_bulk_pragmas(connection)
+            indexes: t.ContextManager[None] = contextlib.nullcontext()
+            if drop_indexes:
+                indexes = backfill.indexes_dropped(connection)
+            with indexes:
+                while True:
+                    batch = list(itertools.islice(generated, batch_size))
+                    if not batch:
+                        break
+                    with connection.begin():
+                        backfill.insert_rows(connection, batch)
+                    inserted += len(batch)
+            with connection.begin():
+                rebuild_latest_values(connection)
+    finally:
+        engine.dispose()
+    elapsed = time.perf_counter() - started
+    click.echo(
+        f"Inserted {inserted} readings in {elapsed:.2f}s "
+        f"({inserted / elapsed:.0f} rows/s)"
+    )
+
+
+@load.command(help="Replays concurrent API traffic against a server")
+@click.option(
+    "--url",
+    required=True,
+    metavar="<URL>",
+    help="The base URL of the server, such as http://localhost:8000",
+)
+@click.option(
+    "--api-key",
+    metavar="<KEY>",
+    required=True,
+    envvar="APD_SENSORS_API_KEY",
+    help="The server's API key",
+)
+@click.option("--concurrency", type=click.IntRange(min=1), default=8, show_default=True)
+@click.option(
+    "--duration",
+    type=click.FloatRange(min=0),
+    default=30.0,
+    show_default=True,
+    metavar="<SECONDS>",
+)
+@click.option(
+    "--path",
+    "paths",
+    multiple=True,
+    metavar="<PATH>",
+    help="Request these paths with equal frequency, rather than a mix of "
+    "current, latest, historical and replication requests",
+)
+@click.option("--seed", type=int, default=0, envvar="APD_SYNTHETIC_SEED")
+def replay(
+    url: str,
+    api_key: str,
+    concurrency: int,
+    duration: float,
+    paths: t.Tuple[str, ...],
+    seed: int,
+) -> None:
+    if paths:
+        requests = [(path, path, 1.0) for path in paths]
+    else:
+        requests = default_requests(datetime.datetime.now())
+    stats = replay_traffic(url, api_key, requests, concurrency, duration, seed)
+    width = max(len(label) for label in stats)
+    click.echo(
+        f"{'Request':<{width}}  {'Count':>8}  {'Errors':>6}  "
+        f"{'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}  {'max ms':>8}"
+    )
+    for label, request_stats in stats.items():
+        latencies = request_stats.latencies
+        columns = [
+            percentile(latencies, 50),
+            percentile(latencies, 95),
+            percentile(latencies, 99),
+            latencies[-1] if latencies else 0.0,
+        ]
+        click.echo(
+            f"{label:<{width}}  {len(latencies):>8}  {request_stats.errors:>6}  "
+            + "  ".join(f"{seconds * 1000:>8.1f}" for seconds in columns)
+        )
+    total = sum(len(request_stats.latencies) for request_stats in stats.values())
+    rate = total / duration if duration else 0.0
+    click.echo(f"{total} requests in {duration:.1f}s ({rate:.1f} requests/s)")
+
+
+if __name__ == "__main__":
+    load()
@@ -0,0 +1,125 @@
+"""Sensors that generate deterministic values at a configurable rate, for
+testing storage and the API at production volumes without real hardware.
+
+Each sensor has a stream of samples, ``APD_SYNTHETIC_RATE`` per second
+(default 1), numbered from ``EPOCH``. Sample ``n`` is the same in every
+process given the same ``APD_SYNTHETIC_SEED``, so reading a sensor returns
+the sample for the current time, and ``samples()`` generates the values of a
+past period. Values follow a daily cycle with noise, and a proportion
+``APD_SYNTHETIC_FAILURE_RATE`` of samples (default 0) are intermittent
+failures.
+
+The sensors subclass the built-in sensors, so values are formatted and stored
+the same way.
+"""
+import datetime
+import hashlib
+import math
+import os
+import struct
+import typing as t
+
+from apd.sensors.base import Sensor
+from apd.sensors.exceptions import IntermittentSensorFailureError
+from apd.sensors.sensors import CPULoad, RAMAvailable, Temperature, ureg
+
+
+T_value = t.TypeVar("T_value")
+
+EPOCH = datetime.datetime(2020, 1, 1)
+SECONDS_PER_DAY = 24 * 60 * 60
+# Two unsigned 64 bit integers, for two uniformly distributed numbers per sample
+UNIFORM = struct.Struct(">QQ")
+
+
+class SyntheticSensor(Sensor[T_value]):
+    def __init__(
+        self,
+        seed: t.Optional[int] = None,
+        rate: t.Optional[float] = None,
+        failure_rate: t.Optional[float] = None,
+    ) -> None:
+        super().__init__()
+        if seed is None:
+            seed = int(os.environ.get("APD_SYNTHETIC_SEED", "0"))
+        if rate is None:
+            rate = float(os.environ.get("APD_SYNTHETIC_RATE", "1"))
+        if failure_rate is None:
+            failure_rate = float(os.environ.get("APD_SYNTHETIC_FAILURE_RATE", "0"))
+        if rate <= 0:
+            raise ValueError("The rate of samples must be positive")
+        self.seed = seed
+        self.rate = rate
+        self.failure_rate = failure_rate
+
+    def index(self, at: datetime.datetime) -> int:
+        """Return the number of the sample current at a time"""
+        return math.floor((at - EPOCH).total_seconds() * self.rate)
+
+    def time_of(self, index: int) -> datetime.datetime:
+        return EPOCH + datetime.timedelta(seconds=index / self.rate)
+
+    def sample(self, index: int) -> T_value:
+        """Return the value of a sample, or raise the failure it represents"""
+        # Hashing is much faster than seeding a random number generator
+        digest = hashlib.blake2b(
+            f"{self.seed}:{self.name}:{index}".encode("ascii"), digest_size=16
+        ).digest()
+        failure, noise = (number / 2 ** 64 for number in UNIFORM.unpack(digest))
+        if failure < self.failure_rate:
+            raise IntermittentSensorFailureError(f"Synthetic failure of sample {index}")
+        seconds = index / self.rate
+        # From -1 at midnight to 1 at midday
+        cycle = -math.cos(2 * math.pi * (seconds % SECONDS_PER_DAY) / SECONDS_PER_DAY)
+        return self.generate(cycle, noise)
+
+    def generate(self, cycle: float, noise: float) -> T_value:
+        """Return a value from the position in the daily cycle, between -1
+        and 1, and a uniformly distributed random number"""
+        raise NotImplementedError
+
+    def value(self) -> T_value:
+        return self.sample(self.index(datetime.datetime.now()))
+
+    def samples(
+        self, start: datetime.datetime, end: datetime.datetime
+    ) -> t.Iterator[t.Tuple[datetime.datetime, T_value]]:
+        """Yield the collection time and value of each sample from start up
+        to end, skipping failures."""
+        for index in range(self.index(start), self.index(end)):
+            try:
+                value = self.sample(index)
+            except IntermittentSensorFailureError:
+                continue
+            yield self.time_of(index), value
+
+
+class SyntheticLoad(SyntheticSensor[float], CPULoad):
+    name = "SyntheticLoad"
+    title = "Synthetic CPU Usage"
+
+    def generate(self, cycle: float, noise: float) -> float:
+        return round(0.3 + 0.2 * cycle + 0.3 * noise, 3)
+
+
+class SyntheticRAMAvailable(SyntheticSensor[int], RAMAvailable):
+    name = "SyntheticRAMAvailable"
+    title = "Synthetic RAM Available"
+
+    def generate(self, cycle: float, noise: float) -> int:
+        return int((2048 - 512 * cycle - 256 * noise) * 1024 * 1024)
+
+
+class SyntheticTemperature(SyntheticSensor[t.Any], Temperature):
+    name = "SyntheticTemperature"
+    title = "Synthetic Ambient Temperature"
+
+    def generate(self, cycle: float, noise: float) -> t.Any:
+        return ureg.Quantity(round(20 + 4 * cycle + noise, 1), ureg.celsius)
+
+
+SENSORS: t.List[t.Type[SyntheticSensor[t.Any]]] = [
+    SyntheticLoad,
+    SyntheticRAMAvailable,
+    SyntheticTemperature,
+]
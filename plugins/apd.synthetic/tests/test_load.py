@@ -0,0 +1,98 @@
+import datetime
+import threading
+import wsgiref.simple_server
+
+import pytest
+from click.testing import CliRunner
+
+from apd.synthetic import load
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    def app(environ, start_response):
+        if environ.get("HTTP_X_API_KEY") != "key":
+            status = "403 Forbidden"
+        elif environ["PATH_INFO"] == "/v/3.1/broken":
+            status = "500 Internal Server Error"
+        else:
+            status = "200 OK"
+        start_response(status, [("Content-Type", "application/json")])
+        return [b"{}"]
+
+    httpd = wsgiref.simple_server.make_server(
+        "127.0.0.1", 0, app, handler_class=QuietHandler
+    )
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_synthetic_rows_are_in_collection_order():
+    end = datetime.datetime(2020, 6, 1)
+    rows = list(load.synthetic_rows(10, end, 1 / 60, 0))
+    assert len(rows) == 10
+    assert [row["collected_at"] for row in rows] == sorted(
+        row["collected_at"] for row in rows
+    )
+    assert rows[-1]["collected_at"] < end
+    assert {row["sensor_name"] for row in rows} == {
+        "SyntheticLoad",
+        "SyntheticRAMAvailable",
+        "SyntheticTemperature",
+    }
+
+
+def test_fill(tmp_path):
+    import sqlalchemy
+
+    db_uri = f"sqlite:///{tmp_path / 'sensor_data.sqlite'}"
+    result = CliRunner().invoke(
+        load.load, ["fill", "--db", db_uri, "--rows", "1000", "--drop-indexes"]
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("Inserted 1000 readings")
+    engine = sqlalchemy.create_engine(db_uri)
+    assert engine.execute("SELECT COUNT(*) FROM recorded_values").scalar() == 1000
+    assert engine.execute("SELECT COUNT(*) FROM latest_values").scalar() == 3
+    engine.dispose()
+
+
+def test_replay_traffic(server):
+    requests = [("ok", "/v/3.1/sensors/", 3.0), ("broken", "/v/3.1/broken", 1.0)]
+    stats = load.replay_traffic(server, "key", requests, 2, 0.5)
+    assert len(stats["ok"].latencies) > len(stats["broken"].latencies) > 0
+    assert stats["ok"].errors == 0
+    assert stats["broken"].errors == len(stats["broken"].latencies)
+
+
+def test_replay(server):
+    result = CliRunner().invoke(
+        load.load,
+        [
+            "replay",
+            "--url",
+            server,
+            "--api-key",
+            "key",
+            "--concurrency",
+            "2",
+            "--duration",
+            "0.2",
+            "--path",
+            "/v/3.1/latest",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    header, row, total = result.output.splitlines()
+    assert header.split()[:3] == ["Request", "Count", "Errors"]
+    assert row.split()[0] == "/v/3.1/latest"
+    assert row.split()[2] == "0"
+    assert "requests in 0.2s" in total
@@ -0,0 +1,57 @@
+import datetime
+
+import pytest
+
+from apd.sensors.exceptions import IntermittentSensorFailureError
+from apd.synthetic.sensors import (
+    SyntheticLoad,
+    SyntheticRAMAvailable,
+    SyntheticTemperature,
+)
+
+
+START = datetime.datetime(2020, 6, 1, 12)
+
+
+def test_samples_are_deterministic():
+    first = list(SyntheticLoad(seed=1).samples(START, START.replace(minute=1)))
+    second = list(SyntheticLoad(seed=1).samples(START, START.replace(minute=1)))
+    other = list(SyntheticLoad(seed=2).samples(START, START.replace(minute=1)))
+    assert first == second
+    assert first != other
+
+
+def test_samples_are_generated_at_rate():
+    sensor = SyntheticRAMAvailable(rate=2)
+    samples = list(sensor.samples(START, START + datetime.timedelta(seconds=10)))
+    assert len(samples) == 20
+    assert samples[1][0] - samples[0][0] == datetime.timedelta(seconds=0.5)
+    assert all(isinstance(value, int) for collected_at, value in samples)
+
+
+def test_value_is_the_current_sample():
+    sensor = SyntheticLoad(rate=0.001)
+    now = datetime.datetime.now()
+    assert sensor.value() == sensor.sample(sensor.index(now))
+    assert 0 <= sensor.value() <= 1
+
+
+def test_failures():
+    sensor = SyntheticLoad(failure_rate=1)
+    with pytest.raises(IntermittentSensorFailureError):
+        sensor.value()
+    assert list(sensor.samples(START, START.replace(minute=1))) == []
+
+
+def test_values_are_stored_like_the_built_in_sensors():
+    sensor = SyntheticTemperature()
+    value = sensor.value()
+    json_value = sensor.to_json_compatible(value)
+    assert json_value["unit"] == "degree_Celsius"
+    assert 15 <= json_value["magnitude"] <= 25
+    assert sensor.format(sensor.from_json_compatible(json_value)).endswith("°F)")
+
+
+def test_rate_must_be_positive():
+    with pytest.raises(ValueError):
+        SyntheticLoad(rate=0)
@@ -0,0 +1,30 @@
+"""Add import progress table
+
+Revision ID: 3c8e1d2f4a6b
+Revises: 0eeb2a54fea8
+Create Date: 2020-06-02 10:12:44.120511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3c8e1d2f4a6b"
+down_revision = "0eeb2a54fea8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "import_progress",
+        sa.Column("source", sa.String(), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.TIMESTAMP(), nullable=False),
+        sa.PrimaryKeyConstraint("source"),
+    )
+
+
+def downgrade():
+    op.drop_table("import_progress")
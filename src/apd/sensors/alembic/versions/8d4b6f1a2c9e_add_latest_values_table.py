@@ -0,0 +1,44 @@
+"""Add latest values table
+
+Revision ID: 8d4b6f1a2c9e
+Revises: 3c8e1d2f4a6b
+Create Date: 2020-06-09 14:27:05.813264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8d4b6f1a2c9e"
+down_revision = "3c8e1d2f4a6b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "latest_values",
+        sa.Column("sensor_name", sa.String(), nullable=False),
+        sa.Column("collected_at", sa.TIMESTAMP(), nullable=False),
+        sa.Column("data", sa.JSON(), nullable=True),
+        sa.PrimaryKeyConstraint("sensor_name"),
+    )
+    # Populate with the newest existing value of each sensor
+    op.execute(
+        """
+        INSERT INTO latest_values (sensor_name, collected_at, data)
+        SELECT sensor_name, collected_at, data FROM (
+            SELECT sensor_name, collected_at, data, ROW_NUMBER() OVER (
+                PARTITION BY sensor_name ORDER BY collected_at DESC, id DESC
+            ) AS position
+            FROM recorded_values
+            WHERE sensor_name IS NOT NULL AND collected_at IS NOT NULL
+        ) AS ranked
+        WHERE position = 1
+        """
+    )
+
+
+def downgrade():
+    op.drop_table("latest_values")
@@ -0,0 +1,570 @@
+"""An asyncio implementation of the v3.1 HTTP API, for ASGI servers such as
+uvicorn. Sensors are read concurrently through ``Sensor.value_async()``,
+so a single event loop can serve many slow requests at once."""
+import asyncio
+import datetime
+import hashlib
+import os
+import re
+import typing as t
+import urllib.parse
+from hmac import compare_digest
+
+from . import (
+    cli,
+    ingest,
+    live,
+    metrics,
+    responses,
+    sharedstore,
+    timeseries,
+    writebehind,
+)
+from .base import Sensor
+from .sensors import DHTSensor
+
+
+Scope = t.Dict[str, t.Any]
+Message = t.Dict[str, t.Any]
+Receive = t.Callable[[], t.Awaitable[Message]]
+Send = t.Callable[[Message], t.Awaitable[None]]
+ViewReturn = t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]
+# The value data and error data of a sensor, either of which may be None
+ReadResult = t.Tuple[t.Optional[t.Dict[str, t.Any]], t.Optional[t.Dict[str, t.Any]]]
+View = t.Callable[..., t.Awaitable[t.Optional[ViewReturn]]]
+
+REQUIRED_CONFIG_KEYS = {"APD_SENSORS_API_KEY"}
+PREFIX = "/v/3.1"
+RANGE = r"(?:/(?P<start>[^/]+)(?:/(?P<end>[^/]+))?)?"
+
+
+class APIApp:
+    def __init__(self, config: t.Dict[str, str]) -> None:
+        self.config = config
+        self.engine: t.Any = None
+        self.routes: t.List[t.Tuple[t.Pattern[str], View, bool]] = [
+            (re.compile(r"^/sensors/$"), self.sensor_values, True),
+            (re.compile(r"^/sensors/(?P<sensor_id>[^/]+)$"), self.sensor_values, True),
+            (re.compile(r"^/info/sensors$"), self.sensor_types, True),
+            (
+                re.compile(rf"^/sensors/(?P<sensor_id>[^/]+)/historical{RANGE}$"),
+                self.historical_values,
+                True,
+            ),
+            (re.compile(rf"^/historical{RANGE}$"), self.historical_values, True),
+            (re.compile(r"^/latest$"), self.latest_values, True),
+            (
+                re.compile(r"^/sensors/(?P<sensor_id>[^/]+)/latest$"),
+                self.latest_values,
+                True,
+            ),
+            (re.compile(r"^/changes$"), self.changes, True),
+            (re.compile(r"^/ingest$"), self.ingest_values, True),
+            (re.compile(r"^/deployment_id$"), self.deployment_id, False),
+        ]
+        # Streaming views send their own response
+        self.stream_routes: t.List[t.Tuple[t.Pattern[str], View, bool]] = [
+            (re.compile(r"^/stream$"), self.stream, True),
+            (re.compile(r"^/sensors/(?P<sensor_id>[^/]+)/stream$"), self.stream, True),
+        ]
+        # Views whose data can be sent in other formats, layouts and encodings
+        self.negotiated_views: t.List[View] = [self.historical_values]
+        # Views that take options from the query string
+        self.query_views: t.List[View] = [
+            self.historical_values,
+            self.latest_values,
+            self.changes,
+        ]
+        # Views that are POSTed a request body, rather than fetched with GET
+        self.body_views: t.List[View] = [self.ingest_values]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        if scope["path"] == "/metrics" and scope["method"] == "GET":
+            await self.send_body(
+                send,
+                metrics.render().encode("utf-8"),
+                200,
+                {"Content-Type": metrics.CONTENT_TYPE, "Cache-Control": "no-store"},
+            )
+            return
+        for pattern, view, requires_key in self.stream_routes:
+            match = pattern.match(self.route_path(scope))
+            if match and scope["method"] == "GET" and self.has_api_key(scope):
+                await view(scope, receive, send, **match.groupdict())
+                return
+        (data, status, headers), source = await self.dispatch(scope, receive)
+        if status == 200 and source in self.negotiated_views:
+            body, encoding_headers = responses.encode(
+                data,
+                get_header(scope, b"accept"),
+                get_header(scope, b"accept-encoding"),
+                get_query_arg(scope, "layout"),
+            )
+            headers = {**headers, **encoding_headers}
+        else:
+            body = responses.serialise(data, responses.JSON)
+            headers = {"Content-Type": responses.JSON, **headers}
+        if_none_match = get_header(scope, b"if-none-match")
+        await self.send_body(send, body, status, headers, if_none_match)
+
+    async def lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Store any readings still queued before the server exits
+                await asyncio.get_running_loop().run_in_executor(
+                    None, writebehind.close_all
+                )
+                if self.engine is not None:
+                    self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def route_path(self, scope: Scope) -> str:
+        path = scope["path"]
+        if not path.startswith(PREFIX):
+            return ""
+        return path.partition(PREFIX)[2]
+
+    async def dispatch(
+        self, scope: Scope, receive: Receive
+    ) -> t.Tuple[ViewReturn, t.Optional[View]]:
+        """Return the response data and the view that produced it, if any."""
+        path = self.route_path(scope)
+        for pattern, view, requires_key in self.routes + self.stream_routes:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            method = "POST" if view in self.body_views else "GET"
+            if scope["method"] != method:
+                return ({"error": "Method not allowed"}, 405, {"Allow": method}), None
+            if requires_key and not self.has_api_key(scope):
+                return ({"error": "Supply API key in X-API-Key header"}, 403, {}), None
+            kwargs: t.Dict[str, t.Any] = {
+                k: v for k, v in match.groupdict().items() if v is not None
+            }
+            if view in self.query_views:
+                kwargs["query"] = get_query(scope)
+            if view in self.body_views:
+                body = await read_body(receive, ingest.MAX_INGEST_SIZE)
+                if body is None:
+                    return ({"error": "Request body too large"}, 413, {}), None
+                kwargs["body"] = body
+                kwargs["content_type"] = get_header(scope, b"content-type") or ""
+            return t.cast(ViewReturn, await view(**kwargs)), view
+        return ({"error": "Not found"}, 404, {}), None
+
+    def has_api_key(self, scope: Scope) -> bool:
+        api_key = self.config["APD_SENSORS_API_KEY"]
+        return compare_digest(api_key, get_header(scope, b"x-api-key") or "")
+
+    async def send_body(
+        self,
+        send: Send,
+        body: bytes,
+        status: int,
+        headers: t.Dict[str, str],
+        if_none_match: t.Optional[str] = None,
+    ) -> None:
+        headers = {**headers, "Content-Length": str(len(body))}
+        if status == 200:
+            # The same strong ETag as werkzeug generates
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            headers["ETag"] = etag
+            if if_none_match and etag_matches(if_none_match, etag):
+                status, body = 304, b""
+                del headers["Content-Type"], headers["Content-Length"]
+        raw_headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers.items()
+        ]
+        await send(
+            {"type": "http.response.start", "status": status, "headers": raw_headers}
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def read_sensor(
+        self, sensor: Sensor[t.Any]
+    ) -> t.Tuple[t.Optional[t.Dict[str, t.Any]], t.Optional[t.Dict[str, t.Any]]]:
+        """Return a tuple of the sensor's value data and its error data, either
+        of which may be None."""
+        now = datetime.datetime.now()
+        shared_store = self.config.get("APD_SENSORS_SHARED_STORE")
+        try:
+            try:
+                if shared_store:
+                    now, value = sharedstore.read_value(
+                        shared_store, sensor, sharedstore.get_max_age(self.config)
+                    )
+                else:
+                    with metrics.timed_read(sensor.name):
+                        value = await sensor.value_async()
+            except Exception as err:
+                return None, responses.error_data(sensor, err, now)
+            value_data = responses.value_data(sensor, value, now)
+            if not shared_store:
+                queue = writebehind.get_queue(self.config)
+                if queue is not None:
+                    queue.put(sensor.name, now, value_data["value"])
+            return value_data, None
+        except NotImplementedError:
+            return None, None
+
+    async def read_in_turn(self, sensors: t.List[Sensor[t.Any]]) -> t.List[ReadResult]:
+        return [await self.read_sensor(sensor) for sensor in sensors]
+
+    async def sensor_values(self, sensor_id: t.Optional[str] = None) -> ViewReturn:
+        headers = {
+            "Content-Security-Policy": "default-src 'none'",
+            "Cache-Control": responses.LIVE_CACHE_CONTROL,
+        }
+        to_read = [
+            sensor
+            for sensor in cli.get_sensors()
+            if not sensor_id or sensor_id == sensor.name
+        ]
+        # Sensors sharing the DHT would only wait for each other in executor
+        # threads, so are read one after another rather than concurrently
+        groups = [[s] for s in to_read if not isinstance(s, DHTSensor)]
+        dht_sensors: t.List[Sensor[t.Any]] = [
+            s for s in to_read if isinstance(s, DHTSensor)
+        ]
+        if dht_sensors:
+            groups.append(dht_sensors)
+        grouped = await asyncio.gather(*(self.read_in_turn(g) for g in groups))
+        by_sensor = {
+            id(sensor): result
+            for group, group_results in zip(groups, grouped)
+            for sensor, result in zip(group, group_results)
+        }
+        results = [by_sensor[id(sensor)] for sensor in to_read]
+        sensors = [value for value, error in results if value is not None]
+        errors = [error for value, error in results if error is not None]
+        data = {"sensors": sensors, "errors": errors}
+        return data, 200, headers
+
+    async def sensor_types(self) -> ViewReturn:
+        headers = {
+            "Content-Security-Policy": "default-src 'none'",
+            "Cache-Control": responses.INFO_CACHE_CONTROL,
+        }
+        known_sensors = {sensor.name: sensor.title for sensor in cli.get_sensors()}
+        return known_sensors, 200, headers
+
+    async def historical_values(
+        self,
+        start: t.Optional[str] = None,
+        end: t.Optional[str] = None,
+        sensor_id: t.Optional[str] = None,
+        query: t.Optional[t.Dict[str, str]] = None,
+    ) -> ViewReturn:
+        include_human_readable = responses.parse_flag(
+            (query or {}).get("human_readable")
+        )
+        # Database access is blocking, so it's run in the executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            self.historical_values_sync,
+            start,
+            end,
+            sensor_id,
+            include_human_readable,
+        )
+
+    def historical_values_sync(
+        self,
+        start: t.Optional[str] = None,
+        end: t.Optional[str] = None,
+        sensor_id: t.Optional[str] = None,
+        include_human_readable: bool = True,
+    ) -> ViewReturn:
+        try:
+            start_dt, end_dt = responses.date_range(start, end)
+        except ImportError:
+            return {"error": "Historical data support is not installed"}, 501, {}
+
+        known_sensors = {sensor.name: sensor for sensor in cli.get_sensors()}
+
+        if sensor_id and sensor_id in known_sensors:
+            known_sensors = {sensor_id: known_sensors[sensor_id]}
+
+        headers = {"Content-Security-Policy": "default-src 'none'"}
+        headers.update(responses.range_cache_headers(end_dt if end else None))
+
+        stored_values: t.List[t.Tuple[str, datetime.datetime, t.Any]] = []
+        timeseries_path = self.config.get("APD_SENSORS_TIMESERIES_PATH")
+        partitions_path = self.config.get("APD_SENSORS_DB_PARTITIONS")
+        engine = None
+        if timeseries_path:
+            store = timeseries.get_store(timeseries_path)
+            stored_values = list(store.values(start_dt, end_dt, list(known_sensors)))
+        elif partitions_path:
+            from apd.sensors.database import get_router, parse_pragmas
+
+            pragmas = parse_pragmas(self.config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+            router = get_router(partitions_path, pragmas)
+            stored_values = list(
+                router.stored_values(start_dt, end_dt, list(known_sensors))
+            )
+        else:
+            engine = self.get_engine()
+        if engine is not None:
+            from apd.sensors.database import sensor_values as sensor_values_table
+
+            query = sensor_values_table.select().where(
+                sensor_values_table.c.collected_at >= start_dt
+            )
+            query = query.where(sensor_values_table.c.collected_at <= end_dt)
+            with engine.connect() as connection:
+                stored_values = [
+                    (row.sensor_name, row.collected_at, row.data)
+                    for row in connection.execute(query)
+                ]
+
+        sensors = responses.historical_data(
+            known_sensors, stored_values, start_dt, end_dt, include_human_readable
+        )
+        return {"sensors": sensors}, 200, headers
+
+    async def latest_values(
+        self,
+        sensor_id: t.Optional[str] = None,
+        query: t.Optional[t.Dict[str, str]] = None,
+    ) -> ViewReturn:
+        include_human_readable = responses.parse_flag(
+            (query or {}).get("human_readable")
+        )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.latest_values_sync, sensor_id, include_human_readable
+        )
+
+    def latest_values_sync(
+        self, sensor_id: t.Optional[str] = None, include_human_readable: bool = True
+    ) -> ViewReturn:
+        known_sensors = {sensor.name: sensor for sensor in cli.get_sensors()}
+        if sensor_id:
+            known_sensors = {
+                name: sensor
+                for name, sensor in known_sensors.items()
+                if name == sensor_id
+            }
+        headers = {
+            "Content-Security-Policy": "default-src 'none'",
+            "Cache-Control": responses.LIVE_CACHE_CONTROL,
+        }
+
+        timeseries_path = self.config.get("APD_SENSORS_TIMESERIES_PATH")
+        partitions_path = self.config.get("APD_SENSORS_DB_PARTITIONS")
+        if timeseries_path:
+            store = timeseries.get_store(timeseries_path)
+            stored_values = store.latest_values(list(known_sensors))
+        elif partitions_path:
+            from apd.sensors.database import get_router, parse_pragmas
+
+            pragmas = parse_pragmas(self.config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+            router = get_router(partitions_path, pragmas)
+            stored_values = router.latest_values(list(known_sensors))
+        else:
+            engine = self.get_engine()
+            if engine is None:
+                return {"error": "Historical data support is not installed"}, 501, {}
+            from apd.sensors.database import latest_stored_values
+
+            with engine.connect() as connection:
+                stored_values = latest_stored_values(connection, list(known_sensors))
+
+        sensors = responses.latest_data(
+            known_sensors, stored_values, include_human_readable
+        )
+        return {"sensors": sensors}, 200, headers
+
+    async def changes(self, query: t.Optional[t.Dict[str, str]] = None) -> ViewReturn:
+        query = query or {}
+        try:
+            since_id, limit = responses.changes_range(
+                query.get("since_id"), query.get("limit")
+            )
+        except ValueError as err:
+            return {"error": str(err)}, 400, {}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.changes_sync, since_id, limit)
+
+    def changes_sync(self, since_id: int, limit: int) -> ViewReturn:
+        if self.config.get("APD_SENSORS_DB_PARTITIONS"):
+            return {"error": responses.PARTITIONED_CHANGES_ERROR}, 501, {}
+        engine = self.get_engine()
+        if engine is None:
+            return {"error": "Historical data support is not installed"}, 501, {}
+        from apd.sensors.database import values_since
+
+        headers = {
+            "Content-Security-Policy": "default-src 'none'",
+            "Cache-Control": responses.LIVE_CACHE_CONTROL,
+        }
+        with engine.begin() as connection:
+            rows = values_since(connection, since_id, limit + 1)
+        deployment_id = self.config["APD_SENSORS_DEPLOYMENT_ID"]
+        data = responses.changes_data(rows, since_id, limit, deployment_id)
+        return data, 200, headers
+
+    async def ingest_values(self, body: bytes, content_type: str) -> ViewReturn:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self.ingest_values_sync, body, content_type
+        )
+
+    def ingest_values_sync(self, body: bytes, content_type: str) -> ViewReturn:
+        headers = {"Content-Security-Policy": "default-src 'none'"}
+        known_sensors = {sensor.name: sensor for sensor in cli.get_sensors()}
+        partitions_path = self.config.get("APD_SENSORS_DB_PARTITIONS")
+        try:
+            if partitions_path:
+                from apd.sensors.database import get_router, parse_pragmas
+
+                # Each partition's readings are stored in a transaction of
+                # their own
+                pragmas = parse_pragmas(self.config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+                router = get_router(partitions_path, pragmas)
+                data = ingest.ingest(
+                    router.store_readings, known_sensors, body, content_type
+                )
+            else:
+                engine = self.get_engine()
+                if engine is None:
+                    return (
+                        {"error": "Historical data support is not installed"},
+                        501,
+                        {},
+                    )
+                from apd.sensors.database import store_readings
+
+                with engine.begin() as connection:
+                    data = ingest.ingest(
+                        lambda rows: store_readings(connection, rows),
+                        known_sensors,
+                        body,
+                        content_type,
+                    )
+        except ingest.IngestError as err:
+            return {"error": str(err)}, 400, headers
+        return data, 200, headers
+
+    def get_engine(self) -> t.Any:
+        if self.engine is None:
+            try:
+                from apd.sensors.database import create_engine, parse_pragmas
+            except ImportError:
+                return None
+            self.engine = create_engine(
+                self.config["SQLALCHEMY_DATABASE_URI"],
+                parse_pragmas(self.config.get("APD_SENSORS_SQLITE_PRAGMAS")),
+            )
+        return self.engine
+
+    async def stream(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+        sensor_id: t.Optional[str] = None,
+    ) -> None:
+        last_id = live.parse_event_id(
+            get_header(scope, b"last-event-id") or get_query_arg(scope, "last_event_id")
+        )
+        feed = live.get_feed(self.config)
+        headers = [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"content-security-policy", b"default-src 'none'"),
+            (b"x-accel-buffering", b"no"),
+        ]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            async for chunk in live.stream_async(feed, last_id, sensor_id):
+                if disconnected.done():
+                    break
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk.encode("utf-8"),
+                        "more_body": True,
+                    }
+                )
+        finally:
+            disconnected.cancel()
+
+    async def deployment_id(self) -> ViewReturn:
+        headers = {
+            "Content-Security-Policy": "default-src 'none'",
+            "Cache-Control": responses.DEPLOYMENT_CACHE_CONTROL,
+        }
+        data = {"deployment_id": self.config["APD_SENSORS_DEPLOYMENT_ID"]}
+        return data, 200, headers
+
+
+def get_header(scope: Scope, name: bytes) -> t.Optional[str]:
+    for header, value in scope["headers"]:
+        if header == name:
+            return t.cast(bytes, value).decode("latin-1")
+    return None
+
+
+def get_query(scope: Scope) -> t.Dict[str, str]:
+    query_string = scope.get("query_string", b"").decode("latin-1")
+    return dict(urllib.parse.parse_qsl(query_string))
+
+
+def get_query_arg(scope: Scope, name: str) -> t.Optional[str]:
+    return get_query(scope).get(name)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    tags = {tag[2:] if tag.startswith("W/") else tag for tag in tags}
+    return "*" in tags or etag in tags
+
+
+async def read_body(receive: Receive, max_size: int) -> t.Optional[bytes]:
+    """Return the request body, or None if it is larger than max_size."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body.extend(message.get("body", b""))
+        if len(body) > max_size:
+            return None
+        if not message.get("more_body", False):
+            break
+    return bytes(body)
+
+
+async def wait_for_disconnect(receive: Receive) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def create_app(environ: t.Optional[t.Dict[str, str]] = None) -> APIApp:
+    if environ is None:
+        environ = dict(os.environ)
+    missing_keys = REQUIRED_CONFIG_KEYS - environ.keys()
+    if missing_keys:
+        raise ValueError("Missing config variables: {}".format(", ".join(missing_keys)))
+    data_file = os.path.join(os.getcwd(), "sensor_data.sqlite")
+    environ["SQLALCHEMY_DATABASE_URI"] = environ.get(
+        "APD_SENSORS_DB_URI", f"sqlite:///{data_file}"
+    )
+    return APIApp(environ)
@@ -0,0 +1,163 @@
+"""Bulk loading of readings from CSV or JSON lines files, such as those written
+by ``sensors export``, into the recorded_values table."""
+import contextlib
+import csv
+import datetime
+import itertools
+import json
+import time
+import typing as t
+
+import sqlalchemy
+
+from .database import import_progress, sensor_values, update_latest_values
+from .ingest import IngestError
+
+
+FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+DEFAULT_BATCH_SIZE = 10000
+# SQLite before 3.32 allows at most 999 parameters in a statement
+ROWS_PER_STATEMENT = 999 // len(sensor_values.c)
+# Trade durability against power loss for speed. An interrupted load is
+# rolled back to the last batch either way, as the journal is still used.
+SQLITE_BULK_PRAGMAS = [
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+]
+
+Row = t.Dict[str, t.Any]
+
+
+class ImportStats(t.NamedTuple):
+    rows: int
+    skipped: int
+    elapsed: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+def read_csv(file: t.TextIO, skip: int = 0) -> t.Iterator[t.Any]:
+    for reading in itertools.islice(csv.DictReader(file), skip, None):
+        try:
+            reading["value"] = json.loads(reading["value"])
+        except (KeyError, TypeError, ValueError):
+            # Left for to_row() to reject
+            pass
+        yield reading
+
+
+def read_ndjson(file: t.TextIO, skip: int = 0) -> t.Iterator[t.Any]:
+    # Skipped lines aren't parsed, so resuming a large import is quick
+    lines = (line for line in file if line.strip())
+    for number, line in enumerate(itertools.islice(lines, skip, None), skip + 1):
+        try:
+            yield json.loads(line)
+        except ValueError as err:
+            raise IngestError(f"Invalid JSON in reading {number}: {err}") from err
+
+
+READERS: t.Dict[str, t.Callable[[t.TextIO, int], t.Iterator[t.Any]]] = {
+    "csv": read_csv,
+    "ndjson": read_ndjson,
+}
+
+
+def get_progress(connection: sqlalchemy.engine.Connection, source: str) -> int:
+    query = sqlalchemy.select([import_progress.c.position]).where(
+        import_progress.c.source == source
+    )
+    return connection.execute(query).scalar() or 0
+
+
+def set_progress(
+    connection: sqlalchemy.engine.Connection, source: str, position: int
+) -> None:
+    values = {"position": position, "updated_at": datetime.datetime.now()}
+    result = connection.execute(
+        import_progress.update()
+        .where(import_progress.c.source == source)
+        .values(**values)
+    )
+    if result.rowcount == 0:
+        connection.execute(import_progress.insert().values(source=source, **values))
+
+
+def clear_progress(connection: sqlalchemy.engine.Connection, source: str) -> None:
+    connection.execute(
+        import_progress.delete().where(import_progress.c.source == source)
+    )
+
+
+def insert_rows(connection: sqlalchemy.engine.Connection, rows: t.List[Row]) -> None:
+    """Insert rows using multi-row INSERT statements."""
+    for offset in range(0, len(rows), ROWS_PER_STATEMENT):
+        end = offset + ROWS_PER_STATEMENT
+        connection.execute(sensor_values.insert().values(rows[offset:end]))
+
+
+def apply_bulk_pragmas(connection: sqlalchemy.engine.Connection) -> None:
+    if connection.dialect.name == "sqlite":
+        for pragma in SQLITE_BULK_PRAGMAS:
+            connection.execute(pragma)
+
+
+@contextlib.contextmanager
+def indexes_dropped(
+    connection: sqlalchemy.engine.Connection, table: sqlalchemy.Table = sensor_values
+) -> t.Iterator[None]:
+    """Drop a table's indexes, and rebuild them afterwards, even if the load
+    fails. Building an index once is much faster than updating it per row."""
+    inspector = sqlalchemy.inspect(connection)
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        # Indexes may already be missing if an earlier load was killed
+        if index.name in existing:
+            index.drop(connection)
+    try:
+        yield
+    finally:
+        for index in table.indexes:
+            index.create(connection)
+
+
+def bulk_load(
+    connection: sqlalchemy.engine.Connection,
+    readings: t.Iterable[t.Any],
+    to_row: t.Callable[[t.Any], Row],
+    source: str,
+    start: int = 0,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> ImportStats:
+    """Store readings in transactions of batch_size rows. The number of
+    readings from the source that have been stored is recorded in the same
+    transaction, so an interrupted load can be resumed from that position."""
+    started = time.perf_counter()
+    position = start
+    batch: t.List[Row] = []
+    for reading in readings:
+        position += 1
+        try:
+            batch.append(to_row(reading))
+        except IngestError as err:
+            raise IngestError(f"Reading {position}: {err}") from err
+        if len(batch) >= batch_size:
+            store_batch(connection, batch, source, position)
+            batch = []
+    if batch:
+        store_batch(connection, batch, source, position)
+    return ImportStats(position - start, start, time.perf_counter() - started)
+
+
+def store_batch(
+    connection: sqlalchemy.engine.Connection,
+    rows: t.List[Row],
+    source: str,
+    position: int,
+) -> None:
+    with connection.begin():
+        insert_rows(connection, rows)
+        update_latest_values(connection, rows)
+        set_progress(connection, source, position)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # coding: utf-8
+import asyncio
 import datetime
 import typing as t
 
@@ -14,10 +15,22 @@ class Sensor(t.Generic[T_value]):
     def value(self) -> T_value:
         raise NotImplementedError
 
+    async def value_async(self) -> T_value:
+        # Sensors that can be read without blocking should override this,
+        # otherwise the blocking read is run in the event loop's executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.value)
+
     @classmethod
     def format(cls, value: T_value) -> str:
         raise NotImplementedError
 
+    @classmethod
+    def format_many(cls, values: t.Sequence[T_value]) -> t.List[str]:
+        # Sensors can override this to format many values at once, for
+        # example when returning historical data
+        return [cls.format(value) for value in values]
+
     def __str__(self) -> str:
         return self.format(self.value())
 
@@ -29,6 +42,19 @@ class Sensor(t.Generic[T_value]):
     def from_json_compatible(cls, json_version: t.Any) -> T_value:
         raise NotImplementedError()
 
+    @classmethod
+    def from_json_compatible_many(
+        cls, json_versions: t.Sequence[t.Any]
+    ) -> t.Sequence[T_value]:
+        # The result only needs to be accepted by format_many, so sensors that
+        # override both can use a more efficient representation, such as an array
+        return [cls.from_json_compatible(json_value) for json_value in json_versions]
+
+    @classmethod
+    def has_batch_formatting(cls) -> bool:
+        format_many = cls.format_many.__func__  # type: ignore
+        return format_many is not Sensor.format_many.__func__  # type: ignore
+
 
 class JSONSensor(Sensor[T_value]):
     @classmethod
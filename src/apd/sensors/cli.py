@@ -1,7 +1,14 @@
+import concurrent.futures
+import contextlib
+import datetime
 import enum
 import importlib
+import json
+import os
+import pathlib
 import sys
 import pkg_resources
+import time
 import traceback
 import typing as t
 
@@ -11,9 +18,18 @@ from .base import Sensor
 from .exceptions import DataCollectionError, UserFacingCLIError
 
 
+# Seconds to wait for a locked SQLite database before spooling values
+DEFAULT_SPOOL_TIMEOUT = 1.0
+# The shortest --watch interval, as shorter ones would just read continuously
+MIN_WATCH_INTERVAL = 1.0
+
+
 class ReturnCodes(enum.IntEnum):
     OK = 0
     BAD_SENSOR_PATH = 17
+    BAD_IMPORT_DATA = 18
+    SPOOL_NOT_DRAINED = 19
+    SENSOR_NOT_SUPPORTED = 20
 
 
 def get_sensor_by_path(sensor_path: str) -> Sensor[t.Any]:
@@ -59,7 +75,20 @@ def get_sensors() -> t.Iterable[Sensor[t.Any]]:
     return sensors
 
 
-@click.command(help="Displays the values of the sensors")
+def sqlite_pragmas() -> t.Dict[str, str]:
+    from .database import parse_pragmas
+
+    return parse_pragmas(os.environ.get("APD_SENSORS_SQLITE_PRAGMAS"))
+
+
+def create_engine(db: str) -> t.Any:
+    """Create a database engine, with the pragmas from the environment"""
+    from .database import create_engine
+
+    return create_engine(db, sqlite_pragmas())
+
+
+@click.group(help="Displays the values of the sensors", invoke_without_command=True)
 @click.option(
     "--develop", required=False, metavar="path", help="Load a sensor by Python path"
 )
@@ -72,7 +101,76 @@ def get_sensors() -> t.Iterable[Sensor[t.Any]]:
     help="The connection string to a database",
     envvar="APD_SENSORS_DB_URI",
 )
-def show_sensors(develop: str, verbose: bool, save: bool, db: str) -> None:
+@click.option(
+    "--timeseries",
+    metavar="<PATH>",
+    help="Save numeric values to time series files in this directory, "
+    "rather than to the database",
+    envvar="APD_SENSORS_TIMESERIES_PATH",
+)
+@click.option(
+    "--partitions",
+    metavar="<PATH>",
+    help="Save to one SQLite database per month in this directory, "
+    "rather than to the database",
+    envvar="APD_SENSORS_DB_PARTITIONS",
+)
+@click.option(
+    "--spool",
+    "spool_path",
+    metavar="<PATH>",
+    help="Keep values in this file if they can't be saved to the database, "
+    "and save them later",
+    envvar="APD_SENSORS_SPOOL",
+)
+@click.option(
+    "--spool-max-size",
+    type=click.IntRange(min=1),
+    default=64 * 1024 * 1024,
+    metavar="<BYTES>",
+    help="The largest the spool file can grow to",
+    envvar="APD_SENSORS_SPOOL_MAX_SIZE",
+)
+@click.option(
+    "--spool-timeout",
+    type=click.FloatRange(min=0),
+    default=DEFAULT_SPOOL_TIMEOUT,
+    metavar="<SECONDS>",
+    help="How long to wait for a locked SQLite database before spooling values",
+    envvar="APD_SENSORS_SPOOL_TIMEOUT",
+)
+@click.option("--parallel", is_flag=True, help="Read all the sensors concurrently")
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "ndjson"]),
+    default="text",
+    help="Show values as text, or as a JSON object per line as each is read",
+)
+@click.option(
+    "--watch",
+    type=click.FloatRange(min=MIN_WATCH_INTERVAL),
+    metavar="<SECONDS>",
+    help="Keep reading the sensors at this interval, rather than exiting",
+)
+@click.pass_context
+def show_sensors(
+    ctx: click.Context,
+    develop: str,
+    verbose: bool,
+    save: bool,
+    db: str,
+    timeseries: t.Optional[str],
+    partitions: t.Optional[str],
+    spool_path: t.Optional[str],
+    spool_max_size: int,
+    spool_timeout: float,
+    parallel: bool,
+    output_format: str,
+    watch: t.Optional[float],
+) -> None:
+    if ctx.invoked_subcommand is not None:
+        return
     sensors: t.Iterable[Sensor[t.Any]]
     if develop:
         try:
@@ -86,34 +184,611 @@ def show_sensors(develop: str, verbose: bool, save: bool, db: str) -> None:
     else:
         sensors = get_sensors()
 
-    db_session = None
-    if save:
-        from sqlalchemy import create_engine
-        from sqlalchemy.orm import sessionmaker
-        from .database import store_sensor_data
+    store = None
+    storage = None
+    spool = None
+    if save and timeseries:
+        from .timeseries import TimeSeriesStore
 
-        engine = create_engine(db)
-        sm = sessionmaker(engine)
-        db_session = sm()
+        store = TimeSeriesStore(timeseries)
+    elif save and spool_path:
+        from .spool import Spool
+
+        # Spooling is quicker than waiting for another process to finish
+        # writing, and doesn't hold up reading the remaining sensors
+        storage = get_storage(db, partitions, busy_timeout=spool_timeout)
+        spool = Spool(spool_path, max_size=spool_max_size)
+    elif save:
+        storage = get_storage(db, partitions)
+
+    # Messages go to stderr when stdout is for machine-readable output
+    err = output_format == "ndjson"
+    sensors = list(sensors)
+    executor = None
+    if parallel and sensors:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(sensors), thread_name_prefix="apd.sensors.cli"
+        )
+    try:
+        while True:
+            started = time.monotonic()
+            # Once saving fails, the rest of the values read in this round are
+            # spooled without waiting for the database
+            database_available = True
+            for reading in read_sensors(sensors, executor):
+                sensor = reading.sensor
+                if output_format == "ndjson":
+                    click.echo(reading_json(reading))
+                else:
+                    click.secho(sensor.title, bold=True)
+                if reading.error is not None:
+                    if output_format == "ndjson":
+                        continue
+                    if verbose:
+                        tb = traceback.format_exception(
+                            type(reading.error),
+                            reading.error,
+                            reading.error.__traceback__,
+                        )
+                        click.echo("".join(tb))
+                        continue
+                    click.echo(reading.error)
+                else:
+                    if output_format == "text":
+                        click.echo(sensor.format(reading.value))
+                    if save and store is not None:
+                        from .timeseries import UnsupportedValueError
+
+                        try:
+                            store.append(
+                                sensor.name,
+                                reading.collected_at,
+                                sensor.to_json_compatible(reading.value),
+                            )
+                        except UnsupportedValueError as error:
+                            click.secho(f"Not saved, as {error}", fg="yellow", err=err)
+                    elif save and storage is not None:
+                        row = {
+                            "sensor_name": sensor.name,
+                            "collected_at": reading.collected_at,
+                            "data": sensor.to_json_compatible(reading.value),
+                        }
+                        if spool is None:
+                            storage([row])
+                        else:
+                            database_available = store_or_spool(
+                                storage, spool, [row], database_available, err=err
+                            )
+                if output_format == "text":
+                    click.echo("")
+            if spool is not None and storage is not None and database_available:
+                drain_spool(storage, spool, err=err)
+            if watch is None:
+                break
+            time.sleep(max(watch - (time.monotonic() - started), 0))
+    except KeyboardInterrupt:
+        # The usual way to stop --watch
+        if watch is None:
+            raise
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+        if spool is not None:
+            report_backlog(spool, err=err)
+            spool.close()
+    sys.exit(ReturnCodes.OK)
+
+
+class Reading(t.NamedTuple):
+    sensor: Sensor[t.Any]
+    collected_at: datetime.datetime
+    value: t.Any
+    error: t.Optional[DataCollectionError]
+
+
+def read_sensor(sensor: Sensor[t.Any]) -> Reading:
+    collected_at = datetime.datetime.now()
+    try:
+        value = sensor.value()
+    except DataCollectionError as error:
+        return Reading(sensor, collected_at, None, error)
+    return Reading(sensor, collected_at, value, None)
+
+
+def read_sensors(
+    sensors: t.Iterable[Sensor[t.Any]],
+    executor: t.Optional[concurrent.futures.Executor] = None,
+) -> t.Iterator[Reading]:
+    """Yield a reading of each sensor in turn or, with an executor, read all
+    of them concurrently and yield each reading as soon as it's available."""
+    if executor is None:
+        for sensor in sensors:
+            yield read_sensor(sensor)
+        return
+    futures = [executor.submit(read_sensor, sensor) for sensor in sensors]
+    for future in concurrent.futures.as_completed(futures):
+        yield future.result()
+
+
+def reading_json(reading: Reading) -> str:
+    """Return a reading in the format of the v3.1 API, which can also be
+    imported by ``sensors import`` or the ingest API."""
+    from . import responses
+
+    if reading.error is None:
+        data = responses.value_data(reading.sensor, reading.value, reading.collected_at)
+    else:
+        data = responses.error_data(reading.sensor, reading.error, reading.collected_at)
+    return json.dumps(data, separators=(",", ":"))
+
+
+def get_storage(
+    db: str, partitions: t.Optional[str], busy_timeout: t.Optional[float] = None
+) -> t.Callable[[t.List[t.Dict[str, t.Any]]], None]:
+    """Return a function that stores rows in the database, or in monthly
+    partitions if a directory is given. If busy_timeout is given, writes to
+    an SQLite database that is locked fail after that many seconds."""
+    from . import database
 
-    for sensor in sensors:
-        click.secho(sensor.title, bold=True)
+    pragmas = sqlite_pragmas()
+    if busy_timeout is not None:
+        pragmas["busy_timeout"] = str(round(busy_timeout * 1000))
+    if partitions:
+        return database.get_router(partitions, pragmas).store_readings
+    return database.engine_storage(database.create_engine(db, pragmas))
+
+
+def store_or_spool(
+    storage: t.Callable[[t.List[t.Dict[str, t.Any]]], None],
+    spool: t.Any,
+    rows: t.List[t.Dict[str, t.Any]],
+    database_available: bool,
+    err: bool = False,
+) -> bool:
+    """Store rows, or add them to the spool if the database is unavailable.
+    Returns whether the database is still available."""
+    from sqlalchemy.exc import SQLAlchemyError
+    from .spool import SpoolFullError
+
+    if database_available:
         try:
-            value = sensor.value()
-        except DataCollectionError as error:
-            if verbose:
-                tb = traceback.format_exception(type(error), error, error.__traceback__)
-                click.echo("".join(tb))
-                continue
-            click.echo(error)
+            storage(rows)
+            return True
+        except SQLAlchemyError as error:
+            reason = getattr(error, "orig", None) or error
+            click.secho(
+                f"Could not save ({reason}), spooling values to {spool.path}",
+                fg="yellow",
+                err=err,
+            )
+    try:
+        spool.append(rows)
+    except SpoolFullError as error:
+        click.secho(str(error), fg="red", bold=True, err=err)
+    return False
+
+
+def drain_spool(
+    storage: t.Callable[[t.List[t.Dict[str, t.Any]]], None],
+    spool: t.Any,
+    err: bool = False,
+) -> bool:
+    """Store the values in the spool, returning whether all were stored."""
+    from sqlalchemy.exc import SQLAlchemyError
+
+    try:
+        drained = spool.drain(storage)
+    except SQLAlchemyError as error:
+        reason = getattr(error, "orig", None) or error
+        click.secho(f"Could not save spooled values ({reason})", fg="yellow", err=err)
+        return False
+    if drained:
+        click.echo(f"Saved {drained} spooled values", err=err)
+    return True
+
+
+def report_backlog(spool: t.Any, err: bool = False) -> None:
+    backlog = spool.backlog()
+    if backlog.readings:
+        click.secho(
+            f"{backlog.readings} values ({backlog.size} bytes) from "
+            f"{spool.oldest():%Y-%m-%d %H:%M:%S} onwards are waiting in the "
+            f"spool {spool.path}",
+            fg="yellow",
+            err=err,
+        )
+
+
+@show_sensors.command(name="spool", help="Shows or saves values in the spool")
+@click.option(
+    "--spool",
+    "spool_path",
+    metavar="<PATH>",
+    required=True,
+    help="The spool file",
+    envvar="APD_SENSORS_SPOOL",
+)
+@click.option(
+    "--db",
+    metavar="<CONNECTION_STRING>",
+    default="sqlite:///sensor_data.sqlite",
+    help="The connection string to a database",
+    envvar="APD_SENSORS_DB_URI",
+)
+@click.option(
+    "--partitions",
+    metavar="<PATH>",
+    help="The directory of monthly SQLite databases, if used",
+    envvar="APD_SENSORS_DB_PARTITIONS",
+)
+@click.option("--drain", is_flag=True, help="Save the values to the database")
+def show_spool(
+    spool_path: str, db: str, partitions: t.Optional[str], drain: bool
+) -> None:
+    from .spool import Spool
+
+    spool = Spool(spool_path)
+    if drain and not drain_spool(get_storage(db, partitions), spool):
+        report_backlog(spool)
+        sys.exit(ReturnCodes.SPOOL_NOT_DRAINED)
+    if spool.backlog().readings:
+        report_backlog(spool)
+    else:
+        click.echo("The spool is empty")
+
+
+@show_sensors.command(
+    name="drop-partitions", help="Deletes monthly partitions of old values"
+)
+@click.option(
+    "--partitions",
+    metavar="<PATH>",
+    required=True,
+    help="The directory of monthly SQLite databases",
+    envvar="APD_SENSORS_DB_PARTITIONS",
+)
+@click.option(
+    "--before",
+    type=click.DateTime(),
+    required=True,
+    help="Delete partitions that only hold values from before this time",
+)
+def drop_partitions(partitions: str, before: datetime.datetime) -> None:
+    from .database import PartitionRouter
+
+    router = PartitionRouter(partitions, pragmas=sqlite_pragmas())
+    try:
+        for path in router.drop_before(before):
+            click.echo(f"Deleted {path}")
+    finally:
+        router.dispose()
+
+
+@show_sensors.command(
+    name="rebuild-latest",
+    help="Rebuilds the table of the latest value of each sensor",
+)
+@click.option(
+    "--db",
+    metavar="<CONNECTION_STRING>",
+    default="sqlite:///sensor_data.sqlite",
+    help="The connection string to a database",
+    envvar="APD_SENSORS_DB_URI",
+)
+def rebuild_latest(db: str) -> None:
+    from .database import rebuild_latest_values
+
+    engine = create_engine(db)
+    try:
+        with engine.begin() as connection:
+            count = rebuild_latest_values(connection)
+    finally:
+        engine.dispose()
+    click.echo(f"Found the latest values of {count} sensors")
+
+
+@show_sensors.command(name="export", help="Exports stored values to CSV or JSON lines")
+@click.option(
+    "--db",
+    metavar="<CONNECTION_STRING>",
+    default="sqlite:///sensor_data.sqlite",
+    help="The connection string to a database",
+    envvar="APD_SENSORS_DB_URI",
+)
+@click.option(
+    "--sensor",
+    "sensor_names",
+    multiple=True,
+    metavar="<SENSOR_ID>",
+    help="Only export values of this sensor, can be given more than once",
+)
+@click.option("--start", type=click.DateTime(), help="Earliest collection time")
+@click.option("--end", type=click.DateTime(), help="Latest collection time")
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["csv", "ndjson"]),
+    default="csv",
+    show_default=True,
+)
+@click.option(
+    "--output",
+    metavar="<PATH>",
+    default="-",
+    help="The file to write to, or the directory to write partitions to",
+)
+@click.option(
+    "--partition",
+    type=click.Choice(["day", "month", "year"]),
+    help="Write one file per period",
+)
+@click.option("--human-readable", is_flag=True, help="Include formatted values")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000)
+@click.option(
+    "--partitions",
+    metavar="<PATH>",
+    help="Export from a directory of monthly SQLite databases instead of --db",
+    envvar="APD_SENSORS_DB_PARTITIONS",
+)
+def export_values(
+    db: str,
+    sensor_names: t.Tuple[str, ...],
+    start: t.Optional[datetime.datetime],
+    end: t.Optional[datetime.datetime],
+    output_format: str,
+    output: str,
+    partition: t.Optional[str],
+    human_readable: bool,
+    batch_size: int,
+    partitions: t.Optional[str],
+) -> None:
+    from .database import PartitionRouter
+    from .export import export, iter_batches, partition_batches, stored_values_query
+
+    if partition and output == "-":
+        raise click.BadParameter(
+            "A directory is needed for partitioned output", param_hint="--output"
+        )
+
+    def open_output(name: t.Optional[str]) -> t.ContextManager[t.TextIO]:
+        if name is not None:
+            directory = pathlib.Path(output)
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"{name}.{output_format}"
+        elif output == "-":
+            return contextlib.nullcontext(sys.stdout)
         else:
-            click.echo(sensor.format(value))
-            if save and db_session is not None:
-                store_sensor_data(sensor, value, db_session)
-                db_session.commit()
+            path = pathlib.Path(output)
+        # The csv module handles line endings itself
+        return open(path, "w", newline="", encoding="utf-8")
 
-        click.echo("")
-    sys.exit(ReturnCodes.OK)
+    known_sensors = {sensor.name: sensor for sensor in get_sensors()}
+    query = stored_values_query(sensor_names, start, end)
+    if partitions:
+        router = PartitionRouter(partitions, pragmas=sqlite_pragmas())
+        try:
+            stats = export(
+                partition_batches(router, query, batch_size, start, end),
+                open_output,
+                output_format,
+                known_sensors,
+                partition,
+                human_readable,
+            )
+        finally:
+            router.dispose()
+    else:
+        engine = create_engine(db)
+        try:
+            with engine.connect() as connection:
+                stats = export(
+                    iter_batches(connection, query, batch_size),
+                    open_output,
+                    output_format,
+                    known_sensors,
+                    partition,
+                    human_readable,
+                )
+        finally:
+            engine.dispose()
+    click.echo(
+        f"Exported {stats.rows} values to {stats.files} file(s) in "
+        f"{stats.elapsed:.2f}s ({stats.rows_per_second:.0f} rows/s)",
+        err=True,
+    )
+
+
+@show_sensors.command(name="import", help="Imports readings from CSV or JSON lines")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--db",
+    metavar="<CONNECTION_STRING>",
+    default="sqlite:///sensor_data.sqlite",
+    help="The connection string to a database",
+    envvar="APD_SENSORS_DB_URI",
+)
+@click.option(
+    "--format",
+    "input_format",
+    type=click.Choice(["csv", "ndjson"]),
+    help="The format of the file, if not given by its extension",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=10000,
+    show_default=True,
+    help="The number of readings stored in each transaction",
+)
+@click.option(
+    "--drop-indexes", is_flag=True, help="Rebuild indexes after loading the data"
+)
+@click.option(
+    "--restart", is_flag=True, help="Ignore the progress of earlier imports of PATH"
+)
+@click.option(
+    "--validate/--no-validate",
+    default=True,
+    help="Check values with the installed sensors",
+)
+@click.option(
+    "--partitions",
+    metavar="<PATH>",
+    hidden=True,
+    envvar="APD_SENSORS_DB_PARTITIONS",
+)
+def import_values(
+    path: str,
+    db: str,
+    input_format: t.Optional[str],
+    batch_size: int,
+    drop_indexes: bool,
+    restart: bool,
+    validate: bool,
+    partitions: t.Optional[str],
+) -> None:
+    from . import backfill
+    from .ingest import IngestError, to_row
+
+    if partitions:
+        # Import progress is tracked in the database being loaded, which
+        # monthly partitions don't have a single one of
+        raise click.UsageError(
+            "Readings can't be imported into monthly partitions, unset "
+            "APD_SENSORS_DB_PARTITIONS or use the ingest API instead"
+        )
+    source = pathlib.Path(path).resolve()
+    if input_format is None:
+        input_format = backfill.FORMATS.get(source.suffix.lower())
+        if input_format is None:
+            raise click.BadParameter(
+                "Unknown file extension, use --format", param_hint="PATH"
+            )
+
+    known_sensors = {sensor.name: sensor for sensor in get_sensors()}
+    engine = create_engine(db)
+    try:
+        with engine.connect() as connection:
+            if restart:
+                backfill.clear_progress(connection, str(source))
+            start = backfill.get_progress(connection, str(source))
+            backfill.apply_bulk_pragmas(connection)
+            indexes: t.ContextManager[None] = contextlib.nullcontext()
+            if drop_indexes:
+                indexes = backfill.indexes_dropped(connection)
+            with indexes, open(source, newline="", encoding="utf-8") as file:
+                readings = backfill.READERS[input_format](file, start)
+                stats = backfill.bulk_load(
+                    connection,
+                    readings,
+                    lambda reading: to_row(known_sensors, reading, validate),
+                    str(source),
+                    start,
+                    batch_size,
+                )
+    except IngestError as error:
+        click.secho(str(error), fg="red", bold=True)
+        click.echo("Earlier batches were stored, run the import again to continue")
+        sys.exit(ReturnCodes.BAD_IMPORT_DATA)
+    finally:
+        engine.dispose()
+    if stats.skipped:
+        click.echo(f"Skipped {stats.skipped} readings stored by an earlier import")
+    click.echo(
+        f"Imported {stats.rows} readings in {stats.elapsed:.2f}s "
+        f"({stats.rows_per_second:.0f} rows/s)"
+    )
+
+
+@show_sensors.command(
+    name="profile", help="Measures the latency and memory use of a sensor"
+)
+@click.argument("sensor_path", metavar="PATH")
+@click.option(
+    "--calls",
+    "-n",
+    type=click.IntRange(min=1),
+    default=100,
+    help="The number of times to read the sensor",
+)
+@click.option(
+    "--memory-calls",
+    type=click.IntRange(min=0),
+    default=10,
+    help="The number of extra reads to trace memory allocations of",
+)
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=0),
+    default=0.0,
+    metavar="<SECONDS>",
+    help="The time to wait between reads, for sensors that can't be read quickly",
+)
+@click.option(
+    "--cprofile",
+    "cprofile_path",
+    metavar="<PATH>",
+    help="Write a cProfile profile of another set of reads to this file",
+)
+@click.option("--verbose", is_flag=True, help="Show additional info")
+def profile_sensor(
+    sensor_path: str,
+    calls: int,
+    memory_calls: int,
+    interval: float,
+    cprofile_path: t.Optional[str],
+    verbose: bool,
+) -> None:
+    from . import profiling
+
+    try:
+        sensor = get_sensor_by_path(sensor_path)
+    except UserFacingCLIError as error:
+        if verbose:
+            tb = traceback.format_exception(type(error), error, error.__traceback__)
+            click.echo("".join(tb))
+        click.secho(error.message, fg="red", bold=True)
+        sys.exit(error.return_code)
+
+    try:
+        profile = profiling.profile_sensor(sensor, calls, memory_calls, interval)
+        if cprofile_path:
+            profiling.write_cprofile(sensor, calls, cprofile_path, interval)
+    except NotImplementedError:
+        click.secho(
+            f"{sensor.title} is not supported on this system", fg="red", bold=True
+        )
+        sys.exit(ReturnCodes.SENSOR_NOT_SUPPORTED)
+
+    click.secho(f"{sensor.title} ({profile.calls} calls)", bold=True)
+    latencies = ", ".join(
+        f"{label} {seconds * 1000:.3f}ms"
+        for label, seconds in (
+            ("p50", profile.percentile(50)),
+            ("p95", profile.percentile(95)),
+            ("p99", profile.percentile(99)),
+            ("max", profile.latencies[-1]),
+        )
+    )
+    click.echo(f"Latency: {latencies}")
+    failed = sum(profile.failures.values())
+    failures = f"Failures: {failed} ({profile.failure_rate:.1%})"
+    if failed:
+        failures += ": " + ", ".join(
+            f"{count} {result}" for result, count in sorted(profile.failures.items())
+        )
+    click.echo(failures)
+    if profile.peak_allocated:
+        click.echo(
+            "Memory per call: mean peak {} bytes (max {}), "
+            "mean retained {} bytes".format(
+                round(sum(profile.peak_allocated) / len(profile.peak_allocated)),
+                max(profile.peak_allocated),
+                round(sum(profile.retained) / len(profile.retained)),
+            )
+        )
+    if cprofile_path:
+        click.echo(f"Wrote cProfile data to {cprofile_path}")
 
 
 if __name__ == "__main__":
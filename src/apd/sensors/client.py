@@ -0,0 +1,195 @@
+"""A client for fetching data from the HTTP API of many nodes at once.
+
+Requests to each node are made concurrently from a thread pool, over
+keep-alive connections that are reused between requests."""
+import concurrent.futures
+import gzip
+import heapq
+import http.client
+import json
+import socket
+import threading
+import typing as t
+import urllib.parse
+
+from .exceptions import APDSensorsError
+
+
+API_PREFIX = "/v/3.1"
+DEFAULT_TIMEOUT = 10.0
+# Idle connections kept open to each node
+MAX_IDLE_CONNECTIONS = 4
+
+Reading = t.Dict[str, t.Any]
+CONNECTION_CLASSES: t.Dict[str, t.Type[http.client.HTTPConnection]] = {
+    "http": http.client.HTTPConnection,
+    "https": http.client.HTTPSConnection,
+}
+
+
+class NodeError(APDSensorsError):
+    """An error response, or no response, from a node"""
+
+
+class FleetResult(t.NamedTuple):
+    """The data returned by each node that responded successfully, and the
+    error for each node that didn't."""
+
+    values: t.Dict[str, t.Any]
+    errors: t.Dict[str, Exception]
+
+
+class ConnectionPool:
+    """A pool of keep-alive HTTP connections to a single node."""
+
+    def __init__(self, url: str, timeout: float = DEFAULT_TIMEOUT) -> None:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in CONNECTION_CLASSES:
+            raise ValueError(f"Unsupported URL: {url}")
+        self.connection_class = CONNECTION_CLASSES[parsed.scheme]
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.idle: t.List[http.client.HTTPConnection] = []
+        self.lock = threading.Lock()
+
+    def acquire(self) -> t.Tuple[http.client.HTTPConnection, bool]:
+        """Return a connection, and whether it has been used before."""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connection_class(self.netloc, timeout=self.timeout), False
+
+    def release(self, connection: http.client.HTTPConnection) -> None:
+        with self.lock:
+            if len(self.idle) < MAX_IDLE_CONNECTIONS:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, path: str, headers: t.Dict[str, str]) -> t.Tuple[int, bytes]:
+        connection, reused = self.acquire()
+        try:
+            connection.request("GET", self.base_path + path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except socket.timeout:
+            connection.close()
+            raise
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if reused:
+                # The node closed the idle connection, so retry on a new one
+                return self.request(path, headers)
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(connection)
+        if response.getheader("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return response.status, body
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+class Client:
+    """Fetch data from many nodes concurrently. Nodes are given as a mapping
+    of the base URL of each node to its API key."""
+
+    def __init__(
+        self,
+        nodes: t.Mapping[str, str],
+        timeout: float = DEFAULT_TIMEOUT,
+        max_workers: t.Optional[int] = None,
+    ) -> None:
+        self.api_keys = dict(nodes)
+        self.pools = {url: ConnectionPool(url, timeout) for url in nodes}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or min(32, len(self.pools) or 1)
+        )
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc_info: t.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for pool in self.pools.values():
+            pool.close()
+
+    def get_json(self, url: str, path: str) -> t.Any:
+        headers = {
+            "X-API-Key": self.api_keys[url],
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+        }
+        try:
+            status, body = self.pools[url].request(API_PREFIX + path, headers)
+        except (http.client.HTTPException, OSError) as err:
+            raise NodeError(f"Couldn't connect to {url}: {err}") from err
+        if status != 200:
+            raise NodeError(f"{url} returned {status} for {path}")
+        return json.loads(body)
+
+    def fetch_all(self, path: str) -> FleetResult:
+        futures = {
+            url: self.executor.submit(self.get_json, url, path) for url in self.pools
+        }
+        result = FleetResult({}, {})
+        for url, future in futures.items():
+            try:
+                result.values[url] = future.result()
+            except Exception as err:
+                result.errors[url] = err
+        return result
+
+    def sensors(self) -> FleetResult:
+        return self.fetch_all("/sensors/")
+
+    def deployment_ids(self) -> FleetResult:
+        result = self.fetch_all("/deployment_id")
+        for url, data in result.values.items():
+            result.values[url] = data["deployment_id"]
+        return result
+
+    def historical(
+        self,
+        start: t.Optional[str] = None,
+        end: t.Optional[str] = None,
+        sensor_id: t.Optional[str] = None,
+    ) -> FleetResult:
+        path = f"/sensors/{sensor_id}/historical" if sensor_id else "/historical"
+        for part in (start, end):
+            if part is None:
+                break
+            path += "/" + urllib.parse.quote(part, safe="")
+        result = self.fetch_all(path)
+        for url, data in result.values.items():
+            result.values[url] = data["sensors"]
+        return result
+
+
+def merge(
+    readings: t.Mapping[str, t.Iterable[Reading]]
+) -> t.Iterator[t.Tuple[str, Reading]]:
+    """Merge each node's readings into a single stream of (url, reading)
+    tuples, ordered by collected_at."""
+    streams = [
+        node_stream(url, node_readings) for url, node_readings in readings.items()
+    ]
+    return heapq.merge(*streams, key=lambda item: item[1]["collected_at"])
+
+
+def node_stream(
+    url: str, readings: t.Iterable[Reading]
+) -> t.Iterator[t.Tuple[str, Reading]]:
+    # Readings from HistoricalSensors follow the stored values, so must be sorted
+    for reading in sorted(readings, key=lambda reading: reading["collected_at"]):
+        yield url, reading
@@ -1,15 +1,31 @@
 from __future__ import annotations
 
+import concurrent.futures
 import datetime
+import pathlib
+import re
+import threading
 import typing as t
 
 import sqlalchemy
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.schema import Table
 from sqlalchemy.orm.session import Session
 
+from apd.sensors import metrics
 from apd.sensors.base import Sensor
 
 
+# Readers aren't blocked by a writer in WAL mode, and NORMAL synchronisation
+# is safe with WAL, only risking the last transactions on power loss
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": str(-16 * 1024),
+    "mmap_size": str(256 * 1024 * 1024),
+}
+PRAGMA_PATTERN = re.compile(r"^\s*(?P<name>[a-z_]+)\s*=\s*(?P<value>[\w.-]+)\s*$")
+
 metadata = sqlalchemy.MetaData()
 
 sensor_values = Table(
@@ -21,10 +37,453 @@ sensor_values = Table(
     sqlalchemy.Column("data", sqlalchemy.JSON),
 )
 
+# How many readings of each file passed to `sensors import` have been stored
+import_progress = Table(
+    "import_progress",
+    metadata,
+    sqlalchemy.Column("source", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("position", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("updated_at", sqlalchemy.TIMESTAMP, nullable=False),
+)
+
+# The most recent stored value of each sensor, updated along with recorded_values
+latest_values = Table(
+    "latest_values",
+    metadata,
+    sqlalchemy.Column("sensor_name", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("collected_at", sqlalchemy.TIMESTAMP, nullable=False),
+    sqlalchemy.Column("data", sqlalchemy.JSON),
+)
+
+StoredValue = t.Tuple[str, datetime.datetime, t.Any]
+
+
+def parse_pragmas(value: t.Optional[str]) -> t.Dict[str, str]:
+    """Parse comma separated name=value pairs of SQLite pragmas, such as the
+    APD_SENSORS_SQLITE_PRAGMAS environment variable."""
+    pragmas = {}
+    for setting in (value or "").split(","):
+        if not setting.strip():
+            continue
+        match = PRAGMA_PATTERN.match(setting.lower())
+        if match is None:
+            raise ValueError(f"Invalid SQLite pragma {setting!r}")
+        pragmas[match.group("name")] = match.group("value")
+    return pragmas
+
+
+def create_engine(
+    uri: t.Union[str, sqlalchemy.engine.url.URL],
+    pragmas: t.Optional[t.Mapping[str, str]] = None,
+    **options: t.Any,
+) -> sqlalchemy.engine.Engine:
+    """Create an engine for a database, with pooling and, for SQLite, pragmas
+    suited to a collector writing while API requests read. The given pragmas
+    are applied on top of SQLITE_PRAGMAS."""
+    if isinstance(uri, sqlalchemy.engine.url.URL):
+        url = uri
+    else:
+        url = sqlalchemy.engine.url.make_url(uri)
+    metrics.instrument_engines()
+    if url.get_backend_name() != "sqlite":
+        options.setdefault("pool_pre_ping", True)
+        return sqlalchemy.create_engine(url, **options)
+
+    if url.database in (None, "", ":memory:"):
+        # Each connection to an in-memory database would be a new database
+        options.setdefault("poolclass", StaticPool)
+    else:
+        # SQLAlchemy defaults to opening a new connection for each checkout
+        options.setdefault("poolclass", QueuePool)
+    options.setdefault("connect_args", {}).setdefault("check_same_thread", False)
+    engine = sqlalchemy.create_engine(url, **options)
+    all_pragmas = {**SQLITE_PRAGMAS, **(pragmas or {})}
+    if "busy_timeout" in all_pragmas:
+        # Setting journal_mode needs a lock, so the timeout must come first
+        all_pragmas = {"busy_timeout": all_pragmas.pop("busy_timeout"), **all_pragmas}
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection: t.Any, connection_record: t.Any) -> None:
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in all_pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+
+    return engine
+
 
 def store_sensor_data(sensor: Sensor[t.Any], data: t.Any, db_session: Session) -> None:
     now = datetime.datetime.now()
-    record = sensor_values.insert().values(
-        sensor_name=sensor.name, data=sensor.to_json_compatible(data), collected_at=now
+    row = {
+        "sensor_name": sensor.name,
+        "data": sensor.to_json_compatible(data),
+        "collected_at": now,
+    }
+    db_session.execute(sensor_values.insert().values(**row))
+    update_latest_values(db_session, [row])
+
+
+def update_latest_values(
+    connection: t.Union[Session, sqlalchemy.engine.Connection],
+    rows: t.Iterable[t.Dict[str, t.Any]],
+) -> None:
+    """Record the newest of the rows for each sensor in latest_values, unless
+    a newer value has already been stored. This must be called in the same
+    transaction as the rows are inserted."""
+    newest: t.Dict[str, t.Dict[str, t.Any]] = {}
+    for row in rows:
+        current = newest.get(row["sensor_name"])
+        if current is None or row["collected_at"] >= current["collected_at"]:
+            newest[row["sensor_name"]] = row
+    if dialect_name(connection) == "postgresql":
+        for row in newest.values():
+            connection.execute(latest_value_upsert(row))
+        return
+    for sensor_name, row in newest.items():
+        values = {"collected_at": row["collected_at"], "data": row["data"]}
+        update = (
+            latest_values.update()
+            .where(latest_values.c.sensor_name == sensor_name)
+            .where(latest_values.c.collected_at <= row["collected_at"])
+            .values(**values)
+        )
+        if connection.execute(update).rowcount:
+            continue
+        # Either there's no value for the sensor yet, or it's newer. Another
+        # writer may insert one first, so the insert is in a savepoint to
+        # leave the transaction usable if it fails.
+        try:
+            with connection.begin_nested():
+                connection.execute(
+                    latest_values.insert().values(sensor_name=sensor_name, **values)
+                )
+        except sqlalchemy.exc.IntegrityError:
+            connection.execute(update)
+
+
+def dialect_name(connection: t.Union[Session, sqlalchemy.engine.Connection]) -> str:
+    if isinstance(connection, sqlalchemy.engine.Connection):
+        return connection.dialect.name
+    # Sessions, including Flask-SQLAlchemy's scoped session
+    return connection.get_bind().dialect.name
+
+
+def latest_value_upsert(row: t.Dict[str, t.Any]) -> t.Any:
+    """Return a PostgreSQL statement that records a row in latest_values in
+    one step, unless a newer value has already been stored."""
+    from sqlalchemy.dialects.postgresql import insert
+
+    statement = insert(latest_values).values(
+        sensor_name=row["sensor_name"],
+        collected_at=row["collected_at"],
+        data=row["data"],
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[latest_values.c.sensor_name],
+        set_={
+            "collected_at": statement.excluded.collected_at,
+            "data": statement.excluded.data,
+        },
+        where=latest_values.c.collected_at <= statement.excluded.collected_at,
     )
-    db_session.execute(record)
+
+
+def latest_values_query() -> t.Any:
+    """Select the newest value of each sensor from recorded_values. This scans
+    the whole table, so is only used to rebuild latest_values."""
+    position = (
+        sqlalchemy.func.row_number()
+        .over(
+            partition_by=sensor_values.c.sensor_name,
+            order_by=(sensor_values.c.collected_at.desc(), sensor_values.c.id.desc()),
+        )
+        .label("position")
+    )
+    ranked = (
+        sqlalchemy.select(
+            [
+                sensor_values.c.sensor_name,
+                sensor_values.c.collected_at,
+                sensor_values.c.data,
+                position,
+            ]
+        )
+        .where(sensor_values.c.sensor_name.isnot(None))
+        .where(sensor_values.c.collected_at.isnot(None))
+        .alias("ranked")
+    )
+    return sqlalchemy.select(
+        [ranked.c.sensor_name, ranked.c.collected_at, ranked.c.data]
+    ).where(ranked.c.position == 1)
+
+
+def rebuild_latest_values(
+    connection: t.Union[Session, sqlalchemy.engine.Connection]
+) -> int:
+    """Replace the contents of latest_values with the newest value of each
+    sensor in recorded_values, returning the number of sensors."""
+    connection.execute(latest_values.delete())
+    connection.execute(
+        latest_values.insert().from_select(
+            ["sensor_name", "collected_at", "data"], latest_values_query()
+        )
+    )
+    count = connection.execute(
+        sqlalchemy.select([sqlalchemy.func.count()]).select_from(latest_values)
+    ).scalar()
+    return int(count)
+
+
+def latest_stored_values(
+    connection: t.Union[Session, sqlalchemy.engine.Connection],
+    sensor_names: t.Optional[t.Sequence[str]] = None,
+) -> t.List[StoredValue]:
+    """Return (sensor_name, collected_at, data) tuples of the latest value of
+    each sensor, ordered by sensor name."""
+    query = latest_values.select().order_by(latest_values.c.sensor_name)
+    if sensor_names is not None:
+        query = query.where(latest_values.c.sensor_name.in_(sensor_names))
+    return [
+        (row.sensor_name, row.collected_at, row.data)
+        for row in connection.execute(query)
+    ]
+
+
+def values_since(
+    connection: t.Union[Session, sqlalchemy.engine.Connection],
+    since_id: int,
+    limit: int,
+) -> t.List[t.Any]:
+    """Return up to limit recorded values with an id greater than since_id, in
+    id order. This is a range scan of the primary key, so is cheap to poll.
+
+    On PostgreSQL ids come from a sequence, so a writer that is still open can
+    commit a lower id than one that's already visible, and a client's cursor
+    would skip it. A SHARE lock waits for open writers first and holds off new
+    ones until the caller's transaction ends. SQLite only has one writer at a
+    time, so its ids are always committed in order."""
+    if dialect_name(connection) == "postgresql":
+        connection.execute(
+            sqlalchemy.text(f"LOCK TABLE {sensor_values.name} IN SHARE MODE")
+        )
+    query = (
+        sensor_values.select()
+        .where(sensor_values.c.id > since_id)
+        .order_by(sensor_values.c.id)
+        .limit(limit)
+    )
+    return list(connection.execute(query))
+
+
+def store_readings(
+    connection: t.Union[Session, sqlalchemy.engine.Connection],
+    rows: t.Sequence[t.Dict[str, t.Any]],
+) -> None:
+    """Insert many rows of sensor_name, collected_at and data with a single
+    executemany, in the caller's transaction."""
+    if rows:
+        connection.execute(sensor_values.insert(), list(rows))
+        update_latest_values(connection, rows)
+
+
+def engine_storage(
+    engine: sqlalchemy.engine.Engine,
+) -> t.Callable[[t.Sequence[t.Dict[str, t.Any]]], None]:
+    """Return a function that stores rows in a transaction of their own."""
+
+    def store(rows: t.Sequence[t.Dict[str, t.Any]]) -> None:
+        with engine.begin() as connection:
+            store_readings(connection, rows)
+
+    return store
+
+
+class PartitionRouter:
+    """Stores values in a directory of SQLite databases, one for each month.
+
+    Values are written to the partition for the month they were collected in,
+    and queries only open the partitions that overlap the requested range,
+    querying them concurrently. Old data can be removed by deleting whole
+    partitions."""
+
+    FILENAME_FORMAT = "sensor_data-%Y-%m.sqlite"
+
+    def __init__(
+        self,
+        directory: str,
+        max_workers: int = 4,
+        pragmas: t.Optional[t.Mapping[str, str]] = None,
+    ) -> None:
+        self.directory = pathlib.Path(directory)
+        self.pragmas = pragmas
+        self.engines: t.Dict[pathlib.Path, sqlalchemy.engine.Engine] = {}
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def partition_path(self, collected_at: datetime.datetime) -> pathlib.Path:
+        return self.directory / collected_at.strftime(self.FILENAME_FORMAT)
+
+    def partitions(self) -> t.List[t.Tuple[datetime.datetime, pathlib.Path]]:
+        """Return the (month start, path) of each partition, oldest first."""
+        partitions = []
+        for path in self.directory.glob("sensor_data-*.sqlite"):
+            try:
+                month = datetime.datetime.strptime(path.name, self.FILENAME_FORMAT)
+            except ValueError:
+                continue
+            partitions.append((month, path))
+        return sorted(partitions)
+
+    def overlapping(
+        self, start: datetime.datetime, end: datetime.datetime
+    ) -> t.List[pathlib.Path]:
+        start, end = local_time(start), local_time(end)
+        return [
+            path
+            for month, path in self.partitions()
+            if month <= end and next_month(month) > start
+        ]
+
+    def engine(self, path: pathlib.Path) -> sqlalchemy.engine.Engine:
+        with self.lock:
+            engine = self.engines.get(path)
+            if engine is None:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                engine = create_engine(f"sqlite:///{path}", self.pragmas)
+                metadata.create_all(engine)
+                self.engines[path] = engine
+            return engine
+
+    def store_readings(self, rows: t.Iterable[t.Dict[str, t.Any]]) -> None:
+        """Store rows of sensor_name, collected_at and data, with one
+        transaction for each partition."""
+        by_partition: t.Dict[pathlib.Path, t.List[t.Dict[str, t.Any]]] = {}
+        for row in rows:
+            path = self.partition_path(row["collected_at"])
+            by_partition.setdefault(path, []).append(row)
+        for path, partition_rows in by_partition.items():
+            with self.engine(path).begin() as connection:
+                store_readings(connection, partition_rows)
+
+    def store_sensor_data(self, sensor: Sensor[t.Any], data: t.Any) -> None:
+        now = datetime.datetime.now()
+        self.store_readings(
+            [
+                {
+                    "sensor_name": sensor.name,
+                    "collected_at": now,
+                    "data": sensor.to_json_compatible(data),
+                }
+            ]
+        )
+
+    def query_partition(
+        self,
+        path: pathlib.Path,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        sensor_names: t.Optional[t.Sequence[str]],
+    ) -> t.List[t.Tuple[str, datetime.datetime, t.Any]]:
+        query = (
+            sensor_values.select()
+            .where(sensor_values.c.collected_at >= start)
+            .where(sensor_values.c.collected_at <= end)
+            .order_by(sensor_values.c.collected_at, sensor_values.c.id)
+        )
+        if sensor_names is not None:
+            query = query.where(sensor_values.c.sensor_name.in_(sensor_names))
+        with self.engine(path).connect() as connection:
+            return [
+                (row.sensor_name, row.collected_at, row.data)
+                for row in connection.execute(query)
+            ]
+
+    def stored_values(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        sensor_names: t.Optional[t.Sequence[str]] = None,
+    ) -> t.Iterator[t.Tuple[str, datetime.datetime, t.Any]]:
+        """Yield (sensor_name, collected_at, data) tuples in time order."""
+        # Values are stored in naive local time
+        start, end = local_time(start), local_time(end)
+        futures = [
+            self.executor.submit(self.query_partition, path, start, end, sensor_names)
+            for path in self.overlapping(start, end)
+        ]
+        # Partitions cover consecutive months, so the results of each one can
+        # be returned in turn without sorting
+        for future in futures:
+            yield from future.result()
+
+    def latest_values(
+        self, sensor_names: t.Optional[t.Sequence[str]] = None
+    ) -> t.List[StoredValue]:
+        """Return the latest value of each sensor, from the newest partition
+        that has one."""
+        latest: t.Dict[str, StoredValue] = {}
+        for month, path in reversed(self.partitions()):
+            with self.engine(path).connect() as connection:
+                for stored in latest_stored_values(connection, sensor_names):
+                    latest.setdefault(stored[0], stored)
+            if sensor_names is not None and latest.keys() >= set(sensor_names):
+                break
+        return [latest[sensor_name] for sensor_name in sorted(latest)]
+
+    def drop_before(self, before: datetime.datetime) -> t.List[pathlib.Path]:
+        """Delete partitions that only hold values collected before a time"""
+        before = local_time(before)
+        dropped = []
+        for month, path in self.partitions():
+            if next_month(month) > before:
+                break
+            with self.lock:
+                engine = self.engines.pop(path, None)
+            if engine is not None:
+                engine.dispose()
+            path.unlink()
+            # Files left by SQLite in WAL mode
+            for suffix in ("-wal", "-shm"):
+                sidecar = path.with_name(path.name + suffix)
+                if sidecar.exists():
+                    sidecar.unlink()
+            dropped.append(path)
+        return dropped
+
+    def dispose(self) -> None:
+        self.executor.shutdown()
+        with self.lock:
+            engines, self.engines = self.engines, {}
+        for engine in engines.values():
+            engine.dispose()
+
+
+def local_time(value: datetime.datetime) -> datetime.datetime:
+    """Convert a timezone aware datetime to the naive local time that
+    partitions are named for and values are stored in."""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+
+def next_month(month: datetime.datetime) -> datetime.datetime:
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1)
+    return month.replace(month=month.month + 1)
+
+
+RouterKey = t.Tuple[str, t.Tuple[t.Tuple[str, str], ...]]
+routers: t.Dict[RouterKey, PartitionRouter] = {}
+
+
+def get_router(
+    directory: str, pragmas: t.Optional[t.Mapping[str, str]] = None
+) -> PartitionRouter:
+    # Callers with different pragmas need different engines
+    key = (directory, tuple(sorted((pragmas or {}).items())))
+    router = routers.get(key)
+    if router is None:
+        router = routers[key] = PartitionRouter(directory, pragmas=pragmas)
+    return router
@@ -0,0 +1,174 @@
+"""Streaming export of stored values to CSV or JSON lines files."""
+import collections
+import contextlib
+import csv
+import datetime
+import json
+import time
+import typing as t
+
+import sqlalchemy
+
+from .base import Sensor
+from .database import sensor_values
+from .responses import human_readable_many
+
+
+FORMATS = ("csv", "ndjson")
+# strftime formats used to name the file each reading is written to
+PARTITIONS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+DEFAULT_BATCH_SIZE = 1000
+
+Reading = t.Dict[str, t.Any]
+
+
+class ExportStats(t.NamedTuple):
+    rows: int
+    files: int
+    elapsed: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+def stored_values_query(
+    sensor_names: t.Sequence[str] = (),
+    start: t.Optional[datetime.datetime] = None,
+    end: t.Optional[datetime.datetime] = None,
+) -> t.Any:
+    query = sensor_values.select().order_by(
+        sensor_values.c.collected_at, sensor_values.c.id
+    )
+    if sensor_names:
+        query = query.where(sensor_values.c.sensor_name.in_(sensor_names))
+    if start:
+        query = query.where(sensor_values.c.collected_at >= start)
+    if end:
+        query = query.where(sensor_values.c.collected_at <= end)
+    return query
+
+
+def iter_batches(
+    connection: sqlalchemy.engine.Connection, query: t.Any, batch_size: int
+) -> t.Iterator[t.List[t.Any]]:
+    """Yield the results of a query in lists of up to batch_size rows. A
+    server-side cursor is used where the database supports one, so only a
+    single batch is held in memory at a time."""
+    result = connection.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        result.close()
+
+
+def partition_batches(
+    router: t.Any,
+    query: t.Any,
+    batch_size: int,
+    start: t.Optional[datetime.datetime] = None,
+    end: t.Optional[datetime.datetime] = None,
+) -> t.Iterator[t.List[t.Any]]:
+    """Yield the results of a query from each monthly partition that overlaps
+    start to end in turn, so they stay in time order."""
+    paths = router.overlapping(
+        start or datetime.datetime.min, end or datetime.datetime.max
+    )
+    for path in paths:
+        with router.engine(path).connect() as connection:
+            yield from iter_batches(connection, query, batch_size)
+
+
+def to_readings(
+    rows: t.Sequence[t.Any],
+    known_sensors: t.Mapping[str, Sensor[t.Any]],
+    include_human_readable: bool = False,
+) -> t.List[Reading]:
+    readings = [
+        {
+            "id": row.sensor_name,
+            "collected_at": row.collected_at.isoformat(),
+            "value": row.data,
+        }
+        for row in rows
+    ]
+    if include_human_readable:
+        by_sensor: t.Dict[str, t.List[Reading]] = collections.defaultdict(list)
+        for reading in readings:
+            reading["human_readable"] = None
+            by_sensor[reading["id"]].append(reading)
+        # Values of sensors that aren't installed are left unformatted
+        for sensor_name, sensor_readings in by_sensor.items():
+            if sensor_name not in known_sensors:
+                continue
+            formatted = human_readable_many(
+                known_sensors[sensor_name],
+                [reading["value"] for reading in sensor_readings],
+            )
+            for reading, text in zip(sensor_readings, formatted):
+                reading["human_readable"] = text
+    return readings
+
+
+class CSVWriter:
+    def __init__(self, file: t.TextIO, include_human_readable: bool) -> None:
+        fields = ["id", "collected_at", "value"]
+        if include_human_readable:
+            fields.append("human_readable")
+        self.writer = csv.DictWriter(file, fields)
+        self.writer.writeheader()
+
+    def write(self, reading: Reading) -> None:
+        self.writer.writerow({**reading, "value": json.dumps(reading["value"])})
+
+
+class NDJSONWriter:
+    def __init__(self, file: t.TextIO, include_human_readable: bool) -> None:
+        self.file = file
+
+    def write(self, reading: Reading) -> None:
+        self.file.write(json.dumps(reading, separators=(",", ":")) + "\n")
+
+
+WRITERS: t.Dict[str, t.Callable[[t.TextIO, bool], t.Any]] = {
+    "csv": CSVWriter,
+    "ndjson": NDJSONWriter,
+}
+
+
+def export(
+    batches: t.Iterable[t.Sequence[t.Any]],
+    open_output: t.Callable[[t.Optional[str]], t.ContextManager[t.TextIO]],
+    output_format: str,
+    known_sensors: t.Mapping[str, Sensor[t.Any]],
+    partition: t.Optional[str] = None,
+    include_human_readable: bool = False,
+) -> ExportStats:
+    """Write batches of stored values, as from iter_batches. open_output is called with
+    the name of each partition, or None if the output isn't partitioned. As
+    readings are in time order, only one output is open at once."""
+    started = time.perf_counter()
+    rows = files = 0
+    current_partition: t.Optional[str] = None
+    writer = None
+    with contextlib.ExitStack() as outputs:
+        for batch in batches:
+            readings = to_readings(batch, known_sensors, include_human_readable)
+            for row, reading in zip(batch, readings):
+                name = None
+                if partition:
+                    name = row.collected_at.strftime(PARTITIONS[partition])
+                if writer is None or name != current_partition:
+                    # Close the previous partition's output
+                    outputs.close()
+                    file = outputs.enter_context(open_output(name))
+                    writer = WRITERS[output_format](file, include_human_readable)
+                    current_partition = name
+                    files += 1
+                writer.write(reading)
+            rows += len(batch)
+    return ExportStats(rows, files, time.perf_counter() - started)
@@ -0,0 +1,120 @@
+"""Parsing and validation of batches of readings pushed to the ingest API."""
+import datetime
+import json
+import logging
+import time
+import typing as t
+
+from .base import Sensor
+from .exceptions import APDSensorsError
+
+
+logger = logging.getLogger(__name__)
+
+NDJSON_TYPES = {"application/x-ndjson", "application/jsonl"}
+JSON_TYPE = "application/json"
+MSGPACK_TYPES = {"application/msgpack", "application/x-msgpack"}
+# Larger batches should be split by the sender
+MAX_INGEST_SIZE = 16 * 1024 * 1024
+
+
+class IngestError(APDSensorsError, ValueError):
+    """A batch of readings that can't be stored"""
+
+
+def parse(body: bytes, content_type: str) -> t.Iterator[t.Any]:
+    """Yield each reading in a request body of JSON lines, a JSON document or
+    a sequence of MessagePack objects. Arrays of readings are also accepted."""
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type in NDJSON_TYPES:
+        objects: t.Iterable[t.Any] = (
+            parse_json_line(line, number)
+            for number, line in enumerate(body.splitlines(), 1)
+            if line.strip()
+        )
+    elif content_type == JSON_TYPE:
+        try:
+            objects = [json.loads(body)]
+        except ValueError as err:
+            raise IngestError(f"Invalid JSON: {err}") from err
+    elif content_type in MSGPACK_TYPES:
+        try:
+            import msgpack
+        except ImportError:
+            raise IngestError("MessagePack support is not installed")
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(body)
+        objects = unpacker
+    else:
+        raise IngestError(f"Unsupported content type {content_type}")
+    try:
+        for obj in objects:
+            if isinstance(obj, list):
+                yield from obj
+            else:
+                yield obj
+    except ValueError as err:
+        if isinstance(err, IngestError):
+            raise
+        raise IngestError(f"Invalid MessagePack data: {err}") from err
+
+
+def parse_json_line(line: bytes, number: int) -> t.Any:
+    try:
+        return json.loads(line)
+    except ValueError as err:
+        raise IngestError(f"Invalid JSON on line {number}: {err}") from err
+
+
+def to_row(
+    known_sensors: t.Mapping[str, Sensor[t.Any]], reading: t.Any, validate: bool = True
+) -> t.Dict[str, t.Any]:
+    """Validate a reading and convert it to a row of the recorded_values table.
+    Without validation, readings of any sensor are accepted and stored as-is."""
+    if not isinstance(reading, dict) or "id" not in reading or "value" not in reading:
+        raise IngestError("Readings must have an id and a value")
+    sensor_name = reading["id"]
+    data = reading["value"]
+    if validate:
+        sensor = known_sensors.get(sensor_name)
+        if sensor is None:
+            raise IngestError(f"Unknown sensor {sensor_name}")
+        try:
+            data = sensor.to_json_compatible(sensor.from_json_compatible(data))
+        except Exception as err:
+            raise IngestError(f"Invalid value for {sensor_name}") from err
+    if reading.get("collected_at"):
+        import dateutil.parser
+
+        try:
+            collected_at = dateutil.parser.isoparse(reading["collected_at"])
+        except (TypeError, ValueError) as err:
+            raise IngestError(f"Invalid collected_at for {sensor_name}") from err
+        if collected_at.tzinfo is not None:
+            # Stored times are in local time
+            collected_at = collected_at.astimezone().replace(tzinfo=None)
+    else:
+        collected_at = datetime.datetime.now()
+    return {"sensor_name": sensor_name, "collected_at": collected_at, "data": data}
+
+
+def ingest(
+    storage: t.Callable[[t.List[t.Dict[str, t.Any]]], None],
+    known_sensors: t.Mapping[str, Sensor[t.Any]],
+    body: bytes,
+    content_type: str,
+) -> t.Dict[str, t.Any]:
+    """Validate every reading in a request body, then pass them all to
+    storage at once, so nothing is stored if any reading is invalid."""
+    started = time.perf_counter()
+    rows = []
+    for number, reading in enumerate(parse(body, content_type), 1):
+        try:
+            rows.append(to_row(known_sensors, reading))
+        except IngestError as err:
+            raise IngestError(f"Reading {number}: {err}") from err
+    storage(rows)
+    elapsed = time.perf_counter() - started
+    rate = len(rows) / elapsed if elapsed else 0.0
+    logger.info(f"Ingested {len(rows)} readings in {elapsed:.3f}s ({rate:.0f} rows/s)")
+    return {"inserted": len(rows), "rows_per_second": round(rate, 1)}
@@ -0,0 +1,268 @@
+"""A feed of changes to sensor values, shared by all streaming API clients
+in a process. A single background thread reads the sensors (or the shared
+store, if configured) and publishes an event whenever a sensor's value or
+error changes. Clients wait for events after the last one they saw, so the
+cost of reading sensors doesn't depend on the number of clients."""
+import asyncio
+import collections
+import datetime
+import json
+import threading
+import typing as t
+
+from . import metrics, responses, sharedstore
+from .base import Sensor
+
+
+DEFAULT_INTERVAL = 5.0
+DEFAULT_HISTORY = 1000
+# Send a comment at least this often, so proxies don't close idle streams
+KEEPALIVE_INTERVAL = 15.0
+# Each stream served by a WSGI server holds one of its threads until the
+# client disconnects, so only a few are allowed per process
+DEFAULT_MAX_STREAMS = 2
+# Seconds clients are asked to wait before retrying when no streams are free
+STREAM_RETRY_AFTER = 30
+
+
+class Event(t.NamedTuple):
+    id: int
+    sensor_name: str
+    kind: str
+    data: t.Dict[str, t.Any]
+
+    def to_sse(self) -> str:
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {json.dumps(self.data)}\n\n"
+
+
+Reading = t.Tuple[str, t.Dict[str, t.Any], datetime.datetime]
+
+
+class LiveFeed:
+    def __init__(
+        self,
+        sensors: t.Iterable[Sensor[t.Any]],
+        interval: float = DEFAULT_INTERVAL,
+        shared_store: t.Optional[str] = None,
+        history: int = DEFAULT_HISTORY,
+        max_age: t.Optional[float] = None,
+    ) -> None:
+        self.sensors = list(sensors)
+        self.interval = interval
+        self.shared_store = shared_store
+        self.max_age = max_age
+        self.events: t.Deque[Event] = collections.deque(maxlen=history)
+        self.latest: t.Dict[str, Event] = {}
+        self.last_id = 0
+        # The most recent event that has been dropped from the history
+        self.evicted_id = 0
+        self.condition = threading.Condition()
+        self.async_waiters: t.List[
+            t.Tuple[asyncio.AbstractEventLoop, "asyncio.Future[None]"]
+        ] = []
+        self.thread: t.Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="apd.sensors.live", daemon=True
+                )
+                self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+
+    def read(self, sensor: Sensor[t.Any]) -> t.Optional[Reading]:
+        now = datetime.datetime.now()
+        try:
+            try:
+                if self.shared_store:
+                    now, value = sharedstore.read_value(
+                        self.shared_store, sensor, self.max_age
+                    )
+                else:
+                    with metrics.timed_read(sensor.name):
+                        value = sensor.value()
+            except Exception as err:
+                return "error", responses.error_data(sensor, err, now), now
+            return "value", responses.value_data(sensor, value, now), now
+        except NotImplementedError:
+            return None
+
+    def poll(self) -> None:
+        for sensor in self.sensors:
+            reading = self.read(sensor)
+            if reading is None:
+                continue
+            kind, data, collected_at = reading
+            previous = self.latest.get(sensor.name)
+            if previous is not None and previous.kind == kind:
+                # Only the value or error matters, not when it was collected
+                if previous.data[kind] == data[kind]:
+                    continue
+            self.publish(sensor.name, kind, data, collected_at)
+
+    def publish(
+        self,
+        sensor_name: str,
+        kind: str,
+        data: t.Dict[str, t.Any],
+        collected_at: datetime.datetime,
+    ) -> Event:
+        with self.condition:
+            # Event ids are based on the collection time, so they are consistent
+            # between processes that read from the same shared store
+            event_id = max(self.last_id + 1, int(collected_at.timestamp() * 1000000))
+            event = Event(event_id, sensor_name, kind, data)
+            if len(self.events) == self.events.maxlen:
+                self.evicted_id = self.events[0].id
+            self.events.append(event)
+            self.latest[sensor_name] = event
+            self.last_id = event_id
+            self.condition.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+        return event
+
+    def events_after(self, last_id: t.Optional[int]) -> t.List[Event]:
+        """Return the events a client that has seen up to last_id is missing.
+        New clients, and those that have missed events that are no longer
+        held, get the most recent event for each sensor."""
+        with self.condition:
+            if last_id is None or last_id < self.evicted_id:
+                return sorted(
+                    (
+                        event
+                        for event in self.latest.values()
+                        if last_id is None or event.id > last_id
+                    ),
+                    key=lambda event: event.id,
+                )
+            missing: t.List[Event] = []
+            for event in reversed(self.events):
+                if event.id <= last_id:
+                    break
+                missing.append(event)
+            missing.reverse()
+            return missing
+
+    def wait(self, last_id: t.Optional[int], timeout: float) -> t.List[Event]:
+        with self.condition:
+            events = self.events_after(last_id)
+            if not events:
+                self.condition.wait(timeout)
+                events = self.events_after(last_id)
+        return events
+
+    async def wait_async(
+        self, last_id: t.Optional[int], timeout: float
+    ) -> t.List[Event]:
+        loop = asyncio.get_running_loop()
+        with self.condition:
+            events = self.events_after(last_id)
+            if events:
+                return events
+            future = loop.create_future()
+            self.async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with self.condition:
+                if (loop, future) in self.async_waiters:
+                    self.async_waiters.remove((loop, future))
+        return self.events_after(last_id)
+
+
+def wake(future: "asyncio.Future[None]") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+feeds: t.Dict[t.Tuple[t.Optional[str], float, float], LiveFeed] = {}
+feeds_lock = threading.Lock()
+
+
+def get_feed(config: t.Mapping[str, t.Any]) -> LiveFeed:
+    """Return the running feed for this process, starting it if needed."""
+    from .cli import get_sensors
+
+    shared_store = config.get("APD_SENSORS_SHARED_STORE")
+    interval = float(config.get("APD_SENSORS_STREAM_INTERVAL", DEFAULT_INTERVAL))
+    max_age = sharedstore.get_max_age(config)
+    with feeds_lock:
+        feed = feeds.get((shared_store, interval, max_age))
+        if feed is None:
+            feed = feeds[(shared_store, interval, max_age)] = LiveFeed(
+                get_sensors(),
+                interval=interval,
+                shared_store=shared_store,
+                max_age=max_age,
+            )
+    feed.start()
+    return feed
+
+
+stream_slots: t.Dict[int, threading.BoundedSemaphore] = {}
+
+
+def get_stream_slots(config: t.Mapping[str, t.Any]) -> threading.BoundedSemaphore:
+    """Return the semaphore limiting the number of concurrent threaded
+    streams in this process to ``APD_SENSORS_MAX_STREAMS``."""
+    limit = int(config.get("APD_SENSORS_MAX_STREAMS", DEFAULT_MAX_STREAMS))
+    with feeds_lock:
+        slots = stream_slots.get(limit)
+        if slots is None:
+            slots = stream_slots[limit] = threading.BoundedSemaphore(limit)
+    return slots
+
+
+def parse_event_id(value: t.Optional[str]) -> t.Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def stream(
+    feed: LiveFeed,
+    last_id: t.Optional[int],
+    sensor_id: t.Optional[str] = None,
+    keepalive: float = KEEPALIVE_INTERVAL,
+) -> t.Iterator[str]:
+    """Generate the text of a Server-Sent Events stream, forever."""
+    while True:
+        events = feed.wait(last_id, keepalive)
+        if not events:
+            yield ": keep-alive\n\n"
+        for event in events:
+            last_id = event.id
+            if sensor_id is None or event.sensor_name == sensor_id:
+                yield event.to_sse()
+
+
+async def stream_async(
+    feed: LiveFeed,
+    last_id: t.Optional[int],
+    sensor_id: t.Optional[str] = None,
+    keepalive: float = KEEPALIVE_INTERVAL,
+) -> t.AsyncIterator[str]:
+    while True:
+        events = await feed.wait_async(last_id, keepalive)
+        if not events:
+            yield ": keep-alive\n\n"
+        for event in events:
+            last_id = event.id
+            if sensor_id is None or event.sensor_name == sensor_id:
+                yield event.to_sse()
@@ -0,0 +1,261 @@
+"""Counters and latency histograms of sensor reads and database operations,
+exposed in the Prometheus text format at ``/metrics``.
+
+Metrics are held in memory for each process, and recording one takes a lock
+and a few additions, so they are always collected. Prometheus client libraries
+aren't needed, as only counters and histograms with fixed buckets are used.
+
+As metrics belong to a process, each pre-forked worker of an API server
+reports only the requests it handled, and the shared store collector, which
+is the only process reading sensors when it is used, serves its own metrics
+with ``serve_metrics()``.
+"""
+import bisect
+import contextlib
+import http.server
+import logging
+import threading
+import time
+import typing as t
+
+from . import timing
+from .exceptions import IntermittentSensorFailureError, PersistentSensorFailureError
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Sensors range from a few microseconds to several seconds, such as CPULoad
+SENSOR_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0)
+DATABASE_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+Labels = t.Tuple[str, ...]
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: Labels) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values: t.Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values.clear()
+
+    def render(self) -> t.Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(self.label_names, labels)} {value:g}"
+
+
+class Histogram:
+    def __init__(
+        self, name: str, help: str, label_names: Labels, buckets: t.Sequence[float]
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # The count in each bucket, and the last for values above every bucket
+        self.counts: t.Dict[Labels, t.List[int]] = {}
+        self.sums: t.Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            counts[index] += 1
+            self.sums[labels] += value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.counts.clear()
+            self.sums.clear()
+
+    def render(self) -> t.Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = sorted(
+                (labels, list(counts), self.sums[labels])
+                for labels, counts in self.counts.items()
+            )
+        for labels, counts, total in series:
+            cumulative = 0
+            bounds = [f"{bucket:g}" for bucket in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                bucket_labels = format_labels(
+                    self.label_names + ("le",), labels + (bound,)
+                )
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            series_labels = format_labels(self.label_names, labels)
+            yield f"{self.name}_sum{series_labels} {total:g}"
+            yield f"{self.name}_count{series_labels} {cumulative}"
+
+
+def format_labels(names: Labels, values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+sensor_read_seconds = Histogram(
+    "apd_sensor_read_seconds",
+    "Time taken to read the value of a sensor",
+    ("sensor",),
+    SENSOR_BUCKETS,
+)
+sensor_reads = Counter(
+    "apd_sensor_reads_total",
+    "Sensor reads by result: success, intermittent, persistent or unhandled",
+    ("sensor", "result"),
+)
+database_seconds = Histogram(
+    "apd_database_operation_seconds",
+    "Time taken to execute a database statement",
+    ("operation",),
+    DATABASE_BUCKETS,
+)
+database_errors = Counter(
+    "apd_database_errors_total",
+    "Database statements that failed, by the class of error",
+    ("operation", "error"),
+)
+METRICS: t.List[t.Union[Counter, Histogram]] = [
+    sensor_read_seconds,
+    sensor_reads,
+    database_seconds,
+    database_errors,
+]
+
+
+def result(err: BaseException) -> str:
+    if isinstance(err, IntermittentSensorFailureError):
+        return "intermittent"
+    elif isinstance(err, PersistentSensorFailureError):
+        return "persistent"
+    return "unhandled"
+
+
+@contextlib.contextmanager
+def timed_read(sensor_name: str) -> t.Iterator[None]:
+    """Record the time taken and the result of reading a sensor, for use
+    around calls to value() or value_async()."""
+    started = time.perf_counter()
+    try:
+        yield
+    except NotImplementedError:
+        # Not supported on this platform, so there was nothing to read
+        raise
+    except Exception as err:
+        record_read(sensor_name, result(err), time.perf_counter() - started)
+        raise
+    record_read(sensor_name, "success", time.perf_counter() - started)
+
+
+def record_read(sensor_name: str, outcome: str, elapsed: float) -> None:
+    sensor_read_seconds.observe(elapsed, sensor_name)
+    sensor_reads.inc(sensor_name, outcome)
+    timing.record("read", elapsed)
+
+
+def operation(statement: str) -> str:
+    """The kind of a SQL statement, such as SELECT, for labelling metrics"""
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+
+def instrument_engines() -> None:
+    """Time every statement executed by any SQLAlchemy engine. Connections
+    are given the time their current statement started."""
+    import sqlalchemy
+
+    Engine = sqlalchemy.engine.Engine
+    if sqlalchemy.event.contains(Engine, "before_cursor_execute", before_execute):
+        return
+    sqlalchemy.event.listen(Engine, "before_cursor_execute", before_execute)
+    sqlalchemy.event.listen(Engine, "after_cursor_execute", after_execute)
+    sqlalchemy.event.listen(Engine, "handle_error", handle_error)
+
+
+def before_execute(
+    connection: t.Any, cursor: t.Any, statement: str, *args: t.Any
+) -> None:
+    connection.info["apd_sensors_started"] = time.perf_counter()
+
+
+def after_execute(
+    connection: t.Any, cursor: t.Any, statement: str, *args: t.Any
+) -> None:
+    started = connection.info.pop("apd_sensors_started", None)
+    if started is not None:
+        record_statement(operation(statement), time.perf_counter() - started)
+
+
+def handle_error(context: t.Any) -> None:
+    if context.connection is None:
+        # Failed to connect, so there was no statement to time
+        database_errors.inc("CONNECT", type(context.original_exception).__name__)
+        return
+    kind = operation(context.statement or "")
+    database_errors.inc(kind, type(context.original_exception).__name__)
+    started = context.connection.info.pop("apd_sensors_started", None)
+    if started is not None:
+        record_statement(kind, time.perf_counter() - started)
+
+
+def record_statement(kind: str, elapsed: float) -> None:
+    database_seconds.observe(elapsed, kind)
+    timing.record("db", elapsed)
+
+
+def render() -> str:
+    lines = [line for metric in METRICS for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: t.Any) -> None:
+        logger.debug(format, *args)
+
+
+def serve_metrics(host: str, port: int) -> http.server.ThreadingHTTPServer:
+    """Serve the metrics of this process at /metrics from a background
+    thread, for processes that don't serve the API."""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="apd.sensors.metrics", daemon=True
+    )
+    thread.start()
+    return server
@@ -0,0 +1,108 @@
+"""Measurement of the latency, failure rate and memory use of a sensor read
+repeatedly, for ``sensors profile``.
+
+Latencies and allocations are measured in separate passes, as tracing
+allocations slows every call down, and calls can be run under cProfile in a
+third pass to find where the time goes.
+"""
+import collections
+import cProfile
+import math
+import time
+import tracemalloc
+import typing as t
+
+from . import metrics
+from .base import Sensor
+
+
+class SensorProfile(t.NamedTuple):
+    # Seconds taken by each call, in ascending order
+    latencies: t.List[float]
+    # The number of failed calls by result, as in apd_sensor_reads_total
+    failures: t.Dict[str, int]
+    # Peak bytes allocated during each call, and bytes still held afterwards
+    peak_allocated: t.List[int]
+    retained: t.List[int]
+
+    @property
+    def calls(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def failure_rate(self) -> float:
+        return sum(self.failures.values()) / self.calls if self.calls else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """Return a latency percentile, using the nearest rank method"""
+        if not self.latencies:
+            return 0.0
+        rank = math.ceil(percent / 100 * len(self.latencies))
+        return self.latencies[max(rank, 1) - 1]
+
+
+def call(sensor: Sensor[t.Any]) -> t.Optional[str]:
+    """Read the sensor, returning the result if it failed"""
+    try:
+        sensor.value()
+    except NotImplementedError:
+        raise
+    except Exception as err:
+        return metrics.result(err)
+    return None
+
+
+def time_calls(
+    sensor: Sensor[t.Any], calls: int, interval: float = 0.0
+) -> t.Tuple[t.List[float], t.Dict[str, int]]:
+    latencies = []
+    failures: t.Dict[str, int] = collections.Counter()
+    for i in range(calls):
+        if i and interval:
+            time.sleep(interval)
+        started = time.perf_counter()
+        failure = call(sensor)
+        latencies.append(time.perf_counter() - started)
+        if failure is not None:
+            failures[failure] += 1
+    return sorted(latencies), dict(failures)
+
+
+def trace_allocations(
+    sensor: Sensor[t.Any], calls: int, interval: float = 0.0
+) -> t.Tuple[t.List[int], t.List[int]]:
+    peak_allocated = []
+    retained = []
+    for i in range(calls):
+        if i and interval:
+            time.sleep(interval)
+        # Restarting resets the peak, which tracemalloc.reset_peak() can't do
+        # before Python 3.9
+        tracemalloc.start()
+        try:
+            call(sensor)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak_allocated.append(peak)
+        retained.append(current)
+    return peak_allocated, retained
+
+
+def profile_sensor(
+    sensor: Sensor[t.Any], calls: int, memory_calls: int, interval: float = 0.0
+) -> SensorProfile:
+    latencies, failures = time_calls(sensor, calls, interval)
+    peak_allocated, retained = trace_allocations(sensor, memory_calls, interval)
+    return SensorProfile(latencies, failures, peak_allocated, retained)
+
+
+def write_cprofile(
+    sensor: Sensor[t.Any], calls: int, path: str, interval: float = 0.0
+) -> None:
+    profiler = cProfile.Profile()
+    for i in range(calls):
+        if i and interval:
+            time.sleep(interval)
+        profiler.runcall(call, sensor)
+    profiler.dump_stats(path)
@@ -0,0 +1,351 @@
+import collections
+import datetime
+import gzip
+import io
+import json
+import logging
+import threading
+import typing as t
+
+from . import timing
+from .base import HistoricalSensor, Sensor
+from .exceptions import DataCollectionError
+
+
+logger = logging.getLogger(__name__)
+
+# Current values change whenever a sensor is read, so clients must always check
+LIVE_CACHE_CONTROL = "no-cache"
+# The list of sensors and the deployment id only change when reconfigured
+INFO_CACHE_CONTROL = "private, max-age=300"
+DEPLOYMENT_CACHE_CONTROL = "public, max-age=300"
+# Data in a past range only changes if old readings are loaded late
+PAST_RANGE_CACHE_CONTROL = "private, max-age=86400"
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+# Small bodies aren't worth the CPU time to compress
+MIN_COMPRESS_SIZE = 1024
+FORMAT_CACHE_SIZE = 4096
+DEFAULT_CHANGES_LIMIT = 1000
+MAX_CHANGES_LIMIT = 10000
+
+format_cache: "collections.OrderedDict[t.Tuple[t.Any, ...], str]"
+format_cache = collections.OrderedDict()
+format_cache_lock = threading.Lock()
+
+
+def date_range(
+    start: t.Optional[str], end: t.Optional[str]
+) -> t.Tuple[datetime.datetime, datetime.datetime]:
+    import dateutil.parser
+
+    if start:
+        start_dt = dateutil.parser.parse(start)
+    else:
+        start_dt = dateutil.parser.parse("1900-01-01")
+
+    if end:
+        end_dt = dateutil.parser.parse(end)
+    else:
+        end_dt = datetime.datetime.now()
+    return start_dt, end_dt
+
+
+def changes_range(
+    since_id: t.Optional[str], limit: t.Optional[str]
+) -> t.Tuple[int, int]:
+    """Parse the since_id and limit options of the change feed, raising
+    ValueError if they are invalid."""
+    since = int(since_id) if since_id else 0
+    size = int(limit) if limit else DEFAULT_CHANGES_LIMIT
+    if since < 0 or not 0 < size <= MAX_CHANGES_LIMIT:
+        raise ValueError(
+            f"since_id must be positive and limit between 1 and {MAX_CHANGES_LIMIT}"
+        )
+    return since, size
+
+
+# Ids are only unique within a partition, so can't be used as a cursor
+PARTITIONED_CHANGES_ERROR = (
+    "The change feed isn't available when values are stored in monthly partitions"
+)
+
+
+def changes_data(
+    rows: t.Sequence[t.Any], since_id: int, limit: int, deployment_id: str
+) -> t.Dict[str, t.Any]:
+    """Build a batch of the change feed from up to limit + 1 recorded values,
+    the last of which is only used to tell if there are more to fetch."""
+    changes = [
+        {
+            "change_id": row.id,
+            "id": row.sensor_name,
+            "collected_at": row.collected_at.isoformat(),
+            "value": row.data,
+        }
+        for row in rows[:limit]
+    ]
+    return {
+        "deployment_id": deployment_id,
+        "changes": changes,
+        # Clients pass this as since_id to get the next batch
+        "high_water_mark": changes[-1]["change_id"] if changes else since_id,
+        "more": len(rows) > limit,
+    }
+
+
+def range_cache_headers(end: t.Optional[datetime.datetime]) -> t.Dict[str, str]:
+    """Return caching headers for historical data up to end, which is None for
+    ranges that continue to the present. Ranges that are entirely in the past
+    can be cached. There's no Last-Modified header, as values collected in
+    the past can still be stored later, such as by ingest or from a spool, so
+    they are revalidated by ETag."""
+    if end is None or end >= datetime.datetime.now(end.tzinfo):
+        return {"Cache-Control": LIVE_CACHE_CONTROL}
+    return {"Cache-Control": PAST_RANGE_CACHE_CONTROL}
+
+
+def value_data(
+    sensor: Sensor[t.Any], value: t.Any, collected_at: datetime.datetime
+) -> t.Dict[str, t.Any]:
+    return {
+        "id": sensor.name,
+        "title": sensor.title,
+        "value": sensor.to_json_compatible(value),
+        "human_readable": sensor.format(value),
+        "collected_at": collected_at.isoformat(),
+    }
+
+
+def error_data(
+    sensor: Sensor[t.Any], err: Exception, collected_at: datetime.datetime
+) -> t.Dict[str, t.Any]:
+    if isinstance(err, DataCollectionError):
+        # We allow data collection errors
+        message = str(err)
+    else:
+        # Other errors shouldn't be published, but should be logged
+        # Don't refuse to service the request in this case
+        message = "Unhandled error"
+        logger.error(f"Unhandled error while handling {sensor.name}")
+    return {
+        "id": sensor.name,
+        "title": sensor.title,
+        "collected_at": collected_at.isoformat(),
+        "error": message,
+    }
+
+
+def human_readable(sensor: Sensor[t.Any], json_value: t.Any) -> str:
+    """Format a stored value, reusing the result for values that have been
+    formatted recently. Many sensors report the same few values repeatedly."""
+    try:
+        key: t.Tuple[t.Any, ...] = (type(sensor), type(json_value), json_value)
+        hash(key)
+    except TypeError:
+        # Lists and dicts are keyed by their serialisation instead
+        key = (type(sensor), json.dumps(json_value, sort_keys=True))
+    with format_cache_lock:
+        formatted = format_cache.get(key)
+        if formatted is not None:
+            format_cache.move_to_end(key)
+            return formatted
+    formatted = sensor.format(sensor.from_json_compatible(json_value))
+    with format_cache_lock:
+        format_cache[key] = formatted
+        if len(format_cache) > FORMAT_CACHE_SIZE:
+            format_cache.popitem(last=False)
+    return formatted
+
+
+def human_readable_many(
+    sensor: Sensor[t.Any], json_values: t.List[t.Any]
+) -> t.List[str]:
+    """Format many stored values for a sensor, using its batch formatting if it
+    has any, otherwise the cache used by human_readable()."""
+    if sensor.has_batch_formatting():
+        return sensor.format_many(sensor.from_json_compatible_many(json_values))
+    return [human_readable(sensor, json_value) for json_value in json_values]
+
+
+def parse_flag(value: t.Optional[str], default: bool = True) -> bool:
+    if value is None:
+        return default
+    return value.lower() not in {"0", "false", "no", "off"}
+
+
+def stored_value_data(
+    sensor: Sensor[t.Any],
+    json_value: t.Any,
+    collected_at: datetime.datetime,
+    include_human_readable: bool = True,
+) -> t.Dict[str, t.Any]:
+    data = {
+        "id": sensor.name,
+        "title": sensor.title,
+        "value": json_value,
+        "collected_at": collected_at.isoformat(),
+    }
+    if include_human_readable:
+        data["human_readable"] = human_readable(sensor, json_value)
+    return data
+
+
+def historical_data(
+    known_sensors: t.Dict[str, Sensor[t.Any]],
+    stored_values: t.Iterable[t.Tuple[str, datetime.datetime, t.Any]],
+    start: datetime.datetime,
+    end: datetime.datetime,
+    include_human_readable: bool = True,
+) -> t.List[t.Dict[str, t.Any]]:
+    """Build the historical data for a set of sensors from stored
+    (sensor_name, collected_at, json_value) tuples, and from any sensors
+    that provide their own history."""
+    sensors = []
+    by_sensor: t.Dict[str, t.List[t.Dict[str, t.Any]]] = collections.defaultdict(list)
+    with timing.phase("rows"):
+        for sensor_name, collected_at, json_value in stored_values:
+            if sensor_name not in known_sensors:
+                continue
+            sensor = known_sensors[sensor_name]
+            data = stored_value_data(sensor, json_value, collected_at, False)
+            sensors.append(data)
+            by_sensor[sensor_name].append(data)
+        for sensor in known_sensors.values():
+            if isinstance(sensor, HistoricalSensor):
+                for date, json_value in sensor.historical(start, end):
+                    data = stored_value_data(sensor, json_value, date, False)
+                    sensors.append(data)
+                    by_sensor[sensor.name].append(data)
+    if include_human_readable:
+        # Format each sensor's values together, so batch formatting can be used
+        with timing.phase("format"):
+            for sensor_name, readings in by_sensor.items():
+                formatted = human_readable_many(
+                    known_sensors[sensor_name],
+                    [reading["value"] for reading in readings],
+                )
+                for reading, text in zip(readings, formatted):
+                    reading["human_readable"] = text
+    return sensors
+
+
+def latest_data(
+    known_sensors: t.Dict[str, Sensor[t.Any]],
+    stored_values: t.Iterable[t.Tuple[str, datetime.datetime, t.Any]],
+    include_human_readable: bool = True,
+) -> t.List[t.Dict[str, t.Any]]:
+    """Build the data for the latest stored value of each installed sensor"""
+    return [
+        stored_value_data(
+            known_sensors[sensor_name], json_value, collected_at, include_human_readable
+        )
+        for sensor_name, collected_at, json_value in stored_values
+        if sensor_name in known_sensors
+    ]
+
+
+def columns(sensors: t.List[t.Dict[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+    """Convert a list of readings into one entry per sensor, with parallel
+    lists of collection times and values."""
+    by_sensor: t.Dict[str, t.Dict[str, t.Any]] = {}
+    for reading in sensors:
+        sensor = by_sensor.get(reading["id"])
+        if sensor is None:
+            sensor = by_sensor[reading["id"]] = {
+                "id": reading["id"],
+                "title": reading["title"],
+                "collected_at": [],
+                "value": [],
+            }
+        sensor["collected_at"].append(reading["collected_at"])
+        sensor["value"].append(reading["value"])
+    return list(by_sensor.values())
+
+
+def parse_accept(header: str) -> t.Dict[str, float]:
+    """Parse an Accept or Accept-Encoding header into a map of each
+    acceptable value to its quality."""
+    accepted = {}
+    for item in header.split(","):
+        value, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, param_value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        if value:
+            accepted[value.lower()] = quality
+    return accepted
+
+
+def preferred(header: t.Optional[str], offered: t.Sequence[str]) -> t.Optional[str]:
+    """Return the offered value the client prefers, if any is acceptable.
+    Ties go to the value offered first."""
+    if not header:
+        return offered[0]
+    accepted = parse_accept(header)
+    best, best_quality = None, 0.0
+    for offer in offered:
+        major = offer.split("/")[0]
+        for candidate in (offer, f"{major}/*", "*/*", "*"):
+            if candidate in accepted:
+                if accepted[candidate] > best_quality:
+                    best, best_quality = offer, accepted[candidate]
+                break
+    return best
+
+
+def serialise(data: t.Any, content_type: str) -> bytes:
+    if content_type == MSGPACK:
+        import msgpack
+
+        return t.cast(bytes, msgpack.packb(data, use_bin_type=True))
+    # Serialised the same way as Flask, so responses match the WSGI API
+    serialised = json.dumps(data, sort_keys=True, separators=(",", ":")) + "\n"
+    return serialised.encode("utf-8")
+
+
+def compress(body: bytes) -> bytes:
+    # Without a fixed mtime the same data would compress to different bytes,
+    # and so have a different ETag, every second
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6, mtime=0) as f:
+        f.write(body)
+    return buffer.getvalue()
+
+
+def content_types() -> t.List[str]:
+    try:
+        import msgpack  # noqa: F401
+    except ImportError:
+        return [JSON]
+    return [JSON, MSGPACK, "application/x-msgpack"]
+
+
+def encode(
+    data: t.Dict[str, t.Any],
+    accept: t.Optional[str],
+    accept_encoding: t.Optional[str],
+    layout: t.Optional[str] = None,
+) -> t.Tuple[bytes, t.Dict[str, str]]:
+    """Encode historical data in the layout, format and compression the client
+    asked for, returning the body and the headers that describe it. Clients
+    that don't ask for anything get uncompressed rows of JSON."""
+    if layout == "columns":
+        data = {**data, "sensors": columns(data["sensors"])}
+    # Clients that accept none of the formats get JSON, as before
+    content_type = preferred(accept, content_types()) or JSON
+    if content_type != JSON:
+        content_type = MSGPACK
+    body = serialise(data, content_type)
+    headers = {"Content-Type": content_type, "Vary": "Accept, Accept-Encoding"}
+    if len(body) >= MIN_COMPRESS_SIZE and accept_encoding:
+        if preferred(accept_encoding, ["gzip"]) == "gzip":
+            body = compress(body)
+            headers["Content-Encoding"] = "gzip"
+    return body, headers
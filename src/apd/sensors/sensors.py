@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # coding: utf-8
+import functools
 import math
 import os
 import socket
 import sys
+import threading
 import typing as t
 
 import psutil
@@ -18,6 +20,15 @@ from .exceptions import (
 
 
 dht_sensor = None
+# The DHT is read by bit-banging a single GPIO pin, so only one thread may
+# set it up or read it at a time. Reentrant, as reads also set it up.
+dht_lock = threading.RLock()
+
+
+@functools.lru_cache(maxsize=32)
+def parse_unit(unit: str) -> t.Any:
+    # Parsing unit names is slow, and stored values use very few distinct units
+    return ureg[unit]
 
 
 class PythonVersion(JSONSensor[version_info_type]):
@@ -75,6 +86,15 @@ class CPULoad(JSONSensor[float]):
     def format(cls, value: float) -> str:
         return "{:.1%}".format(value)
 
+    @classmethod
+    def format_many(cls, values: t.Sequence[float]) -> t.List[str]:
+        try:
+            import numpy
+        except ImportError:
+            return super().format_many(values)
+        percentages = numpy.asarray(values, dtype=float) * 100
+        return t.cast(t.List[str], numpy.char.mod("%.1f%%", percentages).tolist())
+
 
 class RAMAvailable(JSONSensor[int]):
     name = "RAMAvailable"
@@ -87,12 +107,36 @@ class RAMAvailable(JSONSensor[int]):
 
     @classmethod
     def format(cls, value: int) -> str:
-        magnitude = math.floor(math.log(value, cls.UNIT_SIZE))
+        if value == 0:
+            # log(0) is undefined, but zero is zero bytes
+            magnitude = 0
+        else:
+            magnitude = math.floor(math.log(value, cls.UNIT_SIZE))
         max_magnitude = len(cls.UNITS) - 1
         magnitude = min(magnitude, max_magnitude)
         scaled_value = value / (cls.UNIT_SIZE ** magnitude)
         return "{:.1f} {}".format(scaled_value, cls.UNITS[magnitude])
 
+    @classmethod
+    def format_many(cls, values: t.Sequence[int]) -> t.List[str]:
+        if not len(values):
+            # numpy.char.add can't combine empty arrays of different types
+            return []
+        try:
+            import numpy
+        except ImportError:
+            return super().format_many(values)
+        sizes = numpy.asarray(values, dtype=float)
+        # The exponent from frexp is the bit length, which gives the magnitude
+        # exactly, where log() can be out by one at powers of UNIT_SIZE
+        bits = numpy.frexp(sizes)[1]
+        magnitudes = numpy.clip((bits - 1) // 10, 0, len(cls.UNITS) - 1)
+        scaled = sizes / numpy.power(float(cls.UNIT_SIZE), magnitudes)
+        formatted = numpy.char.add(
+            numpy.char.mod("%.1f ", scaled), numpy.array(cls.UNITS)[magnitudes]
+        )
+        return t.cast(t.List[str], formatted.tolist())
+
 
 class ACStatus(JSONSensor[bool]):
     name = "ACStatus"
@@ -125,22 +169,29 @@ class DHTSensor:
     @property
     def sensor(self) -> t.Any:
         global dht_sensor
-        if dht_sensor is None:
-            try:
-                import adafruit_dht
-                import board
-
-                sensor_type = getattr(adafruit_dht, self.board)
-                pin = getattr(board, self.pin)
-                dht_sensor = sensor_type(pin)
-            except (ImportError, NotImplementedError, AttributeError) as err:
-                # No DHT library results in an ImportError.
-                # Running on an unknown platform results in a
-                # NotImplementedError when getting the pin
-                raise PersistentSensorFailureError(
-                    "Unable to initialise sensor interface"
-                ) from err
-        return dht_sensor
+        with dht_lock:
+            if dht_sensor is None:
+                try:
+                    import adafruit_dht
+                    import board
+
+                    sensor_type = getattr(adafruit_dht, self.board)
+                    pin = getattr(board, self.pin)
+                    dht_sensor = sensor_type(pin)
+                except (ImportError, NotImplementedError, AttributeError) as err:
+                    # No DHT library results in an ImportError.
+                    # Running on an unknown platform results in a
+                    # NotImplementedError when getting the pin
+                    raise PersistentSensorFailureError(
+                        "Unable to initialise sensor interface"
+                    ) from err
+            return dht_sensor
+
+    def read(self, attribute: str) -> t.Any:
+        """Read the temperature or humidity, waiting for any other thread
+        reading the DHT to finish."""
+        with dht_lock:
+            return getattr(self.sensor, attribute)
 
 
 class Temperature(Sensor[t.Any], DHTSensor):
@@ -149,7 +200,7 @@ class Temperature(Sensor[t.Any], DHTSensor):
 
     def value(self) -> t.Any:
         try:
-            return ureg.Quantity(self.sensor.temperature, ureg.celsius)
+            return ureg.Quantity(self.read("temperature"), ureg.celsius)
         except DataCollectionError:
             # This is one of our own exceptions, we don't need to re-wrap it
             raise
@@ -168,7 +219,40 @@ class Temperature(Sensor[t.Any], DHTSensor):
 
     @classmethod
     def from_json_compatible(cls, json_version: t.Any) -> t.Any:
-        return ureg.Quantity(json_version["magnitude"], ureg[json_version["unit"]])
+        unit = parse_unit(json_version["unit"])
+        return ureg.Quantity(json_version["magnitude"], unit)
+
+    @classmethod
+    def from_json_compatible_many(cls, json_versions: t.Sequence[t.Any]) -> t.Any:
+        units = {json_version["unit"] for json_version in json_versions}
+        try:
+            import numpy
+        except ImportError:
+            return super().from_json_compatible_many(json_versions)
+        if len(units) != 1:
+            return super().from_json_compatible_many(json_versions)
+        magnitudes = numpy.array(
+            [json_version["magnitude"] for json_version in json_versions], dtype=float
+        )
+        return ureg.Quantity(magnitudes, parse_unit(units.pop()))
+
+    @classmethod
+    def format_many(cls, values: t.Any) -> t.List[str]:
+        if not isinstance(values, ureg.Quantity):
+            # Individual values, which may have different units
+            return super().format_many(values)
+        fahrenheit = values.to(ureg.fahrenheit).magnitude
+        units = "{:~P}".format(values.units)
+        formatted = []
+        for magnitude, converted in zip(values.magnitude, fahrenheit):
+            magnitude_str = format(magnitude, ".3")
+            converted_str = format(converted, ".3")
+            if "e" in magnitude_str or "e" in converted_str:
+                # Leave exponent formatting to pint
+                formatted.append(cls.format(ureg.Quantity(magnitude, values.units)))
+            else:
+                formatted.append(f"{magnitude_str} {units} ({converted_str} °F)")
+        return formatted
 
     def __str__(self) -> str:
         return self.format(self.value())
@@ -180,7 +264,7 @@ class RelativeHumidity(JSONSensor[float], DHTSensor):
 
     def value(self) -> float:
         try:
-            return float(self.sensor.humidity)
+            return float(self.read("humidity"))
         except DataCollectionError:
             # This is one of our own exceptions, we don't need to re-wrap it
             raise
@@ -190,3 +274,12 @@ class RelativeHumidity(JSONSensor[float], DHTSensor):
     @classmethod
     def format(cls, value: float) -> str:
         return "{:.1%}".format(value / 100.0)
+
+    @classmethod
+    def format_many(cls, values: t.Sequence[float]) -> t.List[str]:
+        try:
+            import numpy
+        except ImportError:
+            return super().format_many(values)
+        percentages = numpy.asarray(values, dtype=float) / 100.0 * 100
+        return t.cast(t.List[str], numpy.char.mod("%.1f%%", percentages).tolist())
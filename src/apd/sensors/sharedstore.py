@@ -0,0 +1,388 @@
+"""A latest-value store for sensor readings, held in a memory-mapped file.
+
+One collector process writes the most recent reading of each sensor into
+a fixed-size slot. Any number of reader processes (such as the workers of
+a prefork WSGI server) can then serve those readings without touching the
+sensors themselves.
+
+The file starts with a header, followed by ``slot_count`` slots of
+``slot_size`` bytes each. Every slot starts with a sequence number, which
+the writer makes odd while the slot is being changed and even once it is
+consistent again. Readers retry if the sequence number is odd or changes
+while they copy the slot, so they never see a partially written record.
+
+A collector started with a different layout replaces the file, and readers
+map the new file when they next read. Readings older than the maximum age
+are treated as missing, as the collector has most likely stopped.
+"""
+import datetime
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import typing as t
+
+import click
+
+from . import metrics
+from .base import Sensor
+from .exceptions import (
+    DataCollectionError,
+    IntermittentSensorFailureError,
+    PersistentSensorFailureError,
+)
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"APDS"
+LAYOUT_VERSION = 1
+# magic, layout version, slot count, slot size
+HEADER = struct.Struct("<4sHHI")
+HEADER_SIZE = 64
+# sequence, collected_at timestamp, status, payload length, sensor name
+SLOT_HEADER = struct.Struct("<QdB3xI64s")
+SEQUENCE = struct.Struct("<Q")
+PAYLOAD_OFFSET = SLOT_HEADER.size
+
+STATUS_EMPTY = 0
+STATUS_VALUE = 1
+STATUS_ERROR = 2
+
+READ_ATTEMPTS = 100
+# Seconds after which a reading is too old to serve
+DEFAULT_MAX_AGE = 60.0
+
+
+class StoredReading(t.NamedTuple):
+    name: str
+    collected_at: datetime.datetime
+    value: t.Any
+    error: t.Optional[str]
+
+
+class SharedValueStore:
+    def __init__(
+        self,
+        path: str,
+        writable: bool = False,
+        slot_count: int = 64,
+        slot_size: int = 1024,
+    ) -> None:
+        self.path = path
+        self.writable = writable
+        self._slots: t.Dict[str, int] = {}
+        # The device and inode of the mapped file
+        self._file_id = (0, 0)
+        if writable:
+            self._map = self._open_for_writing(slot_count, slot_size)
+        else:
+            self._map = self._open_for_reading()
+        _, _, self.slot_count, self.slot_size = HEADER.unpack_from(self._map, 0)
+        self.payload_size = self.slot_size - SLOT_HEADER.size
+        self._index_slots()
+
+    def _open_for_writing(self, slot_count: int, slot_size: int) -> mmap.mmap:
+        if slot_size <= SLOT_HEADER.size:
+            raise ValueError(f"slot_size must be larger than {SLOT_HEADER.size}")
+        expected_header = HEADER.pack(MAGIC, LAYOUT_VERSION, slot_count, slot_size)
+        size = HEADER_SIZE + slot_count * slot_size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.pread(fd, HEADER.size, 0) != expected_header or (
+            os.fstat(fd).st_size != size
+        ):
+            # Either a new file or one with a different layout. Build a new
+            # file and move it into place, as truncating a file that readers
+            # have mapped would crash them.
+            os.close(fd)
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            fd = os.open(temporary_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.ftruncate(fd, size)
+            os.pwrite(fd, expected_header, 0)
+            os.replace(temporary_path, self.path)
+        try:
+            self._file_id = file_id(os.fstat(fd))
+            return mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+    def _open_for_reading(self) -> mmap.mmap:
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError as err:
+            raise PersistentSensorFailureError(
+                f"Shared store {self.path} is not available"
+            ) from err
+        try:
+            stat = os.fstat(fd)
+            if stat.st_size < HEADER_SIZE:
+                raise PersistentSensorFailureError(
+                    f"Shared store {self.path} has not been initialised"
+                )
+            self._file_id = file_id(stat)
+            store_map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version, slot_count, slot_size = HEADER.unpack_from(store_map, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            store_map.close()
+            raise PersistentSensorFailureError(
+                f"{self.path} is not a version {LAYOUT_VERSION} shared store"
+            )
+        if len(store_map) < HEADER_SIZE + slot_count * slot_size:
+            store_map.close()
+            raise PersistentSensorFailureError(f"Shared store {self.path} is truncated")
+        return store_map
+
+    def _slot_offset(self, index: int) -> int:
+        return HEADER_SIZE + index * self.slot_size
+
+    def _index_slots(self) -> None:
+        self._slots = {}
+        for index in range(self.slot_count):
+            raw = self._read_slot(index)
+            if raw is None:
+                continue
+            status, name = raw[2], raw[4]
+            if status != STATUS_EMPTY:
+                self._slots[name] = index
+
+    def _read_slot(
+        self, index: int
+    ) -> t.Optional[t.Tuple[int, float, int, bytes, str]]:
+        offset = self._slot_offset(index)
+        for _ in range(READ_ATTEMPTS):
+            before = SEQUENCE.unpack_from(self._map, offset)[0]
+            if before % 2:
+                # The writer is part way through updating this slot
+                time.sleep(0)
+                continue
+            end = offset + self.slot_size
+            raw = self._map[offset:end]
+            after = SEQUENCE.unpack_from(self._map, offset)[0]
+            if before != after:
+                continue
+            sequence, collected_at, status, length, name = SLOT_HEADER.unpack_from(
+                raw, 0
+            )
+            payload_end = PAYLOAD_OFFSET + length
+            payload = raw[PAYLOAD_OFFSET:payload_end]
+            return (
+                sequence,
+                collected_at,
+                status,
+                payload,
+                name.rstrip(b"\0").decode("utf-8"),
+            )
+        return None
+
+    def _write_slot(
+        self, name: str, status: int, payload: bytes, collected_at: datetime.datetime
+    ) -> None:
+        if not self.writable:
+            raise ValueError("Shared store was opened read-only")
+        encoded_name = name.encode("utf-8")
+        if len(encoded_name) > 64:
+            raise ValueError(f"Sensor name {name} is too long for the shared store")
+        index = self._slots.get(name)
+        if index is None:
+            if len(self._slots) >= self.slot_count:
+                raise ValueError("No free slots remain in the shared store")
+            index = len(self._slots)
+            self._slots[name] = index
+        offset = self._slot_offset(index)
+        sequence = SEQUENCE.unpack_from(self._map, offset)[0]
+        if sequence % 2:
+            # A previous writer was interrupted part way through this slot
+            sequence += 1
+        # Mark the slot as being written, then write it, then mark it as consistent
+        SEQUENCE.pack_into(self._map, offset, sequence + 1)
+        SLOT_HEADER.pack_into(
+            self._map,
+            offset,
+            sequence + 1,
+            collected_at.timestamp(),
+            status,
+            len(payload),
+            encoded_name,
+        )
+        start = offset + PAYLOAD_OFFSET
+        end = start + len(payload)
+        self._map[start:end] = payload
+        SEQUENCE.pack_into(self._map, offset, sequence + 2)
+
+    def write_value(
+        self,
+        sensor: Sensor[t.Any],
+        value: t.Any,
+        collected_at: t.Optional[datetime.datetime] = None,
+    ) -> None:
+        if collected_at is None:
+            collected_at = datetime.datetime.now()
+        payload = json.dumps(sensor.to_json_compatible(value)).encode("utf-8")
+        if len(payload) > self.payload_size:
+            self.write_error(sensor, "Value too large for shared store", collected_at)
+            return
+        self._write_slot(sensor.name, STATUS_VALUE, payload, collected_at)
+
+    def write_error(
+        self,
+        sensor: Sensor[t.Any],
+        message: str,
+        collected_at: t.Optional[datetime.datetime] = None,
+    ) -> None:
+        if collected_at is None:
+            collected_at = datetime.datetime.now()
+        payload = message.encode("utf-8")[: self.payload_size]
+        self._write_slot(sensor.name, STATUS_ERROR, payload, collected_at)
+
+    def read(self, name: str) -> t.Optional[StoredReading]:
+        index = self._slots.get(name)
+        if index is None:
+            # The collector may have started writing this sensor since we looked
+            self._index_slots()
+            index = self._slots.get(name)
+            if index is None:
+                return None
+        raw = self._read_slot(index)
+        if raw is None:
+            raise IntermittentSensorFailureError(
+                f"Shared store slot for {name} is being updated"
+            )
+        _, timestamp, status, payload, slot_name = raw
+        if slot_name != name:
+            # The store was reinitialised by the collector, find the slot again
+            self._slots = {}
+            return self.read(name)
+        collected_at = datetime.datetime.fromtimestamp(timestamp)
+        if status == STATUS_ERROR:
+            return StoredReading(name, collected_at, None, payload.decode("utf-8"))
+        return StoredReading(name, collected_at, json.loads(payload), None)
+
+    def read_all(self) -> t.Dict[str, StoredReading]:
+        self._index_slots()
+        readings = {}
+        for name in self._slots:
+            reading = self.read(name)
+            if reading is not None:
+                readings[name] = reading
+        return readings
+
+    def is_replaced(self) -> bool:
+        """Whether the collector has replaced the file since it was mapped."""
+        try:
+            return file_id(os.stat(self.path)) != self._file_id
+        except OSError:
+            # Keep serving the mapped file, its readings will soon be too old
+            return False
+
+    def close(self) -> None:
+        self._map.close()
+
+
+def file_id(stat: os.stat_result) -> t.Tuple[int, int]:
+    return stat.st_dev, stat.st_ino
+
+
+readers: t.Dict[str, SharedValueStore] = {}
+
+
+def get_reader(path: str) -> SharedValueStore:
+    reader = readers.get(path)
+    if reader is None or reader.is_replaced():
+        # A replaced reader isn't closed, as other threads may be reading
+        # from it. Its file is unmapped once they are done with it.
+        reader = readers[path] = SharedValueStore(path)
+    return reader
+
+
+def get_max_age(config: t.Mapping[str, t.Any]) -> float:
+    return float(config.get("APD_SENSORS_SHARED_STORE_MAX_AGE", DEFAULT_MAX_AGE))
+
+
+def read_value(
+    path: str, sensor: Sensor[t.Any], max_age: t.Optional[float] = None
+) -> t.Tuple[datetime.datetime, t.Any]:
+    """Return the time a sensor was last read by the collector and its value,
+    or raise a DataCollectionError explaining why that isn't possible.
+    Readings more than max_age seconds old are treated as missing."""
+    reading = get_reader(path).read(sensor.name)
+    if reading is None:
+        raise PersistentSensorFailureError("No value available in shared store")
+    if max_age is not None:
+        age = (datetime.datetime.now() - reading.collected_at).total_seconds()
+        if age > max_age:
+            raise PersistentSensorFailureError(
+                f"No value available in shared store since {reading.collected_at}"
+            )
+    if reading.error is not None:
+        raise IntermittentSensorFailureError(reading.error)
+    return reading.collected_at, sensor.from_json_compatible(reading.value)
+
+
+def collect(store: SharedValueStore, sensors: t.Iterable[Sensor[t.Any]]) -> None:
+    for sensor in sensors:
+        now = datetime.datetime.now()
+        try:
+            with metrics.timed_read(sensor.name):
+                value = sensor.value()
+        except DataCollectionError as err:
+            store.write_error(sensor, str(err), now)
+        except Exception:
+            logger.exception(f"Unhandled error while handling {sensor.name}")
+            store.write_error(sensor, "Unhandled error", now)
+        else:
+            store.write_value(sensor, value, now)
+
+
+@click.command(help="Collects sensor values into a shared memory store")
+@click.option(
+    "--path",
+    metavar="<PATH>",
+    required=True,
+    help="The file to use for the store, ideally on a tmpfs such as /dev/shm",
+    envvar="APD_SENSORS_SHARED_STORE",
+)
+@click.option(
+    "--interval",
+    type=float,
+    default=10.0,
+    help="Seconds to wait between collection runs",
+    envvar="APD_SENSORS_COLLECT_INTERVAL",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    help="Serve the collector's metrics at /metrics on this port",
+    envvar="APD_SENSORS_COLLECTOR_METRICS_PORT",
+)
+@click.option(
+    "--metrics-host",
+    default="",
+    help="The address to serve metrics on, by default every interface",
+    envvar="APD_SENSORS_COLLECTOR_METRICS_HOST",
+)
+def run_collector(
+    path: str, interval: float, metrics_port: t.Optional[int], metrics_host: str
+) -> None:
+    from .cli import get_sensors
+
+    sensors = get_sensors()
+    if metrics_port is not None:
+        # API workers serving from the store never read the sensors, so the
+        # read metrics are only available from the collector
+        metrics.serve_metrics(metrics_host, metrics_port)
+    store = SharedValueStore(path, writable=True)
+    try:
+        while True:
+            started = time.monotonic()
+            collect(store, sensors)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    run_collector()
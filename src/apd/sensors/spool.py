@@ -0,0 +1,178 @@
+"""A local, append-only file of readings that couldn't be stored, such as when
+an SQLite database is locked or a database server is unreachable.
+
+Readings are written as JSON lines, in the format used by ``sensors export``
+and the ingest API. Writes are made durable with ``fsync``, once per
+``sync_every`` readings rather than for each one. Draining stores the
+readings in batches, recording the offset of the last stored batch in a
+``.offset`` file next to the spool, so a drain that fails part way through
+continues from that batch. Once everything has been drained the spool is
+emptied. Appending and draining hold a lock on a ``.lock`` file next to
+the spool, so several processes, such as pre-forked API workers and
+``sensors --save``, can share one.
+"""
+import datetime
+import json
+import os
+import pathlib
+import typing as t
+
+from .exceptions import APDSensorsError
+from .ingest import to_row
+from .utils import file_lock
+
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_SYNC_EVERY = 100
+DEFAULT_BATCH_SIZE = 1000
+CHUNK_SIZE = 1024 * 1024
+
+Row = t.Dict[str, t.Any]
+Storage = t.Callable[[t.List[Row]], None]
+
+
+class SpoolFullError(APDSensorsError):
+    """Readings that can't be spooled, as the spool has reached its size limit"""
+
+
+class Backlog(t.NamedTuple):
+    readings: int
+    size: int
+
+
+class Spool:
+    def __init__(
+        self,
+        path: t.Union[str, os.PathLike],
+        max_size: int = DEFAULT_MAX_SIZE,
+        sync_every: int = DEFAULT_SYNC_EVERY,
+    ) -> None:
+        self.path = pathlib.Path(path)
+        self.offset_path = self.path.with_name(self.path.name + ".offset")
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.max_size = max_size
+        self.sync_every = sync_every
+        self._fd: t.Optional[int] = None
+        self._unsynced = 0
+
+    def _open(self) -> int:
+        if self._fd is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+            # Discard a partial line left by a crash during a write
+            size = os.fstat(fd).st_size
+            if size:
+                with open(self.path, "rb") as spool_file:
+                    spool_file.seek(max(size - CHUNK_SIZE, 0))
+                    tail = spool_file.read()
+                if not tail.endswith(b"\n"):
+                    os.ftruncate(fd, size - len(tail) + tail.rfind(b"\n") + 1)
+            self._fd = fd
+        return self._fd
+
+    def append(self, rows: t.Sequence[Row]) -> None:
+        """Add rows of the recorded_values table to the spool. Either all of
+        them are added or, if the spool would be too large, none are."""
+        data = b"".join(
+            json.dumps(
+                {
+                    "id": row["sensor_name"],
+                    "collected_at": row["collected_at"].isoformat(),
+                    "value": row["data"],
+                },
+                separators=(",", ":"),
+            ).encode("utf-8")
+            + b"\n"
+            for row in rows
+        )
+        with file_lock(self.lock_path):
+            fd = self._open()
+            if os.fstat(fd).st_size + len(data) > self.max_size:
+                raise SpoolFullError(
+                    f"Spool {self.path} is full, {len(rows)} readings were lost"
+                )
+            os.write(fd, data)
+        self._unsynced += len(rows)
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        if self._fd is not None and self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+
+    def close(self) -> None:
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+    def read_offset(self) -> int:
+        try:
+            return int(self.offset_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_offset(self, offset: int) -> None:
+        temporary_path = self.offset_path.with_name(self.offset_path.name + ".tmp")
+        with open(temporary_path, "w") as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(temporary_path, self.offset_path)
+
+    def backlog(self) -> Backlog:
+        """Return the number and size of the readings waiting to be stored"""
+        if not self.path.exists():
+            return Backlog(0, 0)
+        offset = self.read_offset()
+        readings = 0
+        with open(self.path, "rb") as spool_file:
+            spool_file.seek(offset)
+            for chunk in iter(lambda: spool_file.read(CHUNK_SIZE), b""):
+                readings += chunk.count(b"\n")
+            size = spool_file.tell() - offset
+        return Backlog(readings, size)
+
+    def oldest(self) -> t.Optional[datetime.datetime]:
+        """Return the collection time of the first reading waiting to be stored"""
+        for batch in self.batches(1):
+            return t.cast(datetime.datetime, batch[0][0]["collected_at"])
+        return None
+
+    def batches(self, batch_size: int) -> t.Iterator[t.Tuple[t.List[Row], int]]:
+        """Yield lists of up to batch_size rows after the stored offset, with
+        the offset after each batch."""
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as spool_file:
+            spool_file.seek(self.read_offset())
+            rows: t.List[Row] = []
+            for line in spool_file:
+                if not line.endswith(b"\n"):
+                    # Still being written
+                    break
+                if line.strip():
+                    rows.append(to_row({}, json.loads(line), validate=False))
+                if len(rows) >= batch_size:
+                    yield rows, spool_file.tell()
+                    rows = []
+            if rows:
+                yield rows, spool_file.tell()
+
+    def drain(self, storage: Storage, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+        """Store the spooled readings in batches, and empty the spool if all
+        of them were stored. Exceptions from storage are raised, after
+        recording which batches were stored. Returns the number stored."""
+        self.sync()
+        drained = 0
+        # Held throughout, so readings aren't stored twice by concurrent drains
+        # or appended between the last batch and emptying the spool
+        with file_lock(self.lock_path):
+            for rows, offset in self.batches(batch_size):
+                storage(rows)
+                self.write_offset(offset)
+                drained += len(rows)
+            if drained and self.read_offset() >= self.path.stat().st_size:
+                os.truncate(self.path, 0)
+                self.offset_path.unlink()
+        return drained
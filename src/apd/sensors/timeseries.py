@@ -0,0 +1,395 @@
+"""An append-only store for numeric sensor readings, as an alternative to
+the SQL database for saving and querying historical values.
+
+Each sensor has a directory of segment files. A segment starts with a
+header giving the type of its values, and the unit of quantities such as
+temperatures, followed by fixed-width records of a timestamp and a value, in
+timestamp order. Quantities are stored as their magnitude, and read back in
+the ``{"magnitude", "unit"}`` form of ``to_json_compatible()``. Readings are
+only ever appended, and a new segment is started when the current one is
+full, when the type or unit of value changes, or when a reading is older than
+the last one (such as when the clocks go back), so each segment stays sorted.
+
+Segments are read through ``mmap`` and the records in a time range are
+found by binary search, without reading the rest of the file. Only the
+newest segment of a sensor is appended to, so the time range of the others
+is remembered and segments outside the range of a query aren't read. A
+writer only appends whole records, so readers in other processes ignore any
+trailing partial record. Writers hold a lock on the store's ``.lock`` file
+while appending, so several processes can write to the same store.
+"""
+import bisect
+import datetime
+import heapq
+import mmap
+import os
+import pathlib
+import struct
+import typing as t
+
+from .exceptions import APDSensorsError
+from .utils import file_lock
+
+
+MAGIC = b"APDT"
+LAYOUT_VERSION = 2
+UNIT_SIZE = 48
+# magic, layout version, value type, unit (empty for plain numbers)
+HEADER = struct.Struct(f"<4sHc{UNIT_SIZE}s")
+HEADER_SIZE = 64
+TIMESTAMP = struct.Struct("<d")
+# Record formats for each type of value, timestamp first
+RECORDS = {
+    b"?": struct.Struct("<d?"),
+    b"q": struct.Struct("<dq"),
+    b"d": struct.Struct("<dd"),
+}
+SEGMENT_SUFFIX = ".seg"
+# Not a valid sensor name, so never mistaken for a sensor's directory
+LOCK_NAME = ".lock"
+DEFAULT_SEGMENT_RECORDS = 2 ** 20
+
+INT_RANGE = range(-(2 ** 63), 2 ** 63)
+
+Number = t.Union[bool, int, float]
+# A number, or a quantity as returned by to_json_compatible()
+Value = t.Union[Number, t.Dict[str, t.Any]]
+StoredValue = t.Tuple[str, datetime.datetime, Value]
+
+
+class UnsupportedValueError(APDSensorsError, TypeError):
+    """A value that can't be stored in a time series, as it isn't a number"""
+
+
+def value_type(value: t.Any) -> bytes:
+    # bool is a subclass of int, so must be checked first
+    if isinstance(value, bool):
+        return b"?"
+    if isinstance(value, int):
+        if value not in INT_RANGE:
+            raise UnsupportedValueError(f"{value} doesn't fit in 64 bits")
+        return b"q"
+    if isinstance(value, float):
+        return b"d"
+    raise UnsupportedValueError("the value isn't a number")
+
+
+def split_value(value: t.Any) -> t.Tuple[Number, str]:
+    """Return the number to store for a value, and its unit if it's a quantity"""
+    if (
+        isinstance(value, dict)
+        and value.keys() == {"magnitude", "unit"}
+        and isinstance(value["unit"], str)
+    ):
+        if len(value["unit"].encode("utf-8")) > UNIT_SIZE:
+            raise UnsupportedValueError(f"the unit {value['unit']} is too long")
+        return value["magnitude"], value["unit"]
+    return value, ""
+
+
+class Timestamps:
+    """The timestamps of a segment's records, as a sequence for bisect"""
+
+    def __init__(self, segment_map: mmap.mmap, record_size: int, count: int):
+        self.map = segment_map
+        self.record_size = record_size
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> float:
+        if index < 0:
+            index += self.count
+        offset = HEADER_SIZE + index * self.record_size
+        return t.cast(float, TIMESTAMP.unpack_from(self.map, offset)[0])
+
+
+class Segment:
+    """A read-only view of a segment file, which may still be growing."""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        with open(path, "rb") as segment_file:
+            header = segment_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise APDSensorsError(f"Segment {path} has not been initialised")
+        magic, version, self.value_type, unit = HEADER.unpack(header)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            raise APDSensorsError(f"{path} is not a version {LAYOUT_VERSION} segment")
+        self.unit = unit.rstrip(b"\0").decode("utf-8")
+        self.record = RECORDS[self.value_type]
+        self._map: t.Optional[mmap.mmap] = None
+        self._size = 0
+
+    def timestamps(self) -> Timestamps:
+        """Map any records appended since the last call, and return their
+        timestamps."""
+        size = os.stat(self.path).st_size
+        if self._map is None or size != self._size:
+            # The old map isn't closed, as another thread may be reading it.
+            # It's closed when no longer referenced.
+            with open(self.path, "rb") as segment_file:
+                self._map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._size = size
+        count = (len(self._map) - HEADER_SIZE) // self.record.size
+        return Timestamps(self._map, self.record.size, max(count, 0))
+
+    def bounds(self) -> t.Optional[t.Tuple[float, float]]:
+        """Return the first and last timestamps, or None if there are none"""
+        timestamps = self.timestamps()
+        if not timestamps:
+            return None
+        return timestamps[0], timestamps[-1]
+
+    def value(self, number: Number) -> Value:
+        if self.unit:
+            return {"magnitude": number, "unit": self.unit}
+        return number
+
+    def read(self, start: float, end: float) -> t.Iterator[t.Tuple[float, Value]]:
+        """Yield the (timestamp, value) records with start <= timestamp <= end"""
+        timestamps = self.timestamps()
+        if not timestamps or timestamps[0] > end or timestamps[-1] < start:
+            return
+        first = bisect.bisect_left(timestamps, start)  # type: ignore
+        last = bisect.bisect_right(timestamps, end)  # type: ignore
+        for index in range(first, last):
+            offset = HEADER_SIZE + index * self.record.size
+            timestamp, number = self.record.unpack_from(timestamps.map, offset)
+            yield timestamp, self.value(number)
+
+    def last(self) -> t.Optional[t.Tuple[float, Value]]:
+        """Return the (timestamp, value) record that was appended last"""
+        timestamps = self.timestamps()
+        if not timestamps:
+            return None
+        offset = HEADER_SIZE + (len(timestamps) - 1) * self.record.size
+        timestamp, number = self.record.unpack_from(timestamps.map, offset)
+        return timestamp, self.value(number)
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class Appender:
+    """The state of the segment that a sensor's readings are appended to."""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        segment = Segment(path)
+        self.value_type = segment.value_type
+        self.unit = segment.unit
+        timestamps = segment.timestamps()
+        self.count = len(timestamps)
+        self.last = timestamps[-1] if timestamps else float("-inf")
+        segment.close()
+
+    def is_current(self) -> bool:
+        """Whether no other writer has appended to the sensor since"""
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            return False
+        if size != HEADER_SIZE + self.count * RECORDS[self.value_type].size:
+            return False
+        next_path = self.path.with_name(
+            f"{int(self.path.stem) + 1:08d}{SEGMENT_SUFFIX}"
+        )
+        return not next_path.exists()
+
+
+class TimeSeriesStore:
+    def __init__(
+        self,
+        path: t.Union[str, os.PathLike],
+        segment_records: int = DEFAULT_SEGMENT_RECORDS,
+    ) -> None:
+        self.path = pathlib.Path(path)
+        self.segment_records = segment_records
+        self._segments: t.Dict[pathlib.Path, Segment] = {}
+        self._appenders: t.Dict[str, Appender] = {}
+        # The first and last timestamps of segments that are no longer
+        # appended to, or None if they are empty
+        self._bounds: t.Dict[pathlib.Path, t.Optional[t.Tuple[float, float]]] = {}
+
+    def sensor_path(self, sensor_name: str) -> pathlib.Path:
+        if not sensor_name or sensor_name.startswith(".") or os.sep in sensor_name:
+            raise ValueError(f"Invalid sensor name {sensor_name!r}")
+        return self.path / sensor_name
+
+    def segment_paths(self, sensor_name: str) -> t.List[pathlib.Path]:
+        sensor_path = self.sensor_path(sensor_name)
+        if not sensor_path.is_dir():
+            return []
+        return sorted(sensor_path.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def sensor_names(self) -> t.List[str]:
+        if not self.path.is_dir():
+            return []
+        return sorted(path.name for path in self.path.iterdir() if path.is_dir())
+
+    def append(
+        self, sensor_name: str, collected_at: datetime.datetime, value: Value
+    ) -> None:
+        self.append_many(sensor_name, [(collected_at, value)])
+
+    def append_many(
+        self,
+        sensor_name: str,
+        readings: t.Iterable[t.Tuple[datetime.datetime, Value]],
+    ) -> None:
+        """Append readings of a sensor, writing each run of records that go
+        in the same segment at once."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.path / LOCK_NAME):
+            appender = self._appender(sensor_name)
+            pending = bytearray()
+            for collected_at, value in readings:
+                timestamp = collected_at.timestamp()
+                number, unit = split_value(value)
+                code = value_type(number)
+                if (
+                    appender is None
+                    or code != appender.value_type
+                    or unit != appender.unit
+                    or timestamp < appender.last
+                    or appender.count >= self.segment_records
+                ):
+                    if appender is not None:
+                        self._write(appender, pending)
+                        pending = bytearray()
+                    appender = self._new_segment(sensor_name, code, unit)
+                pending += RECORDS[code].pack(timestamp, number)
+                appender.count += 1
+                appender.last = timestamp
+            if appender is not None:
+                self._write(appender, pending)
+
+    def _appender(self, sensor_name: str) -> t.Optional[Appender]:
+        appender = self._appenders.get(sensor_name)
+        if appender is None or not appender.is_current():
+            paths = self.segment_paths(sensor_name)
+            if not paths:
+                return None
+            self._appenders[sensor_name] = Appender(paths[-1])
+        return self._appenders[sensor_name]
+
+    def _new_segment(self, sensor_name: str, code: bytes, unit: str) -> Appender:
+        sensor_path = self.sensor_path(sensor_name)
+        sensor_path.mkdir(parents=True, exist_ok=True)
+        paths = self.segment_paths(sensor_name)
+        number = int(paths[-1].stem) + 1 if paths else 1
+        path = sensor_path / f"{number:08d}{SEGMENT_SUFFIX}"
+        header = HEADER.pack(MAGIC, LAYOUT_VERSION, code, unit.encode("utf-8"))
+        header = header.ljust(HEADER_SIZE, b"\0")
+        # Write the header to a temporary file first, so readers never see a
+        # segment without one
+        temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary_path, "wb") as segment_file:
+            segment_file.write(header)
+        os.replace(temporary_path, path)
+        appender = self._appenders[sensor_name] = Appender(path)
+        return appender
+
+    def _write(self, appender: Appender, records: bytearray) -> None:
+        if not records:
+            return
+        fd = os.open(appender.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, records)
+        finally:
+            os.close(fd)
+
+    def segment(self, path: pathlib.Path) -> Segment:
+        segment = self._segments.get(path)
+        if segment is None:
+            segment = self._segments[path] = Segment(path)
+        return segment
+
+    def latest(self, sensor_name: str) -> t.Optional[t.Tuple[datetime.datetime, Value]]:
+        """Return the (collected_at, value) of the reading appended last"""
+        # A new segment may not have any records yet
+        for path in reversed(self.segment_paths(sensor_name)):
+            record = self.segment(path).last()
+            if record is not None:
+                return datetime.datetime.fromtimestamp(record[0]), record[1]
+        return None
+
+    def latest_values(
+        self, sensor_names: t.Optional[t.Iterable[str]] = None
+    ) -> t.List[StoredValue]:
+        """Return (sensor_name, collected_at, value) tuples of the latest
+        reading of each sensor, ordered by sensor name."""
+        if sensor_names is None:
+            sensor_names = self.sensor_names()
+        latest = []
+        for sensor_name in sorted(sensor_names):
+            reading = self.latest(sensor_name)
+            if reading is not None:
+                latest.append((sensor_name, *reading))
+        return latest
+
+    def sealed_bounds(self, path: pathlib.Path) -> t.Optional[t.Tuple[float, float]]:
+        """Return the first and last timestamps of a segment that is no longer
+        appended to, which only need to be read once."""
+        if path not in self._bounds:
+            self._bounds[path] = self.segment(path).bounds()
+        return self._bounds[path]
+
+    def read(
+        self, sensor_name: str, start: datetime.datetime, end: datetime.datetime
+    ) -> t.Iterator[t.Tuple[datetime.datetime, Value]]:
+        """Yield the (collected_at, value) readings of a sensor in a time range,
+        in time order."""
+        start_ts, end_ts = start.timestamp(), end.timestamp()
+        paths = self.segment_paths(sensor_name)
+        runs = []
+        for path in paths[:-1]:
+            bounds = self.sealed_bounds(path)
+            if bounds is None or bounds[0] > end_ts or bounds[1] < start_ts:
+                continue
+            runs.append(self.segment(path).read(start_ts, end_ts))
+        if paths:
+            runs.append(self.segment(paths[-1]).read(start_ts, end_ts))
+        # Segments only overlap if the clock went backwards, but each is sorted
+        for timestamp, value in heapq.merge(*runs, key=lambda record: record[0]):
+            yield datetime.datetime.fromtimestamp(timestamp), value
+
+    def values(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        sensor_names: t.Optional[t.Iterable[str]] = None,
+    ) -> t.Iterator[StoredValue]:
+        """Yield (sensor_name, collected_at, value) tuples for the given sensors,
+        or all sensors, in time order. These are the same as the stored values
+        read from the database for historical data."""
+        if sensor_names is None:
+            sensor_names = self.sensor_names()
+        runs = [named(name, self.read(name, start, end)) for name in sensor_names]
+        return heapq.merge(*runs, key=lambda stored: stored[1])
+
+    def close(self) -> None:
+        for segment in self._segments.values():
+            segment.close()
+        self._segments.clear()
+
+
+def named(
+    sensor_name: str, readings: t.Iterable[t.Tuple[datetime.datetime, Value]]
+) -> t.Iterator[StoredValue]:
+    for collected_at, value in readings:
+        yield sensor_name, collected_at, value
+
+
+stores: t.Dict[str, TimeSeriesStore] = {}
+
+
+def get_store(path: str) -> TimeSeriesStore:
+    store = stores.get(path)
+    if store is None:
+        store = stores[path] = TimeSeriesStore(path)
+    return store
@@ -0,0 +1,66 @@
+"""Timing of the phases of handling a request, such as executing database
+statements, building the response from the stored rows, formatting values
+and serialising the response.
+
+A ``Timings`` is made current for the duration of a request, and code that
+may be slow records its time with ``phase()``, which does nothing if there is
+no current ``Timings``. Phases are exclusive of any phases nested in them, so
+a query executed while iterating over rows is counted as ``db`` rather than
+as ``rows``.
+"""
+import contextlib
+import contextvars
+import time
+import typing as t
+
+
+class Timings:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.durations: t.Dict[str, float] = {}
+        # The time spent in phases nested inside each open phase
+        self.nested: t.List[float] = []
+
+    def add(self, name: str, elapsed: float, nested: float = 0.0) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + elapsed - nested
+        if self.nested:
+            self.nested[-1] += elapsed
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def header(self) -> str:
+        """Return the value of a Server-Timing header, in milliseconds"""
+        metrics = [
+            f"{name};dur={duration * 1000:.2f}"
+            for name, duration in self.durations.items()
+        ]
+        metrics.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+current: "contextvars.ContextVar[t.Optional[Timings]]" = contextvars.ContextVar(
+    "apd_sensors_timings", default=None
+)
+
+
+@contextlib.contextmanager
+def phase(name: str) -> t.Iterator[None]:
+    timings = current.get()
+    if timings is None:
+        yield
+        return
+    timings.nested.append(0.0)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        nested = timings.nested.pop()
+        timings.add(name, time.perf_counter() - started, nested)
+
+
+def record(name: str, elapsed: float) -> None:
+    """Add the time taken by an operation that has already finished"""
+    timings = current.get()
+    if timings is not None:
+        timings.add(name, elapsed)
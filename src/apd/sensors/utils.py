@@ -1,3 +1,8 @@
+import contextlib
+import fcntl
+import os
+import typing as t
+
 from apd.sensors.base import Sensor, T_value
 from apd.sensors.exceptions import IntermittentSensorFailureError
 
@@ -18,3 +23,16 @@ def get_value_with_retries(sensor: Sensor[T_value], retries: int = 3) -> T_value
     raise IntermittentSensorFailureError(
         f"Could not find a value after {retries} retries"
     )
+
+
+@contextlib.contextmanager
+def file_lock(path: t.Union[str, os.PathLike]) -> t.Iterator[None]:
+    """Hold an exclusive lock on a file, creating it if needed. The lock is
+    held against other processes and other threads of this one."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
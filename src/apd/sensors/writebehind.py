@@ -0,0 +1,265 @@
+"""Saving of the values read to serve API requests, so that historical data
+can be recorded without reading the sensors again from a ``sensors --save``
+job.
+
+Readings are put on a bounded in-memory queue by the request, and a
+background thread stores them in batches, so requests never wait for the
+database. Readings of a sensor collected less than ``min_interval`` seconds
+after the last one queued are skipped, so busy APIs don't store a value for
+every request. If the queue is full, the ``coalesce`` policy replaces the
+queued reading of the same sensor with the new one, and the ``drop`` policy
+drops the new reading. Queued readings are flushed when the process exits, or
+when a pre-forked worker of ``apd.sensors.wsgi.serve`` is stopped.
+Readings that can't be stored are added to the spool, if one is configured,
+and the spool is drained after the next successful write.
+"""
+import atexit
+import collections
+import datetime
+import logging
+import threading
+import typing as t
+
+from . import responses
+from .spool import Spool, SpoolFullError
+
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("coalesce", "drop")
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MIN_INTERVAL = 60.0
+# The longest a reading waits in the queue before being stored
+DEFAULT_FLUSH_INTERVAL = 5.0
+# The longest to wait for queued readings to be stored when closing
+DEFAULT_CLOSE_TIMEOUT = 10.0
+
+Row = t.Dict[str, t.Any]
+Storage = t.Callable[[t.List[Row]], None]
+
+
+class WriteBehindQueue:
+    def __init__(
+        self,
+        storage: Storage,
+        max_size: int = DEFAULT_QUEUE_SIZE,
+        policy: str = "coalesce",
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        spool: t.Optional[Spool] = None,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown write-behind policy {policy}")
+        self.storage = storage
+        self.max_size = max_size
+        self.policy = policy
+        self.min_interval = min_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool = spool
+        # Whether there may be readings in the spool to be stored
+        self.spooled = spool is not None
+        self.rows: t.Deque[Row] = collections.deque()
+        # The queued row of each sensor, for coalescing
+        self.pending: t.Dict[str, Row] = {}
+        self.last_queued: t.Dict[str, datetime.datetime] = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread: t.Optional[threading.Thread] = None
+        self.stored = self.dropped = self.coalesced = self.failed = 0
+
+    def start(self) -> None:
+        with self.condition:
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(
+                    target=self.run, name="apd.sensors.writebehind", daemon=True
+                )
+                self.thread.start()
+
+    def put(
+        self, sensor_name: str, collected_at: datetime.datetime, data: t.Any
+    ) -> bool:
+        """Queue a JSON compatible value to be stored, without blocking.
+        Returns whether the value will be stored."""
+        row = {"sensor_name": sensor_name, "collected_at": collected_at, "data": data}
+        with self.condition:
+            if self.closed:
+                return False
+            last = self.last_queued.get(sensor_name)
+            if (
+                last is not None
+                and 0 <= (collected_at - last).total_seconds() < self.min_interval
+            ):
+                return False
+            if len(self.rows) >= self.max_size:
+                queued = self.pending.get(sensor_name)
+                if self.policy == "coalesce" and queued is not None:
+                    queued.update(row)
+                    self.coalesced += 1
+                    self.last_queued[sensor_name] = collected_at
+                    return True
+                self.dropped += 1
+                return False
+            self.rows.append(row)
+            self.pending[sensor_name] = row
+            self.last_queued[sensor_name] = collected_at
+            if len(self.rows) >= self.batch_size:
+                self.condition.notify()
+            return True
+
+    def take_batch(self) -> t.List[Row]:
+        batch: t.List[Row] = []
+        while self.rows and len(batch) < self.batch_size:
+            row = self.rows.popleft()
+            if self.pending.get(row["sensor_name"]) is row:
+                del self.pending[row["sensor_name"]]
+            batch.append(row)
+        return batch
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                if not self.closed and len(self.rows) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                batch = self.take_batch()
+                finished = self.closed and not self.rows
+            if batch:
+                self.write(batch)
+            if finished:
+                return
+
+    def write(self, batch: t.List[Row]) -> None:
+        try:
+            self.storage(batch)
+        except Exception:
+            # The API keeps working if the database is unavailable, but the
+            # readings are lost unless there is a spool
+            logger.exception(f"Failed to store {len(batch)} readings")
+            self.spool_batch(batch)
+            return
+        self.stored += len(batch)
+        if self.spool is not None and self.spooled:
+            try:
+                self.stored += self.spool.drain(self.storage)
+            except Exception:
+                logger.exception("Failed to store spooled readings")
+            else:
+                self.spooled = False
+
+    def spool_batch(self, batch: t.List[Row]) -> None:
+        if self.spool is None:
+            self.failed += len(batch)
+            return
+        try:
+            self.spool.append(batch)
+        except SpoolFullError:
+            logger.exception(f"Failed to spool {len(batch)} readings")
+            self.failed += len(batch)
+        else:
+            self.spooled = True
+
+    def close(self, timeout: float = DEFAULT_CLOSE_TIMEOUT) -> None:
+        """Stop accepting readings, and wait up to timeout seconds for the
+        queued ones to be stored."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                # The writer is stuck, most likely on the database, and the
+                # spool can't be closed underneath it
+                logger.warning(
+                    f"Gave up waiting for {len(self.rows)} queued readings "
+                    "to be stored"
+                )
+                return
+        else:
+            # Never started, so flush in this thread
+            while self.rows:
+                self.write(self.take_batch())
+        if self.spool is not None:
+            self.spool.close()
+
+
+def get_storage(config: t.Mapping[str, t.Any]) -> Storage:
+    """Return a function that stores rows wherever ``sensors --save`` would
+    with the same configuration."""
+    from .database import create_engine, engine_storage, get_router, parse_pragmas
+
+    pragmas = parse_pragmas(config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+    timeseries_path = config.get("APD_SENSORS_TIMESERIES_PATH")
+    partitions_path = config.get("APD_SENSORS_DB_PARTITIONS")
+    if timeseries_path:
+        from .timeseries import get_store, UnsupportedValueError
+
+        store = get_store(timeseries_path)
+
+        def store_timeseries(rows: t.List[Row]) -> None:
+            for row in rows:
+                try:
+                    store.append(row["sensor_name"], row["collected_at"], row["data"])
+                except UnsupportedValueError:
+                    pass
+
+        return store_timeseries
+    elif partitions_path:
+        return get_router(partitions_path, pragmas).store_readings
+    return engine_storage(create_engine(config["SQLALCHEMY_DATABASE_URI"], pragmas))
+
+
+def get_spool(config: t.Mapping[str, t.Any]) -> t.Optional[Spool]:
+    spool_path = config.get("APD_SENSORS_SPOOL")
+    if not spool_path or config.get("APD_SENSORS_TIMESERIES_PATH"):
+        return None
+    max_size = config.get("APD_SENSORS_SPOOL_MAX_SIZE")
+    if max_size is None:
+        return Spool(spool_path)
+    return Spool(spool_path, max_size=int(max_size))
+
+
+queues: t.Dict[t.Tuple[t.Optional[str], ...], WriteBehindQueue] = {}
+queues_lock = threading.Lock()
+
+
+def get_queue(config: t.Mapping[str, t.Any]) -> t.Optional[WriteBehindQueue]:
+    """Return the running queue for this process if write-behind is enabled,
+    starting it if needed."""
+    if not responses.parse_flag(config.get("APD_SENSORS_WRITE_BEHIND"), False):
+        return None
+    key = (
+        config.get("APD_SENSORS_TIMESERIES_PATH"),
+        config.get("APD_SENSORS_DB_PARTITIONS"),
+        config.get("SQLALCHEMY_DATABASE_URI"),
+    )
+    with queues_lock:
+        queue = queues.get(key)
+        if queue is None:
+            queue = queues[key] = WriteBehindQueue(
+                get_storage(config),
+                max_size=int(
+                    config.get("APD_SENSORS_WRITE_BEHIND_QUEUE", DEFAULT_QUEUE_SIZE)
+                ),
+                policy=config.get("APD_SENSORS_WRITE_BEHIND_POLICY", "coalesce"),
+                min_interval=float(
+                    config.get(
+                        "APD_SENSORS_WRITE_BEHIND_INTERVAL", DEFAULT_MIN_INTERVAL
+                    )
+                ),
+                spool=get_spool(config),
+            )
+            # Started lazily, so each forked worker has its own thread
+            queue.start()
+    return queue
+
+
+@atexit.register
+def close_all() -> None:
+    with queues_lock:
+        to_close = list(queues.values())
+        queues.clear()
+    for queue in to_close:
+        queue.close()
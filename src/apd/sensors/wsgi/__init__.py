@@ -1,3 +1,5 @@
+import typing as t
+
 import flask
 
 try:
@@ -8,11 +10,14 @@ else:
     sql_support = True
 
 
-from .base import set_up_config
+from apd.sensors import metrics
+
+from .base import set_up_config, time_requests
 from . import v10
 from . import v20
 from . import v21
 from . import v30
+from . import v31
 
 
 __all__ = ["app", "set_up_config", "db"]
@@ -22,10 +27,35 @@ app.register_blueprint(v10.version, url_prefix="/v/1.0")
 app.register_blueprint(v20.version, url_prefix="/v/2.0")
 app.register_blueprint(v21.version, url_prefix="/v/2.1")
 app.register_blueprint(v30.version, url_prefix="/v/3.0")
+app.register_blueprint(v31.version, url_prefix="/v/3.1")
+time_requests(app)
+
+
+@app.route("/metrics")
+def prometheus_metrics() -> flask.Response:
+    """Serve the metrics of this process for Prometheus to scrape"""
+    return flask.Response(
+        metrics.render(),
+        content_type=metrics.CONTENT_TYPE,
+        headers={"Cache-Control": "no-store"},
+    )
+
 
 if sql_support:
-    from apd.sensors.database import metadata
+    from sqlalchemy.pool import NullPool
+    from apd.sensors.database import create_engine, metadata, parse_pragmas
+
+    class TunedSQLAlchemy(SQLAlchemy):
+        """Create engines with the pragmas and pooling of database.create_engine"""
+
+        def create_engine(self, sa_url, engine_opts):
+            # Flask-SQLAlchemy disables pooling for SQLite files
+            if engine_opts.get("poolclass") is NullPool:
+                del engine_opts["poolclass"]
+            config = self.get_app().config
+            pragmas = parse_pragmas(config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+            return create_engine(sa_url, pragmas, **engine_opts)
 
-    db = SQLAlchemy(app, metadata=metadata)
+    db: t.Any = TunedSQLAlchemy(app, metadata=metadata)
 else:
     db = None
@@ -1,14 +1,19 @@
 from hmac import compare_digest
+import cProfile
+import datetime
 import functools
 import os
 import typing as t
 
 import flask
 
+from apd.sensors import responses, timing
+
 
 ViewFuncReturn = t.TypeVar("ViewFuncReturn")
 ErrorReturn = t.Tuple[t.Dict[str, str], int]
 REQUIRED_CONFIG_KEYS = {"APD_SENSORS_API_KEY"}
+DEFAULT_PROFILE_THRESHOLD = 1.0
 
 
 def require_api_key(
@@ -26,6 +31,109 @@ def require_api_key(
     return wrapped
 
 
+def conditional(
+    cache_control: str,
+) -> t.Callable[[t.Callable[..., t.Any]], t.Callable[..., flask.Response]]:
+    """Add an ETag and Cache-Control header to successful responses, and
+    answer requests that already have the current version with 304 Not
+    Modified. Views can set their own Cache-Control to override the default."""
+
+    def decorator(func: t.Callable[..., t.Any]) -> t.Callable[..., flask.Response]:
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs) -> flask.Response:
+            view_return = func(*args, **kwargs)
+            with timing.phase("serialise"):
+                response = flask.make_response(view_return)
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            response.headers.setdefault("Cache-Control", cache_control)
+            response.add_etag()
+            return response.make_conditional(flask.request)
+
+        return wrapped
+
+    return decorator
+
+
+def negotiated(
+    func: t.Callable[..., t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]]
+) -> t.Callable[..., t.Union[flask.Response, t.Tuple[t.Any, ...]]]:
+    """Encode successful responses in the format, compression and layout
+    requested by the client's Accept and Accept-Encoding headers and the
+    layout query parameter."""
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs) -> t.Union[flask.Response, t.Tuple[t.Any, ...]]:
+        data, status, headers = func(*args, **kwargs)
+        if status != 200:
+            return data, status, headers
+        request = flask.request
+        with timing.phase("serialise"):
+            body, encoding_headers = responses.encode(
+                data,
+                request.headers.get("Accept"),
+                request.headers.get("Accept-Encoding"),
+                request.args.get("layout"),
+            )
+        return flask.Response(body, status, {**headers, **encoding_headers})
+
+    return wrapped
+
+
+def time_requests(app: flask.Flask) -> None:
+    """Add a Server-Timing header with the time taken by each phase of every
+    request. If APD_SENSORS_PROFILE_PATH is set, requests are also run under
+    cProfile, and the profile of any that take longer than
+    APD_SENSORS_PROFILE_THRESHOLD seconds is written to that directory."""
+
+    @app.before_request
+    def start_timing() -> None:
+        flask.g.apd_sensors_timings = timing.current.set(timing.Timings())
+        if flask.current_app.config.get("APD_SENSORS_PROFILE_PATH"):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is active, such as one for a parallel request
+                return
+            flask.g.apd_sensors_profiler = profiler
+
+    @app.after_request
+    def add_server_timing(response: flask.Response) -> flask.Response:
+        timings = timing.current.get()
+        config = flask.current_app.config
+        enabled = responses.parse_flag(config.get("APD_SENSORS_SERVER_TIMING"))
+        if timings is not None and enabled:
+            response.headers["Server-Timing"] = timings.header()
+        return response
+
+    @app.teardown_request
+    def finish_timing(exc: t.Optional[BaseException]) -> None:
+        token = flask.g.pop("apd_sensors_timings", None)
+        if token is None:
+            return
+        timings = timing.current.get()
+        timing.current.reset(token)
+        profiler = flask.g.pop("apd_sensors_profiler", None)
+        if profiler is None or timings is None:
+            return
+        profiler.disable()
+        config = flask.current_app.config
+        elapsed = timings.elapsed()
+        threshold = float(
+            config.get("APD_SENSORS_PROFILE_THRESHOLD", DEFAULT_PROFILE_THRESHOLD)
+        )
+        if elapsed >= threshold:
+            endpoint = flask.request.endpoint or "unknown"
+            name = "{}-{}-{}-{}ms.prof".format(
+                datetime.datetime.now().strftime("%Y%m%dT%H%M%S"),
+                os.getpid(),
+                endpoint,
+                round(elapsed * 1000),
+            )
+            profiler.dump_stats(os.path.join(config["APD_SENSORS_PROFILE_PATH"], name))
+
+
 def set_up_config(
     environ: t.Optional[t.Dict[str, str]] = None,
     to_configure: t.Optional[flask.Flask] = None,
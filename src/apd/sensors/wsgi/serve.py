@@ -1,10 +1,169 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import typing as t
+import wsgiref.simple_server
+
+import flask
+
+from apd.sensors import cli, writebehind
 from . import app
 from .base import set_up_config
 
-if __name__ == "__main__":
-    import wsgiref.simple_server
 
-    set_up_config(None, app)
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8000
+# Reading sensors directly means a request to /sensors/ can wait several seconds
+# for slow sensors, such as CPULoad, while using almost no CPU. Allow enough
+# threads that a few of those can be in flight without blocking other requests.
+LIVE_THREADS = 16
+# When a collector fills the shared store, requests never wait on sensors
+SHARED_STORE_THREADS = 4
+# How long stopped workers have to finish storing queued readings before they
+# are killed
+SHUTDOWN_TIMEOUT = writebehind.DEFAULT_CLOSE_TIMEOUT + 5
+
+
+class Stopped(Exception):
+    """Raised in the main thread when the process is sent SIGTERM"""
+
+
+def stop(signum: int, frame: t.Any) -> None:
+    # Further signals would interrupt the clean shutdown
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise Stopped()
+
+
+class ThreadingWSGIServer(
+    socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer
+):
+    daemon_threads = True
+
+    def run(self) -> None:
+        self.serve_forever()
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def pool_sizes(config: t.Mapping[str, t.Any]) -> t.Tuple[int, int]:
+    """Return the number of worker processes and threads per worker to use."""
+    if config.get("APD_SENSORS_SHARED_STORE"):
+        # Requests are cheap and can be spread over every core
+        default_workers = os.cpu_count() or 1
+        default_threads = SHARED_STORE_THREADS
+    else:
+        # Each process would read the sensors independently, and some sensors
+        # (such as the DHT22) can only be driven by one process at a time
+        default_workers = 1
+        default_threads = LIVE_THREADS
+    workers = int(config.get("APD_SENSORS_WORKERS", default_workers))
+    threads = int(config.get("APD_SENSORS_THREADS", default_threads))
+    return max(workers, 1), max(threads, 1)
+
 
-    with wsgiref.simple_server.make_server("", 8000, app) as server:
-        server.serve_forever()
+def preload(to_load: flask.Flask) -> None:
+    """Import all sensor plugins and set up the database engine, so that
+    forked workers don't have to."""
+    cli.get_sensors()
+    from . import db
+
+    if db is not None:
+        with to_load.app_context():
+            # Accessing the engine creates it, without connecting
+            db.engine
+
+
+def bind(config: t.Mapping[str, t.Any]) -> socket.socket:
+    host = config.get("APD_SENSORS_HOST", "")
+    port = int(config.get("APD_SENSORS_PORT", DEFAULT_PORT))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def create_server(to_serve: flask.Flask, sock: socket.socket, threads: int) -> t.Any:
+    """Create a server for the app on an already bound socket. The server
+    has ``run()`` and ``close()`` methods."""
+    try:
+        import waitress
+    except ImportError:
+        # wsgiref's handler closes the connection after every request, but
+        # at least one slow request won't block all the others
+        server = ThreadingWSGIServer(
+            sock.getsockname()[:2], wsgiref.simple_server.WSGIRequestHandler, False
+        )
+        server.socket.close()
+        server.socket = sock
+        host, server.server_port = sock.getsockname()[:2]
+        server.server_name = socket.getfqdn(host)
+        server.setup_environ()
+        server.set_app(to_serve)
+        return server
+    else:
+        return waitress.create_server(to_serve, sockets=[sock], threads=threads)
+
+
+def run_worker(to_serve: flask.Flask, sock: socket.socket, threads: int) -> None:
+    from . import db
+
+    # Forked workers exit without running atexit handlers, so the server must
+    # be stopped cleanly for queued readings to be stored
+    signal.signal(signal.SIGTERM, stop)
+    if db is not None:
+        # Connections must not be shared with the parent process
+        with to_serve.app_context():
+            db.engine.dispose()
+    server = create_server(to_serve, sock, threads)
+    try:
+        server.run()
+    except Stopped:
+        logger.info(f"Worker {os.getpid()} stopping")
+    finally:
+        server.close()
+        writebehind.close_all()
+
+
+def serve(environ: t.Optional[t.Dict[str, str]] = None) -> None:
+    set_up_config(environ, app)
+    workers, threads = pool_sizes(app.config)
+    preload(app)
+    sock = bind(app.config)
+    logger.info(f"Serving on {sock.getsockname()} with {workers}x{threads} threads")
+    if workers == 1:
+        run_worker(app, sock, threads)
+        return
+
+    signal.signal(signal.SIGTERM, stop)
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=run_worker, args=(app, sock, threads), daemon=True)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except Stopped:
+        logger.info("Stopping workers")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+        sock.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve()
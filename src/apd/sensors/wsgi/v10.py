@@ -3,7 +3,7 @@ import typing as t
 
 import flask
 
-from apd.sensors import cli
+from apd.sensors import cli, metrics
 from apd.sensors.exceptions import DataCollectionError
 from .base import require_api_key
 
@@ -17,7 +17,8 @@ def sensor_values() -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
     data = {}
     for sensor in cli.get_sensors():
         try:
-            value = sensor.value()
+            with metrics.timed_read(sensor.name):
+                value = sensor.value()
         except DataCollectionError:
             value = None
         try:
@@ -2,7 +2,7 @@ import typing as t
 
 import flask
 
-from apd.sensors import cli
+from apd.sensors import cli, metrics
 from apd.sensors.exceptions import DataCollectionError
 from .base import require_api_key
 
@@ -20,7 +20,8 @@ def sensor_values(sensor_id=None) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str
             continue
         try:
             try:
-                value = sensor.value()
+                with metrics.timed_read(sensor.name):
+                    value = sensor.value()
             except DataCollectionError:
                 human_readable = "Unknown"
                 json_value = None
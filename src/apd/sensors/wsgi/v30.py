@@ -4,11 +4,11 @@ import typing as t
 
 import flask
 
-from apd.sensors import cli
+from apd.sensors import cli, metrics, responses
 from apd.sensors.base import HistoricalSensor
 from apd.sensors.exceptions import DataCollectionError
 
-from .base import require_api_key
+from .base import conditional, negotiated, require_api_key
 
 version = flask.Blueprint(__name__, __name__)
 logger = logging.getLogger(__name__)
@@ -16,6 +16,7 @@ logger = logging.getLogger(__name__)
 
 @version.route("/sensors/")
 @version.route("/sensors/<sensor_id>")
+@conditional(responses.LIVE_CACHE_CONTROL)
 @require_api_key
 def sensor_values(sensor_id=None) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
     headers = {"Content-Security-Policy": "default-src 'none'"}
@@ -27,7 +28,8 @@ def sensor_values(sensor_id=None) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str
             continue
         try:
             try:
-                value = sensor.value()
+                with metrics.timed_read(sensor.name):
+                    value = sensor.value()
             except Exception as err:
                 if isinstance(err, DataCollectionError):
                     # We allow data collection errors
@@ -62,7 +64,9 @@ def sensor_values(sensor_id=None) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str
 @version.route("/historical")
 @version.route("/historical/<start>")
 @version.route("/historical/<start>/<end>")
+@conditional(responses.LIVE_CACHE_CONTROL)
 @require_api_key
+@negotiated
 def historical_values(
     start: str = None, end: str = None
 ) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
@@ -87,6 +91,7 @@ def historical_values(
         query = query.filter(sensor_values_table.c.collected_at <= end_dt)
     else:
         end_dt = datetime.datetime.now()
+    headers.update(responses.range_cache_headers(end_dt if end else None))
 
     known_sensors = {sensor.name: sensor for sensor in cli.get_sensors()}
     sensors = []
@@ -98,7 +103,7 @@ def historical_values(
             "id": sensor.name,
             "title": sensor.title,
             "value": data.data,
-            "human_readable": sensor.format(sensor.from_json_compatible(data.data)),
+            "human_readable": responses.human_readable(sensor, data.data),
             "collected_at": data.collected_at.isoformat(),
         }
         sensors.append(sensor_data)
@@ -109,7 +114,7 @@ def historical_values(
                     "id": sensor.name,
                     "title": sensor.title,
                     "value": value,
-                    "human_readable": sensor.format(sensor.from_json_compatible(value)),
+                    "human_readable": responses.human_readable(sensor, value),
                     "collected_at": date.isoformat(),
                 }
                 sensors.append(sensor_data)
@@ -121,6 +126,7 @@ def historical_values(
 
 
 @version.route("/deployment_id")
+@conditional(responses.DEPLOYMENT_CACHE_CONTROL)
 def deployment_id() -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
     headers = {"Content-Security-Policy": "default-src 'none'"}
     data = {"deployment_id": flask.current_app.config["APD_SENSORS_DEPLOYMENT_ID"]}
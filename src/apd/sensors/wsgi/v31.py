@@ -1,66 +1,111 @@
 import datetime
-import logging
 import typing as t
 
-import dateutil.parser
 import flask
 
-from apd.sensors import cli
-from apd.sensors.base import HistoricalSensor
-from apd.sensors.exceptions import DataCollectionError
+from apd.sensors import (
+    cli,
+    ingest,
+    live,
+    metrics,
+    responses,
+    sharedstore,
+    timeseries,
+    writebehind,
+)
 
-from .base import require_api_key
+from .base import conditional, negotiated, require_api_key
 
 version = flask.Blueprint(__name__, __name__)
-logger = logging.getLogger(__name__)
+
+# Request bodies are read in chunks of this many bytes
+READ_SIZE = 64 * 1024
 
 
 @version.route("/sensors/")
 @version.route("/sensors/<sensor_id>")
+@conditional(responses.LIVE_CACHE_CONTROL)
 @require_api_key
 def sensor_values(sensor_id=None) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
     headers = {"Content-Security-Policy": "default-src 'none'"}
     sensors = []
     errors = []
+    shared_store = flask.current_app.config.get("APD_SENSORS_SHARED_STORE")
+    # Values from the shared store aren't new readings, so aren't saved
+    queue = None if shared_store else writebehind.get_queue(flask.current_app.config)
     for sensor in cli.get_sensors():
         now = datetime.datetime.now()
         if sensor_id and sensor_id != sensor.name:
             continue
         try:
             try:
-                value = sensor.value()
-            except Exception as err:
-                if isinstance(err, DataCollectionError):
-                    # We allow data collection errors
-                    message = str(err)
+                if shared_store:
+                    # Serve the value the collector stored rather than
+                    # reading the sensor in this process
+                    now, value = sharedstore.read_value(
+                        shared_store,
+                        sensor,
+                        sharedstore.get_max_age(flask.current_app.config),
+                    )
                 else:
-                    # Other errors shouldn't be published, but should be logged
-                    # Don't refuse to service the request in this case
-                    message = "Unhandled error"
-                    logger.error(f"Unhandled error while handling {sensor.name}")
-                error = {
-                    "id": sensor.name,
-                    "title": sensor.title,
-                    "collected_at": now.isoformat(),
-                    "error": message,
-                }
-                errors.append(error)
+                    with metrics.timed_read(sensor.name):
+                        value = sensor.value()
+            except Exception as err:
+                errors.append(responses.error_data(sensor, err, now))
                 continue
-            sensor_data = {
-                "id": sensor.name,
-                "title": sensor.title,
-                "value": sensor.to_json_compatible(value),
-                "human_readable": sensor.format(value),
-                "collected_at": now.isoformat(),
-            }
-            sensors.append(sensor_data)
+            value_data = responses.value_data(sensor, value, now)
+            sensors.append(value_data)
+            if queue is not None:
+                queue.put(sensor.name, now, value_data["value"])
         except NotImplementedError:
             pass
     data = {"sensors": sensors, "errors": errors}
     return data, 200, headers
 
 
+@version.route("/stream")
+@version.route("/sensors/<sensor_id>/stream")
+@require_api_key
+def stream(
+    sensor_id=None,
+) -> t.Union[flask.Response, t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]]:
+    headers = {
+        "Content-Security-Policy": "default-src 'none'",
+        "Cache-Control": "no-cache",
+        # Stop nginx from buffering events
+        "X-Accel-Buffering": "no",
+    }
+    # Every stream holds a server thread until the client disconnects, so
+    # they are limited to leave threads for other requests. The ASGI app
+    # has no such limit.
+    slots = live.get_stream_slots(flask.current_app.config)
+    if not slots.acquire(blocking=False):
+        return (
+            {"error": "Too many open streams"},
+            503,
+            {"Retry-After": str(live.STREAM_RETRY_AFTER)},
+        )
+    try:
+        last_id = live.parse_event_id(
+            flask.request.headers.get("Last-Event-ID")
+            or flask.request.args.get("last_event_id")
+        )
+        feed = live.get_feed(flask.current_app.config)
+        response = flask.Response(
+            live.stream(feed, last_id, sensor_id),
+            mimetype="text/event-stream",
+            headers=headers,
+        )
+    except Exception:
+        slots.release()
+        raise
+    # Called by the server when the client disconnects
+    response.call_on_close(slots.release)
+    return response
+
+
 @version.route("/info/sensors")
+@conditional(responses.INFO_CACHE_CONTROL)
 @require_api_key
 def sensor_types(sensor_id=None) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
     headers = {"Content-Security-Policy": "default-src 'none'"}
@@ -74,75 +119,211 @@ def sensor_types(sensor_id=None) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str,
 @version.route("/historical")
 @version.route("/historical/<start>")
 @version.route("/historical/<start>/<end>")
+@conditional(responses.LIVE_CACHE_CONTROL)
 @require_api_key
+@negotiated
 def historical_values(
     start: str = None, end: str = None, sensor_id: str = None,
 ) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
-    sensors = []
+    try:
+        start_dt, end_dt = responses.date_range(start, end)
+    except ImportError:
+        return {"error": "Historical data support is not installed"}, 501, {}
+
     known_sensors = {sensor.name: sensor for sensor in cli.get_sensors()}
 
     if sensor_id and sensor_id in known_sensors:
         known_sensors = {sensor_id: known_sensors[sensor_id]}
 
     headers = {"Content-Security-Policy": "default-src 'none'"}
+    headers.update(responses.range_cache_headers(end_dt if end else None))
 
-    if start:
-        start_dt = dateutil.parser.parse(start)
+    stored_values: t.Iterable[t.Tuple[str, datetime.datetime, t.Any]] = []
+    timeseries_path = flask.current_app.config.get("APD_SENSORS_TIMESERIES_PATH")
+    partitions_path = flask.current_app.config.get("APD_SENSORS_DB_PARTITIONS")
+    session = None
+    if timeseries_path:
+        store = timeseries.get_store(timeseries_path)
+        stored_values = store.values(start_dt, end_dt, list(known_sensors))
+    elif partitions_path:
+        from apd.sensors.database import get_router, parse_pragmas
+
+        config = flask.current_app.config
+        pragmas = parse_pragmas(config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+        router = get_router(partitions_path, pragmas)
+        stored_values = router.stored_values(start_dt, end_dt, list(known_sensors))
     else:
-        start_dt = dateutil.parser.parse("1900-01-01")
+        try:
+            from apd.sensors.database import sensor_values as sensor_values_table
+            from apd.sensors.wsgi import db
+
+            session = db.session
+        except (ImportError, AttributeError):
+            session = None
+        else:
+            query = session.query(sensor_values_table)
+            query = query.filter(sensor_values_table.c.collected_at >= start_dt)
+            query = query.filter(sensor_values_table.c.collected_at <= end_dt)
+            stored_values = (
+                (row.sensor_name, row.collected_at, row.data) for row in query
+            )
+
+    include_human_readable = responses.parse_flag(
+        flask.request.args.get("human_readable")
+    )
+    sensors = responses.historical_data(
+        known_sensors, stored_values, start_dt, end_dt, include_human_readable
+    )
+    data = {"sensors": sensors}
+    try:
+        return data, 200, headers
+    finally:
+        if session is not None:
+            session.close()
+
+
+@version.route("/latest")
+@version.route("/sensors/<sensor_id>/latest")
+@conditional(responses.LIVE_CACHE_CONTROL)
+@require_api_key
+def latest_values(
+    sensor_id: t.Optional[str] = None,
+) -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
+    known_sensors = {sensor.name: sensor for sensor in cli.get_sensors()}
+    if sensor_id:
+        known_sensors = {
+            name: sensor for name, sensor in known_sensors.items() if name == sensor_id
+        }
+    headers = {"Content-Security-Policy": "default-src 'none'"}
 
-    if end:
-        end_dt = dateutil.parser.parse(end)
+    config = flask.current_app.config
+    timeseries_path = config.get("APD_SENSORS_TIMESERIES_PATH")
+    partitions_path = config.get("APD_SENSORS_DB_PARTITIONS")
+    if timeseries_path:
+        store = timeseries.get_store(timeseries_path)
+        stored_values = store.latest_values(list(known_sensors))
+    elif partitions_path:
+        from apd.sensors.database import get_router, parse_pragmas
+
+        pragmas = parse_pragmas(config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+        router = get_router(partitions_path, pragmas)
+        stored_values = router.latest_values(list(known_sensors))
     else:
-        end_dt = datetime.datetime.now()
+        try:
+            from apd.sensors.database import latest_stored_values
+            from apd.sensors.wsgi import db
+        except ImportError:
+            db = None
+        if db is None:
+            return {"error": "Historical data support is not installed"}, 501, {}
+        try:
+            stored_values = latest_stored_values(db.session, list(known_sensors))
+        finally:
+            db.session.close()
+
+    include_human_readable = responses.parse_flag(
+        flask.request.args.get("human_readable")
+    )
+    sensors = responses.latest_data(
+        known_sensors, stored_values, include_human_readable
+    )
+    return {"sensors": sensors}, 200, headers
 
+
+@version.route("/changes")
+@conditional(responses.LIVE_CACHE_CONTROL)
+@require_api_key
+def changes() -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
+    try:
+        since_id, limit = responses.changes_range(
+            flask.request.args.get("since_id"), flask.request.args.get("limit")
+        )
+    except ValueError as err:
+        return {"error": str(err)}, 400, {}
+    if flask.current_app.config.get("APD_SENSORS_DB_PARTITIONS"):
+        return {"error": responses.PARTITIONED_CHANGES_ERROR}, 501, {}
     try:
-        from apd.sensors.database import sensor_values as sensor_values_table
+        from apd.sensors.database import values_since
         from apd.sensors.wsgi import db
+    except ImportError:
+        db = None
+    if db is None:
+        return {"error": "Historical data support is not installed"}, 501, {}
 
-        session = db.session
-    except (ImportError, AttributeError):
-        session = None
-    else:
-        db_session = db.session
+    headers = {"Content-Security-Policy": "default-src 'none'"}
+    try:
+        rows = values_since(db.session, since_id, limit + 1)
+    finally:
+        db.session.close()
+    deployment_id = flask.current_app.config["APD_SENSORS_DEPLOYMENT_ID"]
+    data = responses.changes_data(rows, since_id, limit, deployment_id)
+    return data, 200, headers
 
-        query = db_session.query(sensor_values_table)
-        query = query.filter(sensor_values_table.c.collected_at >= start_dt)
-        query = query.filter(sensor_values_table.c.collected_at <= end_dt)
 
-        for data in query:
-            if data.sensor_name not in known_sensors:
-                continue
-            sensor = known_sensors[data.sensor_name]
-            sensor_data = {
-                "id": sensor.name,
-                "title": sensor.title,
-                "value": data.data,
-                "human_readable": sensor.format(sensor.from_json_compatible(data.data)),
-                "collected_at": data.collected_at.isoformat(),
-            }
-            sensors.append(sensor_data)
-
-    for sensor in known_sensors.values():
-        if isinstance(sensor, HistoricalSensor):
-            for date, value in sensor.historical(start_dt, end_dt):
-                sensor_data = {
-                    "id": sensor.name,
-                    "title": sensor.title,
-                    "value": value,
-                    "human_readable": sensor.format(sensor.from_json_compatible(value)),
-                    "collected_at": date.isoformat(),
-                }
-                sensors.append(sensor_data)
-    data = {"sensors": sensors}
+@version.route("/ingest", methods=["POST"])
+@require_api_key
+def ingest_values() -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
+    config = flask.current_app.config
+    partitions_path = config.get("APD_SENSORS_DB_PARTITIONS")
     try:
+        from apd.sensors.database import get_router, parse_pragmas, store_readings
+        from apd.sensors.wsgi import db
+    except ImportError:
+        db = None
+    if db is None and not partitions_path:
+        return {"error": "Historical data support is not installed"}, 501, {}
+    body = read_body(ingest.MAX_INGEST_SIZE)
+    if body is None:
+        return {"error": "Request body too large"}, 413, {}
+
+    headers = {"Content-Security-Policy": "default-src 'none'"}
+    known_sensors = {sensor.name: sensor for sensor in cli.get_sensors()}
+    content_type = flask.request.content_type or ""
+    if partitions_path:
+        # Each partition's readings are stored in a transaction of their own
+        pragmas = parse_pragmas(config.get("APD_SENSORS_SQLITE_PRAGMAS"))
+        router = get_router(partitions_path, pragmas)
+        try:
+            data = ingest.ingest(
+                router.store_readings, known_sensors, body, content_type
+            )
+        except ingest.IngestError as err:
+            return {"error": str(err)}, 400, headers
         return data, 200, headers
+    try:
+        data = ingest.ingest(
+            lambda rows: store_readings(db.session, rows),
+            known_sensors,
+            body,
+            content_type,
+        )
+        db.session.commit()
+    except ingest.IngestError as err:
+        db.session.rollback()
+        return {"error": str(err)}, 400, headers
     finally:
-        if session is not None:
-            session.close()
+        db.session.close()
+    return data, 200, headers
+
+
+def read_body(max_size: int) -> t.Optional[bytes]:
+    """Return the request body, or None if it is larger than max_size. Chunked
+    requests have no Content-Length, so the size is checked as it is read."""
+    if (flask.request.content_length or 0) > max_size:
+        return None
+    chunks: t.List[bytes] = []
+    size = 0
+    while size <= max_size:
+        chunk = flask.request.stream.read(min(READ_SIZE, max_size + 1 - size))
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        size += len(chunk)
+    return None
 
 
 @version.route("/deployment_id")
+@conditional(responses.DEPLOYMENT_CACHE_CONTROL)
 def deployment_id() -> t.Tuple[t.Dict[str, t.Any], int, t.Dict[str, str]]:
     headers = {"Content-Security-Policy": "default-src 'none'"}
     data = {"deployment_id": flask.current_app.config["APD_SENSORS_DEPLOYMENT_ID"]}
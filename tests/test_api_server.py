@@ -1,4 +1,6 @@
 import datetime
+import io
+import json
 import os
 import typing as t
 import uuid
@@ -9,12 +11,13 @@ import pytest
 from webtest import TestApp
 
 from apd.sensors.base import HistoricalSensor, JSONSensor
-from apd.sensors.sensors import PythonVersion
+from apd.sensors.sensors import PythonVersion, Temperature
 from apd.sensors.wsgi import set_up_config
 from apd.sensors.wsgi import v10
 from apd.sensors.wsgi import v20
 from apd.sensors.wsgi import v21
 from apd.sensors.wsgi import v30
+from apd.sensors.wsgi import v31
 
 
 class HistoricalBoolSensor(HistoricalSensor[bool], JSONSensor[bool]):
@@ -82,6 +85,15 @@ class CommonTests:
         assert response.status_code == 403
         assert response.json["error"] == "Supply API key in X-API-Key header"
 
+    def test_sensor_reads_are_counted(self, api_server, api_key):
+        from apd.sensors import metrics
+
+        metrics.sensor_reads.clear()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            api_server.get("/sensors/", headers={"X-API-Key": api_key})
+        assert metrics.sensor_reads.values == {("PythonVersion", "success"): 1}
+
 
 class Testv10API(CommonTests):
     @pytest.fixture
@@ -286,6 +298,97 @@ class Testv30API(CommonTests):
             "value": True,
         }
 
+    def test_past_historical_range_is_cacheable(self, api_key, api_server, db):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [HistoricalBoolSensor()]
+            path = "/historical/2020-01-01/2020-01-02"
+            response = api_server.get(path, headers={"X-API-Key": api_key})
+            assert response.headers["Cache-Control"] == "private, max-age=86400"
+            # Values can be stored in the range later, so only the ETag is used
+            assert "Last-Modified" not in response.headers
+
+            not_modified = api_server.get(
+                path,
+                headers={"X-API-Key": api_key, "If-None-Match": response.etag},
+                status=304,
+            )
+            assert not_modified.body == b""
+            assert not_modified.headers["ETag"] == response.headers["ETag"]
+            api_server.get(
+                path,
+                headers={
+                    "X-API-Key": api_key,
+                    "If-Modified-Since": "Thu, 02 Jan 2020 00:00:00 GMT",
+                },
+                status=200,
+            )
+
+    def test_historical_encodings(self, api_key, subject, db):
+        import gzip
+
+        msgpack = pytest.importorskip("msgpack")
+
+        # WebTest decompresses responses, so use the Flask client directly
+        client = subject.test_client()
+        path = "/historical/2020-01-01/2020-01-02"
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [HistoricalBoolSensor()]
+            plain = client.get(path, headers={"X-API-Key": api_key})
+            compressed = client.get(
+                path, headers={"X-API-Key": api_key, "Accept-Encoding": "gzip"}
+            )
+            packed = client.get(
+                path, headers={"X-API-Key": api_key, "Accept": "application/msgpack"}
+            )
+
+        assert plain.content_type == "application/json"
+        assert "Content-Encoding" not in plain.headers
+        assert plain.headers["Vary"] == "Accept, Accept-Encoding"
+
+        assert compressed.headers["Content-Encoding"] == "gzip"
+        assert compressed.headers["ETag"] != plain.headers["ETag"]
+        assert gzip.decompress(compressed.data) == plain.data
+
+        assert packed.content_type == "application/msgpack"
+        assert msgpack.unpackb(packed.data) == plain.json
+
+    def test_historical_column_layout(self, api_key, api_server, db):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [HistoricalBoolSensor()]
+            value = api_server.get(
+                "/historical/2020-01-01/2020-01-02?layout=columns",
+                headers={"X-API-Key": api_key},
+            ).json
+        [sensor] = value["sensors"]
+        assert sensor["id"] == "HistoricalBoolSensor"
+        assert sensor["title"] == "Sensor which has past data"
+        assert sensor["collected_at"][:2] == [
+            "2020-01-01T00:00:00",
+            "2020-01-01T01:00:00",
+        ]
+        assert sensor["value"] == [True] * 24
+
+    def test_open_historical_range_must_be_revalidated(self, api_key, api_server, db):
+        response = api_server.get("/historical", headers={"X-API-Key": api_key})
+        assert response.headers["Cache-Control"] == "no-cache"
+        assert "Last-Modified" not in response.headers
+        assert response.etag
+
+    def test_deployment_id_is_cacheable(self, api_server):
+        response = api_server.get("/deployment_id")
+        assert response.headers["Cache-Control"] == "public, max-age=300"
+        api_server.get(
+            "/deployment_id", headers={"If-None-Match": response.etag}, status=304
+        )
+        changed = api_server.get("/deployment_id", headers={"If-None-Match": '"x"'})
+        assert changed.json == response.json
+
+    def test_errors_are_not_cacheable(self, api_server):
+        response = api_server.get("/sensors/", expect_errors=True)
+        assert response.status_code == 403
+        assert "ETag" not in response.headers
+        assert "Cache-Control" not in response.headers
+
     @pytest.mark.functional
     def test_sensor_values_returned_as_json(self, api_server, api_key):
         value = api_server.get("/sensors/", headers={"X-API-Key": api_key}).json
@@ -355,3 +458,449 @@ class Testv30API(CommonTests):
         ]
         assert len(failing_errors) == 1
         assert failing_errors[0]["error"] == "Unhandled error"
+
+
+class Testv31API(Testv30API):
+    @pytest.fixture
+    def subject(self, api_key, tmp_path):
+        app = flask.Flask("testapp")
+        app.register_blueprint(v31.version)
+        set_up_config(
+            {
+                "APD_SENSORS_API_KEY": api_key,
+                "APD_SENSORS_DEPLOYMENT_ID": "8f1b57faa04b430c81decbbeee9e300c",
+                "APD_SENSORS_DB_URI": "sqlite://",
+            },
+            to_configure=app,
+        )
+        return app
+
+    @pytest.fixture
+    def shared_store(self, subject, tmp_path):
+        from apd.sensors.sharedstore import SharedValueStore, readers
+
+        path = str(tmp_path / "shared_store")
+        store = SharedValueStore(path, writable=True)
+        subject.config["APD_SENSORS_SHARED_STORE"] = path
+        yield store
+        store.close()
+        reader = readers.pop(path, None)
+        if reader is not None:
+            reader.close()
+
+    def test_sensor_values_read_from_shared_store(
+        self, api_server, api_key, shared_store
+    ):
+        from .test_utils import FailingSensor
+
+        collected_at = datetime.datetime.now().replace(microsecond=0)
+        shared_store.write_value(PythonVersion(), PythonVersion().value(), collected_at)
+        shared_store.write_error(FailingSensor(), "Failing 2 more times")
+
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            # The sensors must not be read by the API process
+            failing = FailingSensor(2, exception_type=AssertionError)
+            get_sensors.return_value = [
+                failing,
+                PythonVersion(),
+                HistoricalBoolSensor(),
+            ]
+            with mock.patch.object(PythonVersion, "value") as value:
+                value.side_effect = AssertionError
+                data = api_server.get("/sensors/", headers={"X-API-Key": api_key}).json
+
+        assert data["sensors"] == [
+            {
+                "id": "PythonVersion",
+                "title": "Python Version",
+                "value": list(PythonVersion().value()),
+                "human_readable": str(PythonVersion()),
+                "collected_at": collected_at.isoformat(),
+            }
+        ]
+        errors = {error["id"]: error["error"] for error in data["errors"]}
+        assert errors == {
+            "FailingSensor": "Failing 2 more times",
+            "HistoricalBoolSensor": "No value available in shared store",
+        }
+
+    def test_old_values_in_shared_store_are_errors(
+        self, subject, api_server, api_key, shared_store
+    ):
+        collected_at = datetime.datetime.now() - datetime.timedelta(seconds=30)
+        shared_store.write_value(PythonVersion(), PythonVersion().value(), collected_at)
+        subject.config["APD_SENSORS_SHARED_STORE_MAX_AGE"] = "10"
+
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            data = api_server.get("/sensors/", headers={"X-API-Key": api_key}).json
+
+        assert data["sensors"] == []
+        assert data["errors"][0]["error"].startswith(
+            "No value available in shared store since"
+        )
+
+    def test_historical_without_human_readable(self, api_key, api_server, db):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [HistoricalBoolSensor()]
+            with mock.patch.object(HistoricalBoolSensor, "format") as format:
+                value = api_server.get(
+                    "/historical/2020-01-01/2020-01-02?human_readable=false",
+                    headers={"X-API-Key": api_key},
+                ).json
+        assert format.call_count == 0
+        assert value["sensors"][0] == {
+            "collected_at": "2020-01-01T00:00:00",
+            "id": "HistoricalBoolSensor",
+            "title": "Sensor which has past data",
+            "value": True,
+        }
+
+    @pytest.fixture
+    def stored_values(self, db, store_sensor_data):
+        for i in range(5):
+            store_sensor_data(PythonVersion, [3, i, 0, "final", 1], db.session)
+        db.session.commit()
+
+    def test_changes_are_returned_in_batches(self, api_server, api_key, stored_values):
+        headers = {"X-API-Key": api_key}
+        first = api_server.get("/changes?limit=3", headers=headers).json
+        assert first["deployment_id"] == "8f1b57faa04b430c81decbbeee9e300c"
+        assert [change["value"][1] for change in first["changes"]] == [0, 1, 2]
+        assert first["changes"][0]["id"] == "PythonVersion"
+        assert first["high_water_mark"] == first["changes"][-1]["change_id"]
+        assert first["more"] is True
+
+        since_id = first["high_water_mark"]
+        second = api_server.get(
+            f"/changes?since_id={since_id}&limit=3", headers=headers
+        ).json
+        assert [change["value"][1] for change in second["changes"]] == [3, 4]
+        assert second["more"] is False
+
+        since_id = second["high_water_mark"]
+        last = api_server.get(f"/changes?since_id={since_id}", headers=headers).json
+        assert last["changes"] == []
+        assert last["high_water_mark"] == since_id
+
+    def test_changes_rejects_invalid_options(self, api_server, api_key, db):
+        for query in ("since_id=x", "since_id=-1", "limit=0", "limit=10001"):
+            response = api_server.get(
+                f"/changes?{query}", headers={"X-API-Key": api_key}, status=400
+            )
+            assert "error" in response.json
+
+    def test_latest_values(self, api_server, api_key, stored_values):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion(), Temperature()]
+            data = api_server.get("/latest", headers={"X-API-Key": api_key}).json
+            [reading] = data["sensors"]
+            assert reading["id"] == "PythonVersion"
+            assert reading["value"] == [3, 4, 0, "final", 1]
+            assert reading["human_readable"] == "3.4"
+            data = api_server.get(
+                "/sensors/Temperature/latest", headers={"X-API-Key": api_key}
+            ).json
+            assert data["sensors"] == []
+
+    def test_changes_requires_api_key(self, api_server, db):
+        api_server.get("/changes", status=403)
+
+    def test_historical_from_timeseries(self, subject, api_server, api_key, tmp_path):
+        from apd.sensors.sensors import CPULoad
+        from apd.sensors.timeseries import TimeSeriesStore
+
+        store = TimeSeriesStore(tmp_path / "timeseries")
+        store.append_many(
+            "CPULoad",
+            [(datetime.datetime(2020, 1, day), day / 10) for day in (1, 2, 3)],
+        )
+        subject.config["APD_SENSORS_TIMESERIES_PATH"] = str(tmp_path / "timeseries")
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [CPULoad()]
+            value = api_server.get(
+                "/historical/2020-01-02/2020-01-03", headers={"X-API-Key": api_key}
+            ).json
+        assert [(r["collected_at"], r["human_readable"]) for r in value["sensors"]] == [
+            ("2020-01-02T00:00:00", "20.0%"),
+            ("2020-01-03T00:00:00", "30.0%"),
+        ]
+
+    def test_historical_from_partitions(self, subject, api_server, api_key, tmp_path):
+        from apd.sensors.database import PartitionRouter
+
+        router = PartitionRouter(str(tmp_path))
+        router.store_readings(
+            {
+                "sensor_name": "PythonVersion",
+                "collected_at": datetime.datetime(2020, month, 1),
+                "data": [3, month, 0, "final", 0],
+            }
+            for month in (1, 2, 3)
+        )
+        router.dispose()
+        subject.config["APD_SENSORS_DB_PARTITIONS"] = str(tmp_path)
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            value = api_server.get(
+                "/historical/2020-01-15/2020-03-15", headers={"X-API-Key": api_key}
+            ).json
+        assert [reading["value"][1] for reading in value["sensors"]] == [2, 3]
+
+    def test_historical_from_partitions_with_timezone(
+        self, subject, api_server, api_key, tmp_path
+    ):
+        from apd.sensors.database import PartitionRouter
+
+        router = PartitionRouter(str(tmp_path))
+        router.store_readings(
+            {
+                "sensor_name": "PythonVersion",
+                "collected_at": datetime.datetime(2020, month, 15),
+                "data": [3, month, 0, "final", 0],
+            }
+            for month in (1, 2, 3)
+        )
+        router.dispose()
+        subject.config["APD_SENSORS_DB_PARTITIONS"] = str(tmp_path)
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            response = api_server.get(
+                "/historical/2020-02-01T00:00Z/2020-04-01T00:00Z",
+                headers={"X-API-Key": api_key},
+            )
+        assert response.status_code == 200
+        assert [reading["value"][1] for reading in response.json["sensors"]] == [2, 3]
+
+    def test_ingest_into_partitions(self, subject, api_server, api_key, tmp_path):
+        subject.config["APD_SENSORS_DB_PARTITIONS"] = str(tmp_path)
+        readings = [
+            {
+                "id": "PythonVersion",
+                "collected_at": f"2020-0{month}-01T12:00:00",
+                "value": [3, month, 0, "final", 0],
+            }
+            for month in (1, 2, 3)
+        ]
+        body = "\n".join(json.dumps(reading) for reading in readings) + "\n"
+        data = self.ingest(api_server, api_key, body, "application/x-ndjson").json
+        assert data["inserted"] == 3
+        assert len(list(tmp_path.glob("sensor_data-*.sqlite"))) == 3
+
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            value = api_server.get(
+                "/historical/2020-01-01/2020-04-01", headers={"X-API-Key": api_key}
+            ).json
+        assert [reading["value"][1] for reading in value["sensors"]] == [1, 2, 3]
+
+    def test_changes_with_partitions(self, subject, api_server, api_key, tmp_path):
+        subject.config["APD_SENSORS_DB_PARTITIONS"] = str(tmp_path)
+        response = api_server.get(
+            "/changes", headers={"X-API-Key": api_key}, status=501
+        )
+        assert "monthly partitions" in response.json["error"]
+
+    def test_sensor_values_are_written_behind(
+        self, subject, api_server, api_key, tmp_path
+    ):
+        from apd.sensors import writebehind
+        from apd.sensors.sensors import CPULoad
+        from apd.sensors.timeseries import TimeSeriesStore
+
+        subject.config["APD_SENSORS_WRITE_BEHIND"] = "on"
+        subject.config["APD_SENSORS_TIMESERIES_PATH"] = str(tmp_path / "timeseries")
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [CPULoad()]
+            with mock.patch.object(CPULoad, "value", return_value=0.25):
+                for i in range(3):
+                    api_server.get("/sensors/", headers={"X-API-Key": api_key})
+        # Flushes the queue, as happens when the process exits
+        writebehind.close_all()
+        store = TimeSeriesStore(tmp_path / "timeseries")
+        readings = list(
+            store.read(
+                "CPULoad", datetime.datetime(2000, 1, 1), datetime.datetime.now()
+            )
+        )
+        # Later requests are within the minimum interval, so aren't stored
+        assert [value for collected_at, value in readings] == [0.25]
+
+    def test_sensor_reads_are_measured(self, api_server, api_key):
+        from apd.sensors import metrics, wsgi
+        from apd.sensors.exceptions import IntermittentSensorFailureError
+        from apd.sensors.sensors import CPULoad
+
+        metrics.sensor_reads.clear()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion(), CPULoad()]
+            with mock.patch.object(
+                CPULoad, "value", side_effect=IntermittentSensorFailureError("Busy")
+            ):
+                api_server.get("/sensors/", headers={"X-API-Key": api_key})
+        response = TestApp(wsgi.app).get("/metrics")
+        assert response.content_type == "text/plain"
+        assert (
+            'apd_sensor_reads_total{sensor="CPULoad",result="intermittent"} 1'
+            in response.text
+        )
+        assert (
+            'apd_sensor_reads_total{sensor="PythonVersion",result="success"} 1'
+            in response.text
+        )
+
+    def test_server_timing(self, subject, api_server, api_key, stored_values):
+        from apd.sensors import metrics
+        from apd.sensors.wsgi import time_requests
+
+        # The test database isn't created by database.create_engine
+        metrics.instrument_engines()
+        time_requests(subject)
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            response = api_server.get("/historical", headers={"X-API-Key": api_key})
+        phases = [
+            metric.split(";")[0]
+            for metric in response.headers["Server-Timing"].split(", ")
+        ]
+        assert sorted(phases) == ["db", "format", "rows", "serialise", "total"]
+
+        subject.config["APD_SENSORS_SERVER_TIMING"] = "off"
+        response = api_server.get("/historical", headers={"X-API-Key": api_key})
+        assert "Server-Timing" not in response.headers
+
+    def test_slow_requests_are_profiled(self, subject, api_server, api_key, tmp_path):
+        import pstats
+        from apd.sensors.wsgi import time_requests
+
+        time_requests(subject)
+        subject.config["APD_SENSORS_PROFILE_PATH"] = str(tmp_path)
+        subject.config["APD_SENSORS_PROFILE_THRESHOLD"] = "0"
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            api_server.get("/sensors/", headers={"X-API-Key": api_key})
+        (dump,) = tmp_path.glob("*.prof")
+        assert ".v31.sensor_values-" in dump.name
+        stats = pstats.Stats(str(dump))
+        assert any(
+            function == "sensor_values" for filename, line, function in stats.stats
+        )
+
+        subject.config["APD_SENSORS_PROFILE_THRESHOLD"] = "60"
+        api_server.get("/sensors/", headers={"X-API-Key": api_key})
+        assert len(list(tmp_path.glob("*.prof"))) == 1
+
+    def ingest(self, api_server, api_key, body, content_type, **kwargs):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion(), Temperature()]
+            return api_server.post(
+                "/ingest",
+                body,
+                headers={"X-API-Key": api_key, "Content-Type": content_type},
+                **kwargs,
+            )
+
+    def test_ingest_json_lines(self, api_server, api_key, db):
+        readings = [
+            {
+                "id": "PythonVersion",
+                "collected_at": f"2020-01-01T0{i}:00:00",
+                "value": [3, i, 0, "final", 0],
+            }
+            for i in range(3)
+        ]
+        body = "\n".join(json.dumps(reading) for reading in readings) + "\n"
+        data = self.ingest(api_server, api_key, body, "application/x-ndjson").json
+        assert data["inserted"] == 3
+        assert data["rows_per_second"] > 0
+
+        value = api_server.get(
+            "/historical/2020-01-01/2020-01-02", headers={"X-API-Key": api_key}
+        ).json
+        assert [reading["value"][1] for reading in value["sensors"]] == [0, 1, 2]
+
+    def test_ingest_msgpack(self, api_server, api_key, db):
+        msgpack = pytest.importorskip("msgpack")
+        readings = [
+            {
+                "id": "Temperature",
+                "collected_at": "2020-01-01T12:00:00+00:00",
+                "value": {"magnitude": 21.5, "unit": "degC"},
+            }
+        ]
+        body = msgpack.packb(readings)
+        data = self.ingest(api_server, api_key, body, "application/msgpack").json
+        assert data["inserted"] == 1
+
+        from apd.sensors.database import sensor_values
+
+        [row] = db.session.execute(sensor_values.select()).fetchall()
+        assert row.data == {"magnitude": 21.5, "unit": "degree_Celsius"}
+        expected = datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        assert row.collected_at == expected.astimezone().replace(tzinfo=None)
+
+    def test_ingest_json_array(self, api_server, api_key, db):
+        readings = [
+            {
+                "id": "PythonVersion",
+                "collected_at": f"2020-01-01T0{i}:00:00Z",
+                "value": [3, i, 0, "final", 0],
+            }
+            for i in range(3)
+        ]
+        body = json.dumps(readings, indent=2)
+        data = self.ingest(api_server, api_key, body, "application/json").json
+        assert data["inserted"] == 3
+
+        from apd.sensors.database import sensor_values
+
+        rows = db.session.execute(sensor_values.select()).fetchall()
+        expected = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        assert rows[0].collected_at == expected.astimezone().replace(tzinfo=None)
+
+    def test_ingest_limits_chunked_bodies(self, subject, api_key, db):
+        body = b'{"id": "PythonVersion", "value": [3, 8, 0, "final", 0]}\n' * 10
+        client = subject.test_client()
+        with mock.patch("apd.sensors.ingest.MAX_INGEST_SIZE", len(body) - 1):
+            # Without a Content-Length, the body is read until the end
+            response = client.post(
+                "/ingest",
+                input_stream=io.BytesIO(body),
+                headers={
+                    "X-API-Key": api_key,
+                    "Content-Type": "application/x-ndjson",
+                },
+                environ_overrides={
+                    "CONTENT_LENGTH": "",
+                    "HTTP_TRANSFER_ENCODING": "chunked",
+                    "wsgi.input_terminated": True,
+                },
+            )
+        assert response.status_code == 413
+
+    def test_ingest_is_all_or_nothing(self, api_server, api_key, db):
+        body = (
+            '{"id": "PythonVersion", "value": [3, 8, 0, "final", 0]}\n'
+            '{"id": "Temperature", "value": {"magnitude": 20}}\n'
+        )
+        response = self.ingest(
+            api_server, api_key, body, "application/x-ndjson", status=400
+        )
+        assert response.json["error"] == "Reading 2: Invalid value for Temperature"
+
+        from apd.sensors.database import sensor_values
+
+        assert db.session.execute(sensor_values.select()).fetchall() == []
+
+    def test_ingest_rejects_invalid_data(self, api_server, api_key, db):
+        for body, content_type in [
+            ('{"id": "Unknown", "value": 1}', "application/x-ndjson"),
+            ("[3, 8]", "application/x-ndjson"),
+            ("\n{nonsense", "application/x-ndjson"),
+            ('{"id": "PythonVersion", "value": 1}', "text/plain"),
+        ]:
+            response = self.ingest(api_server, api_key, body, content_type, status=400)
+            assert "error" in response.json
+
+    def test_ingest_requires_api_key(self, api_server, db):
+        api_server.post("/ingest", b"", status=403)
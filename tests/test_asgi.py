@@ -0,0 +1,469 @@
+import asyncio
+import datetime
+import json
+import time
+import uuid
+from unittest import mock
+
+import flask
+import pytest
+from webtest import TestApp
+
+from apd.sensors.asgi import create_app
+from apd.sensors.base import JSONSensor
+from apd.sensors.sensors import PythonVersion
+from apd.sensors.wsgi import set_up_config
+from apd.sensors.wsgi import v31
+
+from .test_api_server import HistoricalBoolSensor
+from .test_utils import FailingSensor
+
+
+class SlowSensor(JSONSensor[bool]):
+    title = "Sensor which is slow"
+    name = "SlowSensor"
+
+    def value(self) -> bool:
+        time.sleep(0.5)
+        return True
+
+    @classmethod
+    def format(cls, value: bool) -> str:
+        return "Yes" if value else "No"
+
+
+class AsyncSensor(JSONSensor[bool]):
+    title = "Sensor which is read asynchronously"
+    name = "AsyncSensor"
+
+    def value(self) -> bool:
+        raise AssertionError("Blocking read should not be used")
+
+    async def value_async(self) -> bool:
+        await asyncio.sleep(0.01)
+        return False
+
+    @classmethod
+    def format(cls, value: bool) -> str:
+        return "Yes" if value else "No"
+
+
+def call(app, path, api_key=None, method="GET", headers=None, raw=False, body=b""):
+    path, _, query_string = path.partition("?")
+
+    async def run():
+        messages = []
+        raw_headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in (headers or {}).items()
+        ]
+        if api_key is not None:
+            raw_headers.append((b"x-api-key", api_key.encode("latin-1")))
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "headers": raw_headers,
+            "query_string": query_string.encode("latin-1"),
+        }
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        await app(scope, receive, send)
+        return messages
+
+    start, body = asyncio.run(run())
+    assert start["type"] == "http.response.start"
+    if raw:
+        return start["status"], dict(start["headers"]), body["body"]
+    data = json.loads(body["body"]) if body["body"] else None
+    return start["status"], dict(start["headers"]), data
+
+
+def without_times(data):
+    for key in ("sensors", "errors"):
+        for item in data[key]:
+            del item["collected_at"]
+    return data
+
+
+@pytest.fixture
+def api_key():
+    return uuid.uuid4().hex
+
+
+@pytest.fixture
+def db_uri(tmp_path):
+    return f"sqlite:///{tmp_path / 'sensor_data.sqlite'}"
+
+
+@pytest.fixture
+def db_session(db_uri):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from apd.sensors.database import metadata
+
+    engine = create_engine(db_uri)
+    metadata.create_all(engine)
+    session = sessionmaker(engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def subject(api_key, db_uri):
+    return create_app(
+        {
+            "APD_SENSORS_API_KEY": api_key,
+            "APD_SENSORS_DEPLOYMENT_ID": "8f1b57faa04b430c81decbbeee9e300c",
+            "APD_SENSORS_DB_URI": db_uri,
+        }
+    )
+
+
+@pytest.fixture
+def flask_api(api_key):
+    app = flask.Flask("testapp")
+    app.register_blueprint(v31.version)
+    set_up_config(
+        {
+            "APD_SENSORS_API_KEY": api_key,
+            "APD_SENSORS_DEPLOYMENT_ID": "8f1b57faa04b430c81decbbeee9e300c",
+        },
+        to_configure=app,
+    )
+    return TestApp(app)
+
+
+def test_api_key_is_required_config_option():
+    with pytest.raises(
+        ValueError, match="Missing config variables: APD_SENSORS_API_KEY"
+    ):
+        create_app({"APD_SENSORS_DEPLOYMENT_ID": ""})
+
+
+def test_sensor_values_require_correct_api_key(subject):
+    status, headers, data = call(subject, "/v/3.1/sensors/", api_key="wrong_key")
+    assert status == 403
+    assert data["error"] == "Supply API key in X-API-Key header"
+    status, headers, data = call(subject, "/v/3.1/sensors/")
+    assert status == 403
+
+
+def test_unknown_path(subject, api_key):
+    status, headers, data = call(subject, "/v/3.1/nonsense", api_key=api_key)
+    assert status == 404
+
+
+def test_only_get_is_allowed(subject, api_key):
+    status, headers, data = call(
+        subject, "/v/3.1/sensors/", api_key=api_key, method="POST"
+    )
+    assert status == 405
+
+
+def test_deployment_id(subject, flask_api):
+    status, headers, data = call(subject, "/v/3.1/deployment_id")
+    assert status == 200
+    assert data == flask_api.get("/deployment_id").json
+
+
+def test_conditional_requests(subject, flask_api):
+    status, headers, data = call(subject, "/v/3.1/deployment_id")
+    expected = flask_api.get("/deployment_id")
+    assert headers[b"etag"].decode("latin-1") == expected.headers["ETag"]
+    assert headers[b"cache-control"] == b"public, max-age=300"
+
+    status, headers, data = call(
+        subject,
+        "/v/3.1/deployment_id",
+        headers={"If-None-Match": 'W/"other", ' + expected.headers["ETag"]},
+    )
+    assert status == 304
+    assert data is None
+    assert b"content-length" not in headers
+
+
+def test_sensor_types(subject, flask_api, api_key):
+    status, headers, data = call(subject, "/v/3.1/info/sensors", api_key=api_key)
+    expected = flask_api.get("/info/sensors", headers={"X-API-Key": api_key}).json
+    assert data == expected
+
+
+@pytest.mark.functional
+def test_sensor_values_match_wsgi_api(subject, flask_api, api_key):
+    def sensors():
+        return [FailingSensor(2), FailingSensor(2, ValueError), PythonVersion()]
+
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.side_effect = sensors
+        status, headers, data = call(subject, "/v/3.1/sensors/", api_key=api_key)
+        expected = flask_api.get("/sensors/", headers={"X-API-Key": api_key}).json
+    assert status == 200
+    assert headers[b"content-security-policy"] == b"default-src 'none'"
+    assert without_times(data) == without_times(expected)
+    assert len(data["errors"]) == 2
+
+
+def test_single_sensor(subject, api_key):
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [FailingSensor(1), PythonVersion()]
+        status, headers, data = call(
+            subject, "/v/3.1/sensors/PythonVersion", api_key=api_key
+        )
+    assert [sensor["id"] for sensor in data["sensors"]] == ["PythonVersion"]
+
+
+@pytest.mark.functional
+def test_sensors_are_read_concurrently(subject, api_key):
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [SlowSensor(), SlowSensor(), SlowSensor()]
+        started = time.monotonic()
+        status, headers, data = call(subject, "/v/3.1/sensors/", api_key=api_key)
+        elapsed = time.monotonic() - started
+    assert len(data["sensors"]) == 3
+    assert elapsed < 1.2
+
+
+def test_dht_sensors_are_read_in_turn(subject, api_key):
+    from apd.sensors.sensors import RelativeHumidity, Temperature
+
+    from .test_dht import FakeDHT
+
+    dht = FakeDHT()
+    with mock.patch("apd.sensors.sensors.dht_sensor", dht), mock.patch(
+        "apd.sensors.cli.get_sensors"
+    ) as get_sensors:
+        get_sensors.return_value = [Temperature(), PythonVersion(), RelativeHumidity()]
+        status, headers, data = call(subject, "/v/3.1/sensors/", api_key=api_key)
+    assert [sensor["id"] for sensor in data["sensors"]] == [
+        "Temperature",
+        "PythonVersion",
+        "RelativeHumidity",
+    ]
+    assert dht.most_active == 1
+
+
+def test_async_sensors_are_not_run_in_executor(subject, api_key):
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [AsyncSensor()]
+        status, headers, data = call(subject, "/v/3.1/sensors/", api_key=api_key)
+    assert data["errors"] == []
+    assert data["sensors"][0]["human_readable"] == "No"
+
+
+def test_historical_sensor(subject, api_key, db_session):
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [HistoricalBoolSensor()]
+        status, headers, data = call(
+            subject, "/v/3.1/historical/2020-01-01/2020-01-02", api_key=api_key
+        )
+    assert len(data["sensors"]) == 24
+    assert data["sensors"][0] == {
+        "collected_at": "2020-01-01T00:00:00",
+        "human_readable": "Yes",
+        "id": "HistoricalBoolSensor",
+        "title": "Sensor which has past data",
+        "value": True,
+    }
+
+
+def test_historical_with_data(subject, api_key, db_session):
+    from apd.sensors.database import store_sensor_data
+
+    store_sensor_data(PythonVersion, [3, 9, 0, "final", 1], db_session)
+    db_session.commit()
+
+    status, headers, data = call(
+        subject, "/v/3.1/sensors/PythonVersion/historical", api_key=api_key
+    )
+    assert len(data["sensors"]) == 1
+    assert data["sensors"][0]["human_readable"] == "3.9"
+
+
+def test_lifespan(subject):
+    async def run():
+        incoming = asyncio.Queue()
+        sent = []
+        await incoming.put({"type": "lifespan.startup"})
+        await incoming.put({"type": "lifespan.shutdown"})
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await subject({"type": "lifespan"}, incoming.get, send)
+        return sent
+
+    assert asyncio.run(run()) == [
+        "lifespan.startup.complete",
+        "lifespan.shutdown.complete",
+    ]
+
+
+def test_historical_encodings(subject, api_key, db_session):
+    import gzip
+
+    msgpack = pytest.importorskip("msgpack")
+
+    path = "/v/3.1/historical/2020-01-01/2020-01-08"
+    headers = {"Accept": "application/msgpack", "Accept-Encoding": "gzip"}
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [HistoricalBoolSensor()]
+        status, plain_headers, plain = call(subject, path, api_key=api_key)
+        status, response_headers, body = call(
+            subject,
+            f"{path}?layout=columns",
+            api_key=api_key,
+            headers=headers,
+            raw=True,
+        )
+    assert plain_headers[b"content-type"] == b"application/json"
+    assert response_headers[b"content-type"] == b"application/msgpack"
+    assert response_headers[b"content-encoding"] == b"gzip"
+    [sensor] = msgpack.unpackb(gzip.decompress(body))["sensors"]
+    assert sensor["value"] == [reading["value"] for reading in plain["sensors"]]
+
+
+def test_changes(subject, api_key, db_session):
+    from apd.sensors.database import store_sensor_data
+
+    for i in range(3):
+        store_sensor_data(PythonVersion, [3, i, 0, "final", 1], db_session)
+    db_session.commit()
+
+    status, headers, data = call(subject, "/v/3.1/changes?limit=2", api_key=api_key)
+    assert status == 200
+    assert data["deployment_id"] == "8f1b57faa04b430c81decbbeee9e300c"
+    assert len(data["changes"]) == 2
+    assert data["more"] is True
+    status, headers, data = call(
+        subject,
+        f"/v/3.1/changes?since_id={data['high_water_mark']}&limit=2",
+        api_key=api_key,
+    )
+    assert [change["value"][1] for change in data["changes"]] == [2]
+    assert data["more"] is False
+
+    status, headers, data = call(subject, "/v/3.1/changes?limit=x", api_key=api_key)
+    assert status == 400
+
+
+def test_latest_values(subject, api_key, db_session):
+    from apd.sensors.database import store_sensor_data
+
+    for i in range(3):
+        store_sensor_data(PythonVersion, [3, i, 0, "final", 1], db_session)
+    db_session.commit()
+
+    status, headers, data = call(subject, "/v/3.1/latest", api_key=api_key)
+    assert status == 200
+    assert [(reading["id"], reading["value"][1]) for reading in data["sensors"]] == [
+        ("PythonVersion", 2)
+    ]
+    path = "/v/3.1/sensors/PythonVersion/latest?human_readable=no"
+    status, headers, data = call(subject, path, api_key=api_key)
+    assert "human_readable" not in data["sensors"][0]
+
+
+def test_metrics(subject, api_key):
+    from apd.sensors import metrics
+
+    metrics.sensor_reads.clear()
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [PythonVersion()]
+        call(subject, "/v/3.1/sensors/", api_key=api_key)
+    status, headers, body = call(subject, "/metrics", raw=True)
+    assert status == 200
+    assert headers[b"content-type"].startswith(b"text/plain; version=0.0.4")
+    assert b'apd_sensor_reads_total{sensor="PythonVersion",result="success"} 1' in body
+
+
+def test_ingest(subject, api_key, db_session):
+    body = b"".join(
+        json.dumps(
+            {
+                "id": "PythonVersion",
+                "collected_at": "2020-01-01",
+                "value": [3, i, 0, "final", 0],
+            }
+        ).encode("utf-8")
+        + b"\n"
+        for i in range(3)
+    )
+    headers = {"Content-Type": "application/x-ndjson"}
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [PythonVersion()]
+        status, response_headers, data = call(
+            subject, "/v/3.1/ingest", api_key, "POST", headers, body=body
+        )
+        assert status == 200
+        assert data["inserted"] == 3
+
+        status, response_headers, data = call(
+            subject, "/v/3.1/ingest", api_key, "POST", headers, body=b"[1]"
+        )
+        assert status == 400
+
+        status, response_headers, data = call(subject, "/v/3.1/ingest", api_key)
+        assert status == 405
+        assert response_headers[b"allow"] == b"POST"
+
+    from apd.sensors.database import sensor_values
+
+    assert len(db_session.execute(sensor_values.select()).fetchall()) == 3
+
+
+def test_ingest_into_partitions(api_key, tmp_path):
+    subject = create_app(
+        {"APD_SENSORS_API_KEY": api_key, "APD_SENSORS_DB_PARTITIONS": str(tmp_path)}
+    )
+    body = b"".join(
+        json.dumps(
+            {
+                "id": "PythonVersion",
+                "collected_at": f"2020-0{month}-01",
+                "value": [3, month, 0, "final", 0],
+            }
+        ).encode("utf-8")
+        + b"\n"
+        for month in (1, 2)
+    )
+    headers = {"Content-Type": "application/x-ndjson"}
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [PythonVersion()]
+        status, response_headers, data = call(
+            subject, "/v/3.1/ingest", api_key, "POST", headers, body=body
+        )
+        assert status == 200
+        assert data["inserted"] == 2
+
+        status, headers, data = call(
+            subject, "/v/3.1/historical/2020-01-01/2020-03-01", api_key=api_key
+        )
+    assert [reading["value"][1] for reading in data["sensors"]] == [1, 2]
+
+    status, headers, data = call(subject, "/v/3.1/changes", api_key=api_key)
+    assert status == 501
+
+
+def test_historical_from_timeseries(api_key, tmp_path):
+    from apd.sensors.sensors import CPULoad
+    from apd.sensors.timeseries import TimeSeriesStore
+
+    TimeSeriesStore(tmp_path).append("CPULoad", datetime.datetime(2020, 1, 1), 0.5)
+    subject = create_app(
+        {"APD_SENSORS_API_KEY": api_key, "APD_SENSORS_TIMESERIES_PATH": str(tmp_path)}
+    )
+    with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+        get_sensors.return_value = [CPULoad()]
+        status, headers, data = call(
+            subject, "/v/3.1/historical/2020-01-01/2020-01-02", api_key=api_key
+        )
+    assert status == 200
+    [reading] = data["sensors"]
+    assert reading["value"] == 0.5
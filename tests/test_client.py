@@ -0,0 +1,169 @@
+import datetime
+import socket
+import threading
+import uuid
+from unittest import mock
+
+import flask
+import pytest
+
+from apd.sensors import client
+from apd.sensors.sensors import PythonVersion
+from apd.sensors.wsgi import serve, set_up_config
+from apd.sensors.wsgi import v31
+
+
+@pytest.fixture(scope="module")
+def api_key():
+    return uuid.uuid4().hex
+
+
+@pytest.fixture(scope="module")
+def db():
+    from flask_sqlalchemy import SQLAlchemy
+    from apd.sensors.database import metadata
+    from apd.sensors import wsgi
+
+    original_db = wsgi.db
+    wsgi.db = SQLAlchemy(metadata=metadata)
+    yield wsgi.db
+    wsgi.db = original_db
+
+
+def start_node(api_key, db, db_path, hours):
+    """Serve the v3.1 API with stored values at the given hours of 2020-01-01"""
+    from apd.sensors.database import sensor_values
+
+    app = flask.Flask("testnode")
+    app.register_blueprint(v31.version, url_prefix="/v/3.1")
+    set_up_config(
+        {
+            "APD_SENSORS_API_KEY": api_key,
+            "APD_SENSORS_DEPLOYMENT_ID": uuid.uuid4().hex,
+            "APD_SENSORS_DB_URI": f"sqlite:///{db_path}",
+        },
+        to_configure=app,
+    )
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        for hour in hours:
+            db.session.execute(
+                sensor_values.insert().values(
+                    sensor_name="PythonVersion",
+                    collected_at=datetime.datetime(2020, 1, 1, hour),
+                    data=[3, hour, 0, "final", 0],
+                )
+            )
+        db.session.commit()
+        db.session.remove()
+
+    sock = serve.bind({"APD_SENSORS_HOST": "127.0.0.1", "APD_SENSORS_PORT": 0})
+    server = serve.create_server(app, sock, threads=4)
+    # waitress can only be closed from the thread that runs it, so nodes
+    # are left to stop with the test process
+    threading.Thread(target=server.run, daemon=True).start()
+    host, port = sock.getsockname()
+    return f"http://{host}:{port}", app.config["APD_SENSORS_DEPLOYMENT_ID"]
+
+
+@pytest.fixture(scope="module")
+def nodes(api_key, db, tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("nodes")
+    return [
+        start_node(api_key, db, tmp_path / "even.sqlite", [0, 2, 4]),
+        start_node(api_key, db, tmp_path / "odd.sqlite", [1, 3, 5]),
+    ]
+
+
+@pytest.fixture
+def unresponsive_node():
+    # Connections are accepted by the kernel, but requests are never answered
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    host, port = sock.getsockname()
+    yield f"http://{host}:{port}"
+    sock.close()
+
+
+@pytest.fixture
+def subject(nodes, api_key):
+    with client.Client({url: api_key for url, deployment_id in nodes}) as subject:
+        yield subject
+
+
+@pytest.mark.functional
+class TestClient:
+    def test_deployment_ids(self, subject, nodes):
+        result = subject.deployment_ids()
+        assert result.values == dict(nodes)
+        assert result.errors == {}
+
+    def test_sensors(self, subject, nodes):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            result = subject.sensors()
+        for url, deployment_id in nodes:
+            [value] = result.values[url]["sensors"]
+            assert value["id"] == "PythonVersion"
+
+    def test_historical_streams_are_merged(self, subject, nodes):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion()]
+            result = subject.historical("2020-01-01", "2020-01-02")
+        merged = list(client.merge(result.values))
+        assert [reading["value"][1] for url, reading in merged] == list(range(6))
+        even, odd = [url for url, deployment_id in nodes]
+        assert [url for url, reading in merged] == [even, odd] * 3
+
+    def test_connections_are_reused(self, subject, nodes):
+        url, deployment_id = nodes[0]
+        pool = subject.pools[url]
+        subject.get_json(url, "/deployment_id")
+        [connection] = pool.idle
+        subject.get_json(url, "/deployment_id")
+        assert pool.idle == [connection]
+
+    def test_closed_connections_are_replaced(self, subject, nodes):
+        url, deployment_id = nodes[0]
+        pool = subject.pools[url]
+        subject.get_json(url, "/deployment_id")
+        # Simulate the node closing an idle connection
+        pool.idle[0].sock.shutdown(socket.SHUT_RDWR)
+        assert subject.get_json(url, "/deployment_id") == {
+            "deployment_id": deployment_id
+        }
+
+    def test_error_responses(self, nodes):
+        url, deployment_id = nodes[0]
+        with client.Client({url: "wrong key"}) as subject:
+            result = subject.sensors()
+        assert result.values == {}
+        assert str(result.errors[url]) == f"{url} returned 403 for /sensors/"
+
+    def test_unresponsive_node_times_out(self, nodes, api_key, unresponsive_node):
+        node_keys = {url: api_key for url, deployment_id in nodes}
+        node_keys[unresponsive_node] = api_key
+        with client.Client(node_keys, timeout=0.5) as subject:
+            result = subject.deployment_ids()
+        assert result.values == dict(nodes)
+        assert isinstance(result.errors[unresponsive_node], client.NodeError)
+
+
+def test_merge_sorts_each_node():
+    readings = {
+        "a": [{"collected_at": "2020-01-01T02:00:00"}, {"collected_at": "2020-01-01"}],
+        "b": [{"collected_at": "2020-01-01T01:00:00.5"}],
+    }
+    merged = [(url, r["collected_at"]) for url, r in client.merge(readings)]
+    assert merged == [
+        ("a", "2020-01-01"),
+        ("b", "2020-01-01T01:00:00.5"),
+        ("a", "2020-01-01T02:00:00"),
+    ]
+
+
+def test_unsupported_url():
+    with pytest.raises(ValueError):
+        client.ConnectionPool("ftp://example.com")
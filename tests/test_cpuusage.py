@@ -25,6 +25,15 @@ class TestCPULoadFormatter:
         assert subject(1) == "100.0%"
 
 
+class TestCPULoadBatchFormatter:
+    def test_matches_format(self, sensor):
+        values = [0.05, 0.031415926, 1, 0, 0.0005, 0.0015, 0.9999]
+        assert sensor.format_many(values) == [sensor.format(v) for v in values]
+
+    def test_empty(self, sensor):
+        assert sensor.format_many([]) == []
+
+
 class TestCPULoadValue:
     @pytest.fixture
     def subject(self, sensor):
@@ -0,0 +1,303 @@
+import datetime
+import threading
+from unittest import mock
+
+import pytest
+
+from apd.sensors.database import (
+    PartitionRouter,
+    create_engine,
+    get_router,
+    latest_stored_values,
+    latest_value_upsert,
+    latest_values,
+    metadata,
+    next_month,
+    parse_pragmas,
+    rebuild_latest_values,
+    sensor_values,
+    store_readings,
+    update_latest_values,
+    values_since,
+)
+
+
+def row(month, day, value):
+    return {
+        "sensor_name": "CPULoad",
+        "collected_at": datetime.datetime(2020, month, day),
+        "data": value,
+    }
+
+
+@pytest.fixture
+def subject(tmp_path):
+    router = PartitionRouter(str(tmp_path))
+    yield router
+    router.dispose()
+
+
+def test_values_are_stored_in_monthly_partitions(subject, tmp_path):
+    subject.store_readings([row(1, 31, 0.1), row(2, 1, 0.2), row(12, 1, 0.3)])
+    assert sorted(path.name for path in tmp_path.glob("*.sqlite")) == [
+        "sensor_data-2020-01.sqlite",
+        "sensor_data-2020-02.sqlite",
+        "sensor_data-2020-12.sqlite",
+    ]
+
+
+def test_queries_only_open_overlapping_partitions(subject):
+    subject.store_readings([row(month, 15, month / 10) for month in (1, 2, 3, 4)])
+    # Partitions are found from their filenames, so start afresh
+    subject.dispose()
+    subject = PartitionRouter(str(subject.directory))
+    values = list(
+        subject.stored_values(
+            datetime.datetime(2020, 2, 20), datetime.datetime(2020, 3, 20)
+        )
+    )
+    assert values == [("CPULoad", datetime.datetime(2020, 3, 15), 0.3)]
+    assert sorted(path.name for path in subject.engines) == [
+        "sensor_data-2020-02.sqlite",
+        "sensor_data-2020-03.sqlite",
+    ]
+    subject.dispose()
+
+
+def test_timezone_aware_ranges_are_compared_in_local_time(subject):
+    subject.store_readings([row(month, 15, month / 10) for month in (1, 2, 3)])
+    start = datetime.datetime(2020, 2, 20).astimezone(datetime.timezone.utc)
+    end = datetime.datetime(2020, 3, 20).astimezone(datetime.timezone.utc)
+    assert [path.name for path in subject.overlapping(start, end)] == [
+        "sensor_data-2020-02.sqlite",
+        "sensor_data-2020-03.sqlite",
+    ]
+    assert list(subject.stored_values(start, end)) == [
+        ("CPULoad", datetime.datetime(2020, 3, 15), 0.3)
+    ]
+
+
+def test_routers_are_shared_by_directory_and_pragmas(tmp_path):
+    router = get_router(str(tmp_path), {"synchronous": "OFF"})
+    try:
+        assert get_router(str(tmp_path), {"synchronous": "OFF"}) is router
+        other = get_router(str(tmp_path), {"synchronous": "FULL"})
+        assert other is not router
+        assert other.pragmas == {"synchronous": "FULL"}
+    finally:
+        router.dispose()
+        other.dispose()
+
+
+def test_partitions_are_queried_concurrently(subject):
+    subject.store_readings([row(month, 1, month) for month in (1, 2, 3)])
+    barrier = threading.Barrier(3, timeout=5)
+    query_partition = subject.query_partition
+
+    def wait_for_all(*args):
+        # Only passes if all three partitions are queried at the same time
+        barrier.wait()
+        return query_partition(*args)
+
+    with mock.patch.object(subject, "query_partition", wait_for_all):
+        values = subject.stored_values(
+            datetime.datetime(2020, 1, 1), datetime.datetime(2020, 12, 1), ["CPULoad"]
+        )
+        assert [value for name, collected_at, value in values] == [1, 2, 3]
+
+
+def test_drop_before(subject, tmp_path):
+    subject.store_readings([row(month, 1, month) for month in (1, 2, 3)])
+    dropped = subject.drop_before(datetime.datetime(2020, 2, 15))
+    assert [path.name for path in dropped] == ["sensor_data-2020-01.sqlite"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "sensor_data-2020-02.sqlite",
+        "sensor_data-2020-02.sqlite-shm",
+        "sensor_data-2020-02.sqlite-wal",
+        "sensor_data-2020-03.sqlite",
+        "sensor_data-2020-03.sqlite-shm",
+        "sensor_data-2020-03.sqlite-wal",
+    ]
+
+
+def test_latest_values_come_from_newest_partition(subject):
+    subject.store_readings(
+        [row(1, 31, 0.1), row(2, 1, 0.2), {**row(1, 1, True), "sensor_name": "AC"}]
+    )
+    assert subject.latest_values() == [
+        ("AC", datetime.datetime(2020, 1, 1), True),
+        ("CPULoad", datetime.datetime(2020, 2, 1), 0.2),
+    ]
+    assert subject.latest_values(["CPULoad"]) == [
+        ("CPULoad", datetime.datetime(2020, 2, 1), 0.2)
+    ]
+
+
+def test_next_month():
+    assert next_month(datetime.datetime(2020, 12, 1)) == datetime.datetime(2021, 1, 1)
+    assert next_month(datetime.datetime(2020, 1, 1)) == datetime.datetime(2020, 2, 1)
+
+
+class TestLatestValues:
+    @pytest.fixture
+    def connection(self):
+        engine = create_engine("sqlite://")
+        metadata.create_all(engine)
+        with engine.begin() as connection:
+            yield connection
+        engine.dispose()
+
+    def test_writes_update_latest_values(self, connection):
+        store_readings(connection, [row(1, 2, 0.2), row(1, 1, 0.1)])
+        assert latest_stored_values(connection) == [
+            ("CPULoad", datetime.datetime(2020, 1, 2), 0.2)
+        ]
+        # Older values don't replace newer ones
+        store_readings(connection, [row(1, 1, 0.05)])
+        store_readings(connection, [row(1, 3, 0.3)])
+        assert latest_stored_values(connection) == [
+            ("CPULoad", datetime.datetime(2020, 1, 3), 0.3)
+        ]
+
+    def test_concurrent_insert_is_updated(self, connection):
+        store_readings(connection, [row(1, 1, 0.1)])
+        execute = connection.execute
+        calls = []
+
+        def miss_first_update(statement, *args, **kwargs):
+            calls.append(statement)
+            if len(calls) == 1:
+                # As if another writer inserted the row after this update ran
+                return mock.Mock(rowcount=0)
+            return execute(statement, *args, **kwargs)
+
+        with mock.patch.object(connection, "execute", miss_first_update):
+            update_latest_values(connection, [row(1, 2, 0.2)])
+        assert latest_stored_values(connection) == [
+            ("CPULoad", datetime.datetime(2020, 1, 2), 0.2)
+        ]
+        # The failed insert doesn't abort the transaction
+        store_readings(connection, [row(1, 3, 0.3)])
+        assert latest_stored_values(connection) == [
+            ("CPULoad", datetime.datetime(2020, 1, 3), 0.3)
+        ]
+
+    def test_postgresql_upsert(self):
+        from sqlalchemy.dialects import postgresql
+
+        sql = str(
+            latest_value_upsert(row(1, 1, 0.1)).compile(dialect=postgresql.dialect())
+        )
+        assert "ON CONFLICT (sensor_name) DO UPDATE" in sql
+        assert "WHERE latest_values.collected_at <= excluded.collected_at" in sql
+
+    def test_postgresql_change_feed_waits_for_writers(self):
+        import sqlalchemy
+
+        connection = mock.Mock(spec=sqlalchemy.engine.Connection)
+        connection.dialect = mock.Mock()
+        connection.dialect.name = "postgresql"
+        connection.execute.return_value = []
+        values_since(connection, 0, 10)
+        lock, query = connection.execute.call_args_list
+        assert str(lock.args[0]) == "LOCK TABLE recorded_values IN SHARE MODE"
+        assert "recorded_values.id >" in str(query.args[0])
+
+    def test_rebuild_latest_values(self, connection):
+        store_readings(
+            connection,
+            [row(1, 1, 0.1), row(1, 2, 0.2), {**row(1, 1, True), "sensor_name": "AC"}],
+        )
+        connection.execute(latest_values.delete())
+        assert latest_stored_values(connection) == []
+        assert rebuild_latest_values(connection) == 2
+        assert latest_stored_values(connection) == [
+            ("AC", datetime.datetime(2020, 1, 1), True),
+            ("CPULoad", datetime.datetime(2020, 1, 2), 0.2),
+        ]
+        assert latest_stored_values(connection, ["AC"]) == [
+            ("AC", datetime.datetime(2020, 1, 1), True)
+        ]
+
+
+class TestCreateEngine:
+    @pytest.fixture
+    def db_uri(self, tmp_path):
+        return f"sqlite:///{tmp_path / 'sensor_data.sqlite'}"
+
+    def test_pragmas(self, db_uri):
+        engine = create_engine(db_uri, {"synchronous": "FULL"})
+        with engine.connect() as connection:
+            assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+            # FULL
+            assert connection.execute("PRAGMA synchronous").scalar() == 2
+            assert connection.execute("PRAGMA mmap_size").scalar() > 0
+        engine.dispose()
+
+    def test_connections_are_pooled(self, db_uri):
+        engine = create_engine(db_uri)
+        with engine.connect() as connection:
+            first = connection.connection.connection
+        with engine.connect() as connection:
+            assert connection.connection.connection is first
+        engine.dispose()
+
+    def test_readers_are_not_blocked_by_writers(self, db_uri):
+        from apd.sensors.database import metadata
+
+        engine = create_engine(db_uri, {"busy_timeout": "100"})
+        metadata.create_all(engine)
+        writer = engine.connect()
+        transaction = writer.begin()
+        writer.execute(
+            sensor_values.insert().values(
+                sensor_name="CPULoad", collected_at=datetime.datetime.now(), data=0.5
+            )
+        )
+        # The uncommitted write isn't visible, but doesn't block the read
+        with engine.connect() as reader:
+            assert reader.execute(sensor_values.select()).fetchall() == []
+        transaction.commit()
+        writer.close()
+        engine.dispose()
+
+    def test_in_memory_database_is_shared(self):
+        from apd.sensors.database import metadata
+
+        engine = create_engine("sqlite://")
+        metadata.create_all(engine)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(
+                engine.execute(sensor_values.select()).fetchall()
+            )
+        )
+        thread.start()
+        thread.join()
+        assert results == [[]]
+
+    def test_parse_pragmas(self):
+        assert parse_pragmas(None) == {}
+        assert parse_pragmas("synchronous=OFF, cache_size = -2000") == {
+            "synchronous": "off",
+            "cache_size": "-2000",
+        }
+        with pytest.raises(ValueError):
+            parse_pragmas("synchronous=OFF; DROP TABLE recorded_values")
+
+
+def test_wsgi_engines_are_pooled(tmp_path):
+    import flask
+    from sqlalchemy.pool import QueuePool
+    from apd.sensors import wsgi
+
+    app = flask.Flask("testapp")
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'data.sqlite'}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["APD_SENSORS_SQLITE_PRAGMAS"] = "synchronous=OFF"
+    db = wsgi.TunedSQLAlchemy(app)
+    with app.app_context():
+        assert isinstance(db.engine.pool, QueuePool)
+        assert db.session.execute("PRAGMA synchronous").scalar() == 0
+        db.session.remove()
+        db.engine.dispose()
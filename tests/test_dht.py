@@ -1,5 +1,13 @@
+import json
+import sys
+import threading
+import time
+from unittest import mock
+
+from click.testing import CliRunner
 import pytest
 
+from apd.sensors.cli import show_sensors
 from apd.sensors.sensors import Temperature, RelativeHumidity, ureg
 
 
@@ -13,6 +21,71 @@ def humidity_sensor():
     return RelativeHumidity()
 
 
+class FakeDHT:
+    """A DHT interface that records how many threads read it at once"""
+
+    def __init__(self):
+        self.active = self.most_active = 0
+        self.lock = threading.Lock()
+
+    def read(self, value):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        return value
+
+    @property
+    def temperature(self):
+        return self.read(21.0)
+
+    @property
+    def humidity(self):
+        return self.read(45.0)
+
+
+class TestSharedInterface:
+    def test_parallel_reads_are_serialised(self):
+        dht = FakeDHT()
+        with mock.patch("apd.sensors.sensors.dht_sensor", dht), mock.patch(
+            "apd.sensors.cli.get_sensors"
+        ) as get_sensors:
+            get_sensors.return_value = [Temperature(), RelativeHumidity()] * 2
+            result = CliRunner().invoke(
+                show_sensors, ["--parallel", "--format", "ndjson"]
+            )
+        assert result.exit_code == 0
+        ids = [json.loads(line)["id"] for line in result.stdout.splitlines()]
+        assert sorted(ids) == ["RelativeHumidity"] * 2 + ["Temperature"] * 2
+        assert dht.most_active == 1
+
+    def test_interface_is_set_up_once(self):
+        created = []
+
+        def slow_dht(pin):
+            created.append(pin)
+            time.sleep(0.05)
+            return FakeDHT()
+
+        modules = {
+            "adafruit_dht": mock.Mock(DHT22=slow_dht),
+            "board": mock.Mock(D20="D20"),
+        }
+        with mock.patch("apd.sensors.sensors.dht_sensor", None), mock.patch.dict(
+            sys.modules, modules
+        ):
+            threads = [
+                threading.Thread(target=lambda: Temperature().sensor) for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert created == ["D20"]
+
+
 class TestTemperatureFormatter:
     @pytest.fixture
     def subject(self, temperature_sensor):
@@ -59,6 +132,16 @@ class TestTemperatureSerializer:
             {"magnitude": 21.0, "unit": "degree_Celsius"}
         ) == self.to_degc(21.0)
 
+    def test_deserialize_reuses_parsed_unit(self, deserialize):
+        from apd.sensors.sensors import parse_unit
+
+        deserialize({"magnitude": 21.0, "unit": "degree_Celsius"})
+        hits = parse_unit.cache_info().hits
+        assert deserialize(
+            {"magnitude": 22.0, "unit": "degree_Celsius"}
+        ) == self.to_degc(22.0)
+        assert parse_unit.cache_info().hits == hits + 1
+
 
 class TestHumidityFormatter:
     @pytest.fixture
@@ -67,3 +150,34 @@ class TestHumidityFormatter:
 
     def test_format_percentage(self, subject):
         assert subject(3.5) == "3.5%"
+
+
+class TestBatchFormatters:
+    def test_humidity_matches_format(self, humidity_sensor):
+        values = [3.5, 0, 100, 45.25, 33.333333]
+        expected = [humidity_sensor.format(value) for value in values]
+        assert humidity_sensor.format_many(values) == expected
+
+    def test_temperature_matches_format(self, temperature_sensor):
+        magnitudes = [21.0, -32.0, 0.0, 21.456, 0.001, 100.0, 1234.5, 37.77777]
+        json_values = [
+            {"magnitude": magnitude, "unit": "degree_Celsius"}
+            for magnitude in magnitudes
+        ]
+        values = temperature_sensor.from_json_compatible_many(json_values)
+        expected = [
+            temperature_sensor.format(temperature_sensor.from_json_compatible(value))
+            for value in json_values
+        ]
+        assert temperature_sensor.format_many(values) == expected
+
+    def test_temperature_with_mixed_units(self, temperature_sensor):
+        json_values = [
+            {"magnitude": 21.0, "unit": "degree_Celsius"},
+            {"magnitude": 69.8, "unit": "degree_Fahrenheit"},
+        ]
+        values = temperature_sensor.from_json_compatible_many(json_values)
+        assert temperature_sensor.format_many(values) == [
+            "21.0 °C (69.8 °F)",
+            "69.8 °F (69.8 °F)",
+        ]
@@ -0,0 +1,279 @@
+import asyncio
+import datetime
+import threading
+import time
+import uuid
+from unittest import mock
+
+import flask
+import pytest
+
+from apd.sensors import live
+from apd.sensors.asgi import create_app
+from apd.sensors.base import JSONSensor
+from apd.sensors.wsgi import set_up_config
+from apd.sensors.wsgi import v31
+
+from .test_utils import FailingSensor
+
+
+class SettableSensor(JSONSensor[int]):
+    title = "Sensor with a settable value"
+    name = "SettableSensor"
+
+    def __init__(self, value: int = 0):
+        self.current = value
+
+    def value(self) -> int:
+        return self.current
+
+    @classmethod
+    def format(cls, value: int) -> str:
+        return str(value)
+
+
+@pytest.fixture
+def sensor():
+    return SettableSensor()
+
+
+@pytest.fixture
+def feed(sensor):
+    return live.LiveFeed([sensor], interval=0.01, history=3)
+
+
+def parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = [line for line in block.split("\n") if not line.startswith(":")]
+        fields = dict(line.split(": ", 1) for line in lines)
+        if fields:
+            events.append(fields)
+    return events
+
+
+class TestLiveFeed:
+    def test_first_poll_publishes_every_sensor(self, sensor):
+        feed = live.LiveFeed([sensor, FailingSensor(10)])
+        feed.poll()
+        events = feed.events_after(None)
+        assert [(event.sensor_name, event.kind) for event in events] == [
+            ("SettableSensor", "value"),
+            ("FailingSensor", "error"),
+        ]
+        assert events[0].data["value"] == 0
+        assert events[1].data["error"] == "Failing 9 more times"
+
+    def test_unchanged_values_are_not_published(self, feed, sensor):
+        feed.poll()
+        feed.poll()
+        assert len(feed.events) == 1
+        sensor.current = 5
+        feed.poll()
+        assert [event.data["value"] for event in feed.events] == [0, 5]
+
+    def test_changed_errors_are_published(self):
+        feed = live.LiveFeed([FailingSensor(3)])
+        feed.poll()
+        feed.poll()
+        feed.poll()
+        assert [event.kind for event in feed.events] == ["error", "error", "value"]
+
+    def test_event_ids_follow_collection_time(self, feed, sensor):
+        collected_at = datetime.datetime(2020, 5, 1, 12, 30)
+        first = feed.publish("SettableSensor", "value", {"value": 1}, collected_at)
+        second = feed.publish("SettableSensor", "value", {"value": 2}, collected_at)
+        assert first.id == int(collected_at.timestamp() * 1000000)
+        assert second.id == first.id + 1
+
+    def test_resume_from_last_event(self, feed, sensor):
+        feed.poll()
+        last_id = feed.last_id
+        sensor.current = 1
+        feed.poll()
+        sensor.current = 2
+        feed.poll()
+        resumed = feed.events_after(last_id)
+        assert [event.data["value"] for event in resumed] == [1, 2]
+        assert feed.events_after(feed.last_id) == []
+
+    def test_resume_after_history_is_lost_sends_latest_values(self, feed, sensor):
+        feed.poll()
+        last_id = feed.last_id
+        for i in range(1, 5):
+            sensor.current = i
+            feed.poll()
+        resumed = feed.events_after(last_id)
+        assert [event.data["value"] for event in resumed] == [4]
+
+    def test_wait_is_woken_by_new_events(self, feed, sensor):
+        feed.poll()
+        last_id = feed.last_id
+        sensor.current = 1
+        timer = threading.Timer(0.1, feed.poll)
+        timer.start()
+        started = time.monotonic()
+        events = feed.wait(last_id, timeout=5)
+        assert time.monotonic() - started < 4
+        assert [event.data["value"] for event in events] == [1]
+
+    def test_wait_times_out(self, feed):
+        feed.poll()
+        assert feed.wait(feed.last_id, timeout=0.01) == []
+
+    def test_wait_async_is_woken_by_new_events(self, feed, sensor):
+        feed.poll()
+        last_id = feed.last_id
+        sensor.current = 1
+
+        async def run():
+            poller = threading.Thread(target=feed.poll)
+            asyncio.get_running_loop().call_later(0.1, poller.start)
+            return await feed.wait_async(last_id, timeout=5)
+
+        events = asyncio.run(run())
+        assert [event.data["value"] for event in events] == [1]
+        assert feed.async_waiters == []
+
+    def test_background_polling(self, feed, sensor):
+        feed.start()
+        try:
+            events = feed.wait(None, timeout=5)
+            sensor.current = 1
+            events = feed.wait(events[-1].id, timeout=5)
+            assert events[0].data["value"] == 1
+        finally:
+            feed.stop()
+
+
+class TestStream:
+    def test_events_are_formatted_as_sse(self, feed):
+        feed.poll()
+        chunk = next(live.stream(feed, None))
+        [event] = parse_sse(chunk)
+        assert event["id"] == str(feed.last_id)
+        assert event["event"] == "value"
+        assert '"value": 0' in event["data"]
+
+    def test_keepalive_is_sent_when_idle(self, feed):
+        feed.poll()
+        chunks = live.stream(feed, feed.last_id, keepalive=0.01)
+        assert next(chunks) == ": keep-alive\n\n"
+
+    def test_filter_by_sensor(self, feed):
+        feed.sensors.append(FailingSensor(10))
+        feed.poll()
+        chunks = live.stream(feed, None, sensor_id="FailingSensor", keepalive=0.01)
+        assert parse_sse(next(chunks))[0]["event"] == "error"
+        assert next(chunks) == ": keep-alive\n\n"
+
+
+class TestStreamingEndpoints:
+    @pytest.fixture
+    def api_key(self):
+        return uuid.uuid4().hex
+
+    @pytest.fixture
+    def flask_client(self, api_key):
+        app = flask.Flask("testapp")
+        app.register_blueprint(v31.version)
+        set_up_config(
+            {
+                "APD_SENSORS_API_KEY": api_key,
+                "APD_SENSORS_DEPLOYMENT_ID": "8f1b57faa04b430c81decbbeee9e300c",
+            },
+            to_configure=app,
+        )
+        return app.test_client()
+
+    @pytest.fixture
+    def running_feed(self, feed):
+        with mock.patch("apd.sensors.live.get_feed", return_value=feed):
+            yield feed
+
+    def test_flask_requires_api_key(self, flask_client, running_feed):
+        response = flask_client.get("/stream")
+        assert response.status_code == 403
+
+    def test_flask_stream(self, flask_client, api_key, running_feed, sensor):
+        running_feed.poll()
+        first_id = running_feed.last_id
+        sensor.current = 3
+        running_feed.poll()
+
+        response = flask_client.get(
+            "/stream",
+            headers={"X-API-Key": api_key, "Last-Event-ID": str(first_id)},
+            buffered=False,
+        )
+        assert response.mimetype == "text/event-stream"
+        assert response.headers["Cache-Control"] == "no-cache"
+        chunk = next(response.response)
+        response.close()
+        [event] = parse_sse(chunk.decode("utf-8"))
+        assert event["id"] == str(running_feed.last_id)
+        assert '"value": 3' in event["data"]
+
+    def test_flask_streams_are_limited(
+        self, flask_client, api_key, running_feed, sensor
+    ):
+        flask_client.application.config["APD_SENSORS_MAX_STREAMS"] = "1"
+        # So each stream starts with an event rather than waiting
+        running_feed.poll()
+        headers = {"X-API-Key": api_key}
+        first = flask_client.get("/stream", headers=headers, buffered=False)
+        assert first.status_code == 200
+
+        refused = flask_client.get("/stream", headers=headers, buffered=False)
+        assert refused.status_code == 503
+        assert refused.headers["Retry-After"] == str(live.STREAM_RETRY_AFTER)
+
+        # Disconnecting frees the slot
+        first.close()
+        second = flask_client.get("/stream", headers=headers, buffered=False)
+        assert second.status_code == 200
+        second.close()
+
+    def test_asgi_stream(self, api_key, running_feed, sensor):
+        subject = create_app({"APD_SENSORS_API_KEY": api_key})
+        running_feed.poll()
+
+        async def run():
+            sent = []
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                sent.append(message)
+                if message["type"] == "http.response.body":
+                    disconnect.set()
+                    # Let the disconnection be noticed before the next event
+                    await asyncio.sleep(0.01)
+                    threading.Thread(target=running_feed.poll).start()
+
+            scope = {
+                "type": "http",
+                "method": "GET",
+                "path": "/v/3.1/sensors/SettableSensor/stream",
+                "headers": [(b"x-api-key", api_key.encode("latin-1"))],
+                "query_string": b"",
+            }
+            sensor.current = 1
+            await asyncio.wait_for(subject(scope, receive, send), timeout=5)
+            return sent
+
+        start, body = asyncio.run(run())
+        assert start["status"] == 200
+        assert dict(start["headers"])[b"content-type"].startswith(b"text/event-stream")
+        [event] = parse_sse(body["body"].decode("utf-8"))
+        assert '"value": 0' in event["data"]
+
+    def test_asgi_requires_api_key(self, api_key, running_feed):
+        from .test_asgi import call
+
+        subject = create_app({"APD_SENSORS_API_KEY": api_key})
+        status, headers, data = call(subject, "/v/3.1/stream")
+        assert status == 403
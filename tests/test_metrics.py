@@ -0,0 +1,126 @@
+import datetime
+
+import pytest
+import sqlalchemy
+
+from apd.sensors import metrics
+from apd.sensors.database import create_engine
+from apd.sensors.exceptions import (
+    IntermittentSensorFailureError,
+    PersistentSensorFailureError,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    for metric in metrics.METRICS:
+        metric.clear()
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("latency", "Latency", ("sensor",), (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, "A")
+    assert list(histogram.render()) == [
+        "# HELP latency Latency",
+        "# TYPE latency histogram",
+        'latency_bucket{sensor="A",le="0.1"} 2',
+        'latency_bucket{sensor="A",le="1"} 3',
+        'latency_bucket{sensor="A",le="+Inf"} 4',
+        'latency_sum{sensor="A"} 2.65',
+        'latency_count{sensor="A"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = metrics.Counter("reads", "Reads", ("sensor",))
+    counter.inc('A "quoted"\\name')
+    assert list(counter.render())[-1] == 'reads{sensor="A \\"quoted\\"\\\\name"} 1'
+
+
+@pytest.mark.parametrize(
+    "error,outcome",
+    [
+        (IntermittentSensorFailureError("Try again"), "intermittent"),
+        (PersistentSensorFailureError("No sensor"), "persistent"),
+        (KeyError("Bug"), "unhandled"),
+    ],
+)
+def test_reads_are_counted_by_error_class(error, outcome):
+    with pytest.raises(type(error)):
+        with metrics.timed_read("Sensor"):
+            raise error
+    with metrics.timed_read("Sensor"):
+        pass
+    assert metrics.sensor_reads.values == {
+        ("Sensor", outcome): 1,
+        ("Sensor", "success"): 1,
+    }
+    assert sum(metrics.sensor_read_seconds.counts[("Sensor",)]) == 2
+
+
+def test_unsupported_sensors_are_not_counted():
+    with pytest.raises(NotImplementedError):
+        with metrics.timed_read("Sensor"):
+            raise NotImplementedError
+    assert metrics.sensor_reads.values == {}
+    assert metrics.sensor_read_seconds.counts == {}
+
+
+def test_database_operations_are_timed():
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        connection.execute("CREATE TABLE readings (collected_at TIMESTAMP)")
+        connection.execute(
+            sqlalchemy.text("INSERT INTO readings VALUES (:now)"),
+            now=datetime.datetime.now(),
+        )
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            connection.execute("SELECT * FROM missing")
+    engine.dispose()
+    assert {
+        labels: sum(counts)
+        for labels, counts in metrics.database_seconds.counts.items()
+    } == {("CREATE",): 1, ("INSERT",): 1, ("SELECT",): 1}
+    assert metrics.database_errors.values == {("SELECT", "OperationalError"): 1}
+
+
+def test_render():
+    with metrics.timed_read("Sensor"):
+        pass
+    rendered = metrics.render()
+    assert rendered.endswith("\n")
+    assert 'apd_sensor_reads_total{sensor="Sensor",result="success"} 1\n' in rendered
+    assert "# TYPE apd_database_operation_seconds histogram\n" in rendered
+
+
+def test_connection_errors_are_counted(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'missing' / 'sensor_data.sqlite'}")
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        engine.connect()
+    assert metrics.database_errors.values == {("CONNECT", "OperationalError"): 1}
+
+
+def test_serve_metrics():
+    import http.client
+
+    with metrics.timed_read("Sensor"):
+        pass
+    server = metrics.serve_metrics("127.0.0.1", 0)
+    try:
+        connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        body = response.read().decode("utf-8")
+        assert response.status == 200
+        assert response.getheader("Content-Type") == metrics.CONTENT_TYPE
+        assert 'apd_sensor_reads_total{sensor="Sensor",result="success"} 1' in body
+
+        connection.request("GET", "/")
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 404
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,48 @@
+from unittest import mock
+
+import pytest
+
+from apd.sensors import profiling
+from apd.sensors.exceptions import (
+    IntermittentSensorFailureError,
+    PersistentSensorFailureError,
+)
+from apd.sensors.sensors import PythonVersion
+
+
+def test_percentiles_use_nearest_rank():
+    profile = profiling.SensorProfile([i / 100 for i in range(1, 101)], {}, [], [])
+    assert profile.percentile(50) == 0.5
+    assert profile.percentile(99) == 0.99
+    assert profile.percentile(0) == 0.01
+    assert profiling.SensorProfile([], {}, [], []).percentile(50) == 0.0
+
+
+def test_failures_are_counted_by_result():
+    sensor = PythonVersion()
+    errors = [
+        IntermittentSensorFailureError("Busy"),
+        None,
+        PersistentSensorFailureError("Missing"),
+        IntermittentSensorFailureError("Busy"),
+    ]
+    with mock.patch.object(PythonVersion, "value", side_effect=errors):
+        profile = profiling.profile_sensor(sensor, 4, 0)
+    assert profile.calls == 4
+    assert profile.failures == {"intermittent": 2, "persistent": 1}
+    assert profile.failure_rate == 0.75
+    assert profile.latencies == sorted(profile.latencies)
+
+
+def test_allocations_are_traced_per_call():
+    sensor = PythonVersion()
+    with mock.patch.object(PythonVersion, "value", side_effect=lambda: [0] * 10000):
+        profile = profiling.profile_sensor(sensor, 1, 3)
+    assert len(profile.peak_allocated) == 3
+    assert min(profile.peak_allocated) >= 80000
+
+
+def test_unsupported_sensors_raise():
+    with mock.patch.object(PythonVersion, "value", side_effect=NotImplementedError):
+        with pytest.raises(NotImplementedError):
+            profiling.profile_sensor(PythonVersion(), 1, 0)
@@ -27,6 +27,25 @@ class TestRAMAvailableFormatter:
     def test_format_gibibytes(self, subject):
         assert subject(15000000000) == "14.0 GiB"
 
+    def test_format_zero(self, subject):
+        assert subject(0) == "0.0 B"
+
+
+class TestRAMAvailableBatchFormatter:
+    def test_matches_format(self, sensor):
+        values = [1, 15, 1023, 1024, 15000, 2 ** 20, 15000000, 2 ** 30 - 1, 2 ** 60]
+        assert sensor.format_many(values) == [sensor.format(v) for v in values]
+
+    def test_zero_is_formatted_as_bytes(self, sensor):
+        assert sensor.format_many([0]) == ["0.0 B"] == [sensor.format(0)]
+
+    def test_no_values(self, sensor):
+        assert sensor.format_many([]) == []
+
+    def test_without_numpy(self, sensor):
+        with mock.patch.dict("sys.modules", {"numpy": None}):
+            assert sensor.format_many([15, 15000]) == ["15.0 B", "14.6 KiB"]
+
 
 class TestRAMAvailableValue:
     @pytest.fixture
@@ -0,0 +1,116 @@
+import datetime
+from unittest import mock
+
+import pytest
+
+from apd.sensors import responses
+from apd.sensors.base import JSONSensor
+
+
+class CountingSensor(JSONSensor[int]):
+    title = "Sensor which counts formatting"
+    name = "CountingSensor"
+    formatted = 0
+
+    @classmethod
+    def format(cls, value) -> str:
+        cls.formatted += 1
+        return str(value)
+
+
+@pytest.fixture
+def sensor():
+    CountingSensor.formatted = 0
+    responses.format_cache.clear()
+    yield CountingSensor()
+    responses.format_cache.clear()
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    [
+        (None, "application/json"),
+        ("*/*", "application/json"),
+        ("application/msgpack", "application/msgpack"),
+        ("application/json;q=0.5, application/*", "application/msgpack"),
+        ("application/msgpack;q=0", None),
+        ("text/html", None),
+    ],
+)
+def test_preferred_content_type(header, expected):
+    offered = ["application/json", "application/msgpack"]
+    assert responses.preferred(header, offered) == expected
+
+
+@pytest.mark.parametrize(
+    "header,compressed",
+    [
+        (None, False),
+        ("gzip", True),
+        ("deflate, gzip;q=0.5", True),
+        ("gzip;q=0", False),
+        ("*", True),
+        ("identity", False),
+    ],
+)
+def test_compression(header, compressed):
+    data = {"sensors": [{"value": "x" * responses.MIN_COMPRESS_SIZE}]}
+    body, headers = responses.encode(data, None, header)
+    assert ("Content-Encoding" in headers) == compressed
+
+
+def test_small_responses_are_not_compressed():
+    body, headers = responses.encode({"sensors": []}, None, "gzip")
+    assert "Content-Encoding" not in headers
+    assert body == b'{"sensors":[]}\n'
+
+
+def test_unacceptable_types_get_json():
+    body, headers = responses.encode({"sensors": []}, "text/html", None)
+    assert headers["Content-Type"] == "application/json"
+
+
+class TestHumanReadable:
+    def test_repeated_values_are_formatted_once(self, sensor):
+        assert responses.human_readable(sensor, 3) == "3"
+        assert responses.human_readable(sensor, 3) == "3"
+        assert responses.human_readable(sensor, 4) == "4"
+        assert sensor.formatted == 2
+
+    def test_values_of_different_types_are_distinct(self, sensor):
+        assert responses.human_readable(sensor, 1) == "1"
+        assert responses.human_readable(sensor, 1.0) == "1.0"
+        assert responses.human_readable(sensor, True) == "True"
+
+    def test_unhashable_values(self, sensor):
+        assert responses.human_readable(sensor, [3, 9]) == "[3, 9]"
+        assert responses.human_readable(sensor, [3, 9]) == "[3, 9]"
+        assert responses.human_readable(sensor, {"a": 1}) == "{'a': 1}"
+        assert sensor.formatted == 2
+
+    def test_cache_is_bounded(self, sensor):
+        with mock.patch.object(responses, "FORMAT_CACHE_SIZE", 2):
+            for value in (1, 2, 3, 1):
+                responses.human_readable(sensor, value)
+        assert len(responses.format_cache) == 2
+        assert sensor.formatted == 4
+
+
+class BatchSensor(CountingSensor):
+    @classmethod
+    def format_many(cls, values):
+        return [f"{value}!" for value in values]
+
+
+def test_batch_formatting_is_used_for_historical_data(sensor):
+    known_sensors = {"CountingSensor": BatchSensor(), "Other": CountingSensor()}
+    now = datetime.datetime(2020, 1, 1)
+    stored_values = [
+        ("CountingSensor", now, 1),
+        ("Other", now, 2),
+        ("CountingSensor", now, 3),
+    ]
+    data = responses.historical_data(known_sensors, stored_values, now, now)
+    assert [reading["human_readable"] for reading in data] == ["1!", "2", "3!"]
+    assert BatchSensor.has_batch_formatting()
+    assert not CountingSensor.has_batch_formatting()
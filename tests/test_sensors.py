@@ -1,3 +1,4 @@
+import datetime
 import json
 from unittest import mock
 
@@ -60,6 +61,204 @@ class TestCLI:
         assert ["Sensor which fails", "Failing sensor"] == result.stdout.split("\n")[:2]
         assert "Python Version" in result.stdout
 
+    def test_ndjson_format(self):
+        from .test_utils import FailingSensor
+
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [
+                FailingSensor(10),
+                apd.sensors.sensors.PythonVersion(),
+            ]
+            result = runner.invoke(apd.sensors.cli.show_sensors, ["--format", "ndjson"])
+        assert result.exit_code == 0
+        failing, python_version = [
+            json.loads(line) for line in result.stdout.splitlines()
+        ]
+        assert failing["id"] == "FailingSensor"
+        assert failing["error"] == "Failing 9 more times"
+        assert python_version["id"] == "PythonVersion"
+        assert python_version["value"][0] == 3
+        assert python_version["human_readable"] == str(
+            apd.sensors.sensors.PythonVersion()
+        )
+
+    def test_parallel_reads_every_sensor(self):
+        from apd.sensors.sensors import PythonVersion, RAMAvailable
+
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [PythonVersion(), RAMAvailable()]
+            result = runner.invoke(
+                apd.sensors.cli.show_sensors, ["--parallel", "--format", "ndjson"]
+            )
+        assert result.exit_code == 0
+        ids = [json.loads(line)["id"] for line in result.stdout.splitlines()]
+        assert sorted(ids) == ["PythonVersion", "RAMAvailable"]
+
+    def test_watch_reads_until_interrupted(self, tmp_path):
+        from apd.sensors.timeseries import TimeSeriesStore
+
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors, mock.patch(
+            "time.sleep", side_effect=[None, KeyboardInterrupt]
+        ) as sleep:
+            get_sensors.return_value = [apd.sensors.sensors.RAMAvailable()]
+            result = runner.invoke(
+                apd.sensors.cli.show_sensors,
+                ["--watch", "60", "--save", "--timeseries", str(tmp_path)],
+            )
+        assert result.exit_code == 0
+        assert result.stdout.count("RAM Available") == 2
+        assert 59 < sleep.call_args[0][0] <= 60
+        readings = TimeSeriesStore(tmp_path).read(
+            "RAMAvailable", datetime.datetime(2000, 1, 1), datetime.datetime.now()
+        )
+        assert len(list(readings)) == 2
+
+    @pytest.mark.parametrize("interval", ["0", "-1", "0.5"])
+    def test_watch_interval_must_be_at_least_a_second(self, interval):
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            result = runner.invoke(apd.sensors.cli.show_sensors, ["--watch", interval])
+        assert result.exit_code == 2
+        assert "--watch" in result.output
+        assert get_sensors.call_count == 0
+
+    def test_save_to_timeseries(self, tmp_path):
+        from apd.sensors.sensors import Temperature, ureg
+        from apd.sensors.timeseries import TimeSeriesStore
+
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [
+                apd.sensors.sensors.PythonVersion(),
+                apd.sensors.sensors.RAMAvailable(),
+                Temperature(),
+            ]
+            with mock.patch.object(
+                Temperature, "value", return_value=ureg.Quantity(21.5, ureg.celsius)
+            ):
+                result = runner.invoke(
+                    apd.sensors.cli.show_sensors,
+                    ["--save", "--timeseries", str(tmp_path)],
+                )
+        assert "Not saved, as the value isn't a number" in result.stdout
+        store = TimeSeriesStore(tmp_path)
+        assert store.sensor_names() == ["RAMAvailable", "Temperature"]
+        start, end = datetime.datetime(2000, 1, 1), datetime.datetime.now()
+        [(collected_at, value)] = store.read("RAMAvailable", start, end)
+        assert isinstance(value, int)
+        [(collected_at, value)] = store.read("Temperature", start, end)
+        assert value == {"magnitude": 21.5, "unit": "degree_Celsius"}
+
+    def test_save_to_partitions(self, tmp_path):
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [apd.sensors.sensors.PythonVersion()]
+            result = runner.invoke(
+                apd.sensors.cli.show_sensors,
+                ["--save", "--partitions", str(tmp_path)],
+            )
+        assert result.exit_code == 0
+        [path] = tmp_path.glob("*.sqlite")
+        assert path.name == datetime.datetime.now().strftime("sensor_data-%Y-%m.sqlite")
+
+    def test_values_are_spooled_if_database_is_unavailable(self, tmp_path):
+        from sqlalchemy import create_engine
+        from apd.sensors.database import metadata, sensor_values
+
+        runner = CliRunner()
+        db_uri = f"sqlite:///{tmp_path / 'missing' / 'sensor_data.sqlite'}"
+        spool_path = str(tmp_path / "sensor_data.spool")
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [
+                apd.sensors.sensors.PythonVersion(),
+                apd.sensors.sensors.RAMAvailable(),
+            ]
+            result = runner.invoke(
+                apd.sensors.cli.show_sensors,
+                ["--save", "--db", db_uri, "--spool", spool_path],
+            )
+        assert result.exit_code == 0
+        assert "unable to open database file" in result.stdout
+        assert "2 values" in result.stdout
+
+        (tmp_path / "missing").mkdir()
+        engine = create_engine(db_uri)
+        metadata.create_all(engine)
+        result = runner.invoke(
+            apd.sensors.cli.show_sensors,
+            ["spool", "--drain", "--db", db_uri, "--spool", spool_path],
+        )
+        assert result.exit_code == 0
+        assert "Saved 2 spooled values" in result.stdout
+        assert "The spool is empty" in result.stdout
+        query = sensor_values.select().order_by(sensor_values.c.id)
+        names = [row.sensor_name for row in engine.execute(query)]
+        assert names == ["PythonVersion", "RAMAvailable"]
+        engine.dispose()
+
+    def test_values_are_spooled_if_database_is_locked(self, tmp_path):
+        import sqlite3
+        import time
+        from sqlalchemy import create_engine
+        from apd.sensors.database import metadata, sensor_values
+
+        path = tmp_path / "sensor_data.sqlite"
+        engine = create_engine(f"sqlite:///{path}")
+        metadata.create_all(engine)
+        engine.dispose()
+        locker = sqlite3.connect(str(path), isolation_level=None)
+        locker.execute("BEGIN EXCLUSIVE")
+        runner = CliRunner()
+        try:
+            with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+                get_sensors.return_value = [apd.sensors.sensors.PythonVersion()]
+                started = time.monotonic()
+                result = runner.invoke(
+                    apd.sensors.cli.show_sensors,
+                    [
+                        "--save",
+                        "--db",
+                        f"sqlite:///{path}",
+                        "--spool",
+                        str(tmp_path / "sensor_data.spool"),
+                        "--spool-timeout",
+                        "0.1",
+                    ],
+                )
+                elapsed = time.monotonic() - started
+        finally:
+            locker.execute("ROLLBACK")
+            locker.close()
+        assert result.exit_code == 0
+        assert "database is locked" in result.stdout
+        assert "1 values" in result.stdout
+        assert elapsed < 3
+        engine = create_engine(f"sqlite:///{path}")
+        assert engine.execute(sensor_values.select()).fetchall() == []
+        engine.dispose()
+
+    def test_drop_partitions(self, tmp_path):
+        for name in ("sensor_data-2020-01.sqlite", "sensor_data-2020-02.sqlite"):
+            (tmp_path / name).touch()
+        runner = CliRunner()
+        result = runner.invoke(
+            apd.sensors.cli.show_sensors,
+            [
+                "drop-partitions",
+                "--partitions",
+                str(tmp_path),
+                "--before",
+                "2020-02-01",
+            ],
+        )
+        assert result.exit_code == 0
+        assert [path.name for path in tmp_path.iterdir()] == [
+            "sensor_data-2020-02.sqlite"
+        ]
+
 
 class TestSensorFromPath:
     @pytest.fixture
@@ -99,6 +298,38 @@ def test_develop_option_finds_sensor_by_path():
     assert ["Python Version", python_version, "", ""] == result.stdout.split("\n")
 
 
+def test_profile_reports_latency_and_memory(tmp_path):
+    import pstats
+
+    runner = CliRunner()
+    cprofile_path = tmp_path / "sensor.prof"
+    result = runner.invoke(
+        apd.sensors.cli.show_sensors,
+        [
+            "profile",
+            "apd.sensors.sensors:PythonVersion",
+            "-n",
+            "20",
+            "--cprofile",
+            str(cprofile_path),
+        ],
+    )
+    assert result.exit_code == 0
+    lines = result.stdout.splitlines()
+    assert lines[0] == "Python Version (20 calls)"
+    assert lines[1].startswith("Latency: p50 ")
+    assert lines[2] == "Failures: 0 (0.0%)"
+    assert lines[3].startswith("Memory per call: mean peak ")
+    stats = pstats.Stats(str(cprofile_path))
+    assert any(function == "value" for filename, line, function in stats.stats)
+
+
+def test_profile_requires_sensor_path():
+    runner = CliRunner()
+    result = runner.invoke(apd.sensors.cli.show_sensors, ["profile", "PythonVersion"])
+    assert result.exit_code == apd.sensors.cli.ReturnCodes.BAD_SENSOR_PATH
+
+
 class TestDefaultSerializer:
     @pytest.fixture
     def python_version(self):
@@ -124,3 +355,257 @@ class TestDefaultSerializer:
         )
         deserialized = deserialize(serialized)
         assert deserialized == value
+
+
+class TestExport:
+    @pytest.fixture
+    def db_uri(self, tmp_path):
+        from sqlalchemy import create_engine
+        from apd.sensors.database import metadata, sensor_values
+
+        db_uri = f"sqlite:///{tmp_path / 'sensor_data.sqlite'}"
+        engine = create_engine(db_uri)
+        metadata.create_all(engine)
+        with engine.begin() as connection:
+            for day in (1, 1, 2, 3):
+                connection.execute(
+                    sensor_values.insert().values(
+                        sensor_name="PythonVersion",
+                        collected_at=datetime.datetime(2020, 1, day, 12),
+                        data=[3, day, 0, "final", 0],
+                    )
+                )
+            connection.execute(
+                sensor_values.insert().values(
+                    sensor_name="RAMAvailable",
+                    collected_at=datetime.datetime(2020, 1, 2, 13),
+                    data=2 ** 20,
+                )
+            )
+        engine.dispose()
+        return db_uri
+
+    def export(self, *args):
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [apd.sensors.sensors.PythonVersion()]
+            return runner.invoke(apd.sensors.cli.show_sensors, ["export", *args])
+
+    def test_export_ndjson(self, db_uri):
+        result = self.export(
+            "--db", db_uri, "--format", "ndjson", "--sensor", "PythonVersion"
+        )
+        assert result.exit_code == 0
+        readings = [json.loads(line) for line in result.stdout.splitlines()]
+        assert [reading["collected_at"] for reading in readings] == [
+            "2020-01-01T12:00:00",
+            "2020-01-01T12:00:00",
+            "2020-01-02T12:00:00",
+            "2020-01-03T12:00:00",
+        ]
+        assert readings[0] == {
+            "id": "PythonVersion",
+            "collected_at": "2020-01-01T12:00:00",
+            "value": [3, 1, 0, "final", 0],
+        }
+        assert "Exported 4 values to 1 file(s)" in result.stderr
+        assert "rows/s" in result.stderr
+
+    def test_export_csv_with_time_range(self, db_uri):
+        result = self.export(
+            "--db",
+            db_uri,
+            "--start",
+            "2020-01-02",
+            "--end",
+            "2020-01-02T23:59:59",
+            "--human-readable",
+            "--batch-size",
+            "1",
+        )
+        assert result.exit_code == 0
+        assert result.stdout.splitlines() == [
+            "id,collected_at,value,human_readable",
+            'PythonVersion,2020-01-02T12:00:00,"[3, 2, 0, ""final"", 0]",3.2',
+            "RAMAvailable,2020-01-02T13:00:00,1048576,",
+        ]
+
+    def test_export_partitioned(self, db_uri, tmp_path):
+        output = tmp_path / "export"
+        result = self.export(
+            "--db", db_uri, "--partition", "day", "--output", str(output)
+        )
+        assert result.exit_code == 0
+        assert sorted(path.name for path in output.iterdir()) == [
+            "2020-01-01.csv",
+            "2020-01-02.csv",
+            "2020-01-03.csv",
+        ]
+        lines = (output / "2020-01-02.csv").read_text().splitlines()
+        assert lines[0] == "id,collected_at,value"
+        assert len(lines) == 3
+
+    def test_export_from_partitions(self, tmp_path):
+        from apd.sensors.database import PartitionRouter
+
+        router = PartitionRouter(str(tmp_path))
+        router.store_readings(
+            {
+                "sensor_name": "PythonVersion",
+                "collected_at": datetime.datetime(2020, month, 1),
+                "data": [3, month, 0, "final", 0],
+            }
+            for month in (3, 1, 2)
+        )
+        router.dispose()
+        result = self.export(
+            "--partitions", str(tmp_path), "--format", "ndjson", "--start", "2020-02-01"
+        )
+        assert result.exit_code == 0
+        readings = [json.loads(line) for line in result.stdout.splitlines()]
+        assert [reading["value"][1] for reading in readings] == [2, 3]
+
+    def test_partitioned_export_needs_directory(self, db_uri):
+        result = self.export("--db", db_uri, "--partition", "day")
+        assert result.exit_code == 2
+        assert "--output" in result.stderr
+
+
+class TestImport:
+    @pytest.fixture
+    def db_uri(self, tmp_path):
+        from sqlalchemy import create_engine
+        from apd.sensors.database import metadata
+
+        db_uri = f"sqlite:///{tmp_path / 'sensor_data.sqlite'}"
+        engine = create_engine(db_uri)
+        metadata.create_all(engine)
+        engine.dispose()
+        return db_uri
+
+    def stored_values(self, db_uri):
+        from sqlalchemy import create_engine
+        from apd.sensors.database import sensor_values
+
+        engine = create_engine(db_uri)
+        query = sensor_values.select().order_by(sensor_values.c.id)
+        with engine.connect() as connection:
+            rows = [(row.sensor_name, row.data) for row in connection.execute(query)]
+        engine.dispose()
+        return rows
+
+    def write_readings(self, path, versions):
+        path.write_text(
+            "".join(
+                json.dumps(
+                    {
+                        "id": "PythonVersion",
+                        "collected_at": "2020-01-01T12:00:00",
+                        "value": version,
+                    }
+                )
+                + "\n"
+                for version in versions
+            )
+        )
+
+    def sensors_import(self, *args):
+        runner = CliRunner()
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [apd.sensors.sensors.PythonVersion()]
+            return runner.invoke(apd.sensors.cli.show_sensors, ["import", *args])
+
+    def test_import_into_partitions(self, db_uri, tmp_path):
+        path = tmp_path / "readings.ndjson"
+        self.write_readings(path, [[3, 8, 0, "final", 0]])
+        result = self.sensors_import(
+            str(path), "--db", db_uri, "--partitions", str(tmp_path / "partitions")
+        )
+        assert result.exit_code == 2
+        assert "monthly partitions" in result.stderr
+        assert self.stored_values(db_uri) == []
+
+    def test_import_csv(self, db_uri, tmp_path):
+        path = tmp_path / "readings.csv"
+        path.write_text(
+            "id,collected_at,value,human_readable\n"
+            'PythonVersion,2020-01-01T12:00:00,"[3, 8, 0, ""final"", 0]",3.8\n'
+        )
+        result = self.sensors_import(str(path), "--db", db_uri, "--drop-indexes")
+        assert result.exit_code == 0
+        assert "Imported 1 readings" in result.stdout
+        assert self.stored_values(db_uri) == [("PythonVersion", [3, 8, 0, "final", 0])]
+
+        from sqlalchemy import create_engine, inspect
+
+        engine = create_engine(db_uri)
+        indexes = {
+            index["name"] for index in inspect(engine).get_indexes("recorded_values")
+        }
+        engine.dispose()
+        assert indexes == {
+            "ix_recorded_values_collected_at",
+            "ix_recorded_values_sensor_name",
+        }
+
+    def test_rebuild_latest(self, db_uri, tmp_path):
+        from sqlalchemy import create_engine
+        from apd.sensors.database import latest_stored_values, latest_values
+
+        path = tmp_path / "readings.ndjson"
+        self.write_readings(path, [[3, 7, 0, "final", 0], [3, 8, 0, "final", 0]])
+        assert self.sensors_import(str(path), "--db", db_uri).exit_code == 0
+        engine = create_engine(db_uri)
+        with engine.begin() as connection:
+            [(_, _, imported)] = latest_stored_values(connection)
+            connection.execute(latest_values.delete())
+
+        result = CliRunner().invoke(
+            apd.sensors.cli.show_sensors, ["rebuild-latest", "--db", db_uri]
+        )
+        assert result.exit_code == 0
+        assert "Found the latest values of 1 sensors" in result.stdout
+        with engine.connect() as connection:
+            [(_, _, rebuilt)] = latest_stored_values(connection)
+        engine.dispose()
+        assert imported == rebuilt == [3, 8, 0, "final", 0]
+
+    def test_interrupted_import_is_resumed(self, db_uri, tmp_path):
+        path = tmp_path / "readings.ndjson"
+        versions = [[3, minor, 0, "final", 0] for minor in range(5)]
+        self.write_readings(path, versions[:3] + [[3]] + versions[4:])
+        result = self.sensors_import(str(path), "--db", db_uri, "--batch-size", "2")
+        assert result.exit_code == 18
+        assert "Reading 4: Invalid value for PythonVersion" in result.stdout
+        assert len(self.stored_values(db_uri)) == 2
+
+        self.write_readings(path, versions)
+        result = self.sensors_import(str(path), "--db", db_uri, "--batch-size", "2")
+        assert result.exit_code == 0
+        assert "Skipped 2 readings" in result.stdout
+        assert "Imported 3 readings" in result.stdout
+        assert [data for name, data in self.stored_values(db_uri)] == versions
+
+        # Importing a finished file again does nothing unless restarted
+        result = self.sensors_import(str(path), "--db", db_uri)
+        assert "Imported 0 readings" in result.stdout
+        result = self.sensors_import(str(path), "--db", db_uri, "--restart")
+        assert "Imported 5 readings" in result.stdout
+        assert len(self.stored_values(db_uri)) == 10
+
+    def test_unknown_sensors_need_no_validate(self, db_uri, tmp_path):
+        path = tmp_path / "readings.jsonl"
+        path.write_text('{"id": "Elsewhere", "value": 1}\n')
+        result = self.sensors_import(str(path), "--db", db_uri)
+        assert result.exit_code == 18
+        result = self.sensors_import(str(path), "--db", db_uri, "--no-validate")
+        assert result.exit_code == 0
+        assert self.stored_values(db_uri) == [("Elsewhere", 1)]
+
+    def test_unknown_extension(self, db_uri, tmp_path):
+        path = tmp_path / "readings.txt"
+        path.write_text("")
+        result = self.sensors_import(str(path), "--db", db_uri)
+        assert result.exit_code == 2
+        result = self.sensors_import(str(path), "--db", db_uri, "--format", "csv")
+        assert result.exit_code == 0
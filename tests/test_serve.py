@@ -0,0 +1,181 @@
+import concurrent.futures
+import http.client
+import socket
+import sys
+import threading
+import time
+from unittest import mock
+
+import flask
+import pytest
+
+from apd.sensors.base import JSONSensor
+from apd.sensors.wsgi import serve, set_up_config
+from apd.sensors.wsgi import v31
+
+
+class SlowSensor(JSONSensor[bool]):
+    title = "Sensor which is slow"
+    name = "SlowSensor"
+
+    def value(self) -> bool:
+        time.sleep(1)
+        return True
+
+    @classmethod
+    def format(cls, value: bool) -> str:
+        return "Yes" if value else "No"
+
+
+class TestPoolSizes:
+    def test_live_reads_use_one_threaded_process(self):
+        assert serve.pool_sizes({}) == (1, serve.LIVE_THREADS)
+
+    def test_shared_store_uses_a_process_per_cpu(self):
+        with mock.patch("os.cpu_count", return_value=4):
+            sizes = serve.pool_sizes({"APD_SENSORS_SHARED_STORE": "/dev/shm/apd"})
+        assert sizes == (4, serve.SHARED_STORE_THREADS)
+
+    def test_sizes_can_be_configured(self):
+        config = {"APD_SENSORS_WORKERS": "3", "APD_SENSORS_THREADS": "2"}
+        assert serve.pool_sizes(config) == (3, 2)
+
+    def test_sizes_are_at_least_one(self):
+        config = {"APD_SENSORS_WORKERS": "0", "APD_SENSORS_THREADS": "-1"}
+        assert serve.pool_sizes(config) == (1, 1)
+
+
+class TestServer:
+    @pytest.fixture
+    def subject(self, api_key):
+        app = flask.Flask("testapp")
+        app.register_blueprint(v31.version)
+        set_up_config(
+            {
+                "APD_SENSORS_API_KEY": api_key,
+                "APD_SENSORS_DEPLOYMENT_ID": "8f1b57faa04b430c81decbbeee9e300c",
+            },
+            to_configure=app,
+        )
+        return app
+
+    @pytest.fixture
+    def api_key(self):
+        return "a9bd0b8c2d7b4d44a4e7a5f1f5f0e3f2"
+
+    @pytest.fixture(params=["waitress", "wsgiref"])
+    def server_address(self, request, subject):
+        sock = serve.bind({"APD_SENSORS_HOST": "127.0.0.1", "APD_SENSORS_PORT": 0})
+        if request.param == "wsgiref":
+            with mock.patch.dict(sys.modules, {"waitress": None}):
+                server = serve.create_server(subject, sock, threads=4)
+        else:
+            server = serve.create_server(subject, sock, threads=4)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        yield sock.getsockname()
+        if request.param == "wsgiref":
+            # waitress can only be closed from the thread that runs it, so
+            # it is left to stop with the test process
+            server.close()
+
+    def get(self, address, path, api_key):
+        connection = http.client.HTTPConnection(*address, timeout=10)
+        connection.request("GET", path, headers={"X-API-Key": api_key})
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response.status
+
+    @pytest.mark.functional
+    def test_slow_requests_are_served_concurrently(self, server_address, api_key):
+        with mock.patch("apd.sensors.cli.get_sensors") as get_sensors:
+            get_sensors.return_value = [SlowSensor()]
+            started = time.monotonic()
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                statuses = list(
+                    pool.map(
+                        lambda i: self.get(server_address, "/sensors/", api_key),
+                        range(4),
+                    )
+                )
+            elapsed = time.monotonic() - started
+        assert statuses == [200] * 4
+        assert elapsed < 3
+
+    @pytest.mark.functional
+    def test_connections_are_kept_alive(self, subject, api_key):
+        sock = serve.bind({"APD_SENSORS_HOST": "127.0.0.1", "APD_SENSORS_PORT": 0})
+        server = serve.create_server(subject, sock, threads=2)
+        threading.Thread(target=server.run, daemon=True).start()
+
+        connection = http.client.HTTPConnection(*sock.getsockname(), timeout=10)
+        connection.request("GET", "/deployment_id")
+        connection.getresponse().read()
+        first_socket = connection.sock
+        connection.request("GET", "/deployment_id")
+        response = connection.getresponse()
+        assert response.status == 200
+        assert connection.sock is first_socket
+        connection.close()
+
+
+def test_bind_uses_configured_address():
+    sock = serve.bind({"APD_SENSORS_HOST": "127.0.0.1", "APD_SENSORS_PORT": "0"})
+    try:
+        host, port = sock.getsockname()
+        assert host == "127.0.0.1"
+        assert port != 0
+        assert sock.type == socket.SOCK_STREAM
+    finally:
+        sock.close()
+
+
+@pytest.mark.functional
+def test_stopped_worker_stores_queued_readings(tmp_path):
+    import datetime
+    import multiprocessing
+
+    from apd.sensors import writebehind
+    from apd.sensors.sensors import CPULoad
+    from apd.sensors.timeseries import TimeSeriesStore
+
+    api_key = "a9bd0b8c2d7b4d44a4e7a5f1f5f0e3f2"
+    app = flask.Flask("testapp")
+    app.register_blueprint(v31.version)
+    set_up_config(
+        {
+            "APD_SENSORS_API_KEY": api_key,
+            "APD_SENSORS_DEPLOYMENT_ID": "8f1b57faa04b430c81decbbeee9e300c",
+            "APD_SENSORS_WRITE_BEHIND": "on",
+            "APD_SENSORS_TIMESERIES_PATH": str(tmp_path / "timeseries"),
+        },
+        to_configure=app,
+    )
+    sock = serve.bind({"APD_SENSORS_HOST": "127.0.0.1", "APD_SENSORS_PORT": 0})
+    context = multiprocessing.get_context("fork")
+    # The test app has no database engine to dispose of
+    with mock.patch("apd.sensors.wsgi.db", None), mock.patch(
+        "apd.sensors.cli.get_sensors"
+    ) as get_sensors, mock.patch.object(CPULoad, "value", return_value=0.25):
+        get_sensors.return_value = [CPULoad()]
+        worker = context.Process(target=serve.run_worker, args=(app, sock, 2))
+        worker.start()
+    try:
+        connection = http.client.HTTPConnection(*sock.getsockname(), timeout=10)
+        connection.request("GET", "/sensors/", headers={"X-API-Key": api_key})
+        assert connection.getresponse().status == 200
+        connection.close()
+    finally:
+        # The reading is still queued, as it is less than a batch and the
+        # queue is flushed every few seconds
+        worker.terminate()
+        worker.join(serve.SHUTDOWN_TIMEOUT)
+        sock.close()
+    assert worker.exitcode == 0
+    assert writebehind.queues == {}
+    store = TimeSeriesStore(tmp_path / "timeseries")
+    readings = store.read(
+        "CPULoad", datetime.datetime(2000, 1, 1), datetime.datetime.now()
+    )
+    assert [value for collected_at, value in readings] == [0.25]
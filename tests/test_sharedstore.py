@@ -0,0 +1,170 @@
+import datetime
+import multiprocessing
+
+import pytest
+
+from apd.sensors.exceptions import (
+    IntermittentSensorFailureError,
+    PersistentSensorFailureError,
+)
+from apd.sensors.sensors import PythonVersion, Temperature, ureg
+from apd.sensors.sharedstore import SharedValueStore, collect, read_value, readers
+
+from .test_utils import FailingSensor
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    path = str(tmp_path / "store")
+    yield path
+    reader = readers.pop(path, None)
+    if reader is not None:
+        reader.close()
+
+
+@pytest.fixture
+def writer(store_path):
+    store = SharedValueStore(store_path, writable=True, slot_count=4)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def reader(store_path, writer):
+    store = SharedValueStore(store_path)
+    yield store
+    store.close()
+
+
+def write_then_read_forever(path, stop):
+    store = SharedValueStore(path, writable=True)
+    sensor = Temperature()
+    i = 0
+    while not stop.is_set():
+        i += 1
+        # Alternate between short and long payloads, so torn reads would be visible
+        store.write_value(sensor, ureg.Quantity(i * (10 ** (i % 12)), ureg.celsius))
+    store.close()
+
+
+class TestSharedValueStore:
+    def test_value_roundtrip(self, writer, reader):
+        collected_at = datetime.datetime(2020, 5, 1, 12, 30)
+        writer.write_value(PythonVersion(), PythonVersion().value(), collected_at)
+
+        reading = reader.read("PythonVersion")
+        assert reading.collected_at == collected_at
+        assert reading.value == list(PythonVersion().value())
+        assert reading.error is None
+
+    def test_error_roundtrip(self, writer, reader):
+        writer.write_error(FailingSensor(), "Failing 2 more times")
+
+        reading = reader.read("FailingSensor")
+        assert reading.value is None
+        assert reading.error == "Failing 2 more times"
+
+    def test_unknown_sensor(self, reader):
+        assert reader.read("PythonVersion") is None
+
+    def test_values_are_updated_in_place(self, writer, reader):
+        sensor = Temperature()
+        writer.write_value(sensor, ureg.Quantity(21.0, ureg.celsius))
+        writer.write_value(sensor, ureg.Quantity(22.5, ureg.celsius))
+        assert reader.read_all().keys() == {"Temperature"}
+        assert reader.read("Temperature").value["magnitude"] == 22.5
+
+    def test_slots_survive_collector_restart(self, store_path, writer):
+        writer.write_value(PythonVersion(), PythonVersion().value())
+        writer.close()
+
+        restarted = SharedValueStore(store_path, writable=True, slot_count=4)
+        restarted.write_error(FailingSensor(), "Failed")
+        assert restarted.read_all().keys() == {"PythonVersion", "FailingSensor"}
+        restarted.close()
+
+    def test_too_many_sensors(self, writer):
+        for i in range(4):
+            sensor = FailingSensor()
+            sensor.name = f"Sensor{i}"
+            writer.write_error(sensor, "Failed")
+        with pytest.raises(ValueError, match="No free slots"):
+            writer.write_error(FailingSensor(), "Failed")
+
+    def test_oversized_values_are_stored_as_errors(self, store_path):
+        store = SharedValueStore(store_path, writable=True, slot_size=128)
+        store.write_value(FailingSensor(), "x" * 100)
+        assert store.read("FailingSensor").error == "Value too large for shared store"
+        store.close()
+
+    def test_reader_requires_store(self, store_path):
+        with pytest.raises(PersistentSensorFailureError, match="is not available"):
+            SharedValueStore(store_path)
+
+    @pytest.mark.functional
+    def test_concurrent_reads_are_consistent(self, store_path):
+        context = multiprocessing.get_context("fork")
+        SharedValueStore(store_path, writable=True).close()
+        stop = context.Event()
+        process = context.Process(
+            target=write_then_read_forever, args=(store_path, stop)
+        )
+        process.start()
+        try:
+            reader = SharedValueStore(store_path)
+            seen = set()
+            while len(seen) < 1000:
+                try:
+                    reading = reader.read("Temperature")
+                except IntermittentSensorFailureError:
+                    continue
+                if reading is None:
+                    continue
+                # Any torn read would fail to decode or have the wrong shape
+                assert reading.value["unit"] == "degree_Celsius"
+                seen.add(reading.value["magnitude"])
+            reader.close()
+        finally:
+            stop.set()
+            process.join()
+
+
+class TestCollectAndRead:
+    def test_collect_stores_values_and_errors(self, store_path, writer):
+        collect(writer, [FailingSensor(2), PythonVersion()])
+
+        collected_at, value = read_value(store_path, PythonVersion())
+        assert value == PythonVersion().value()
+        with pytest.raises(IntermittentSensorFailureError, match="Failing 1 more"):
+            read_value(store_path, FailingSensor())
+
+    def test_unhandled_errors_are_not_published(self, store_path, writer):
+        collect(writer, [FailingSensor(2, exception_type=ValueError)])
+
+        with pytest.raises(IntermittentSensorFailureError, match="^Unhandled error$"):
+            read_value(store_path, FailingSensor())
+
+    def test_missing_value(self, store_path, writer):
+        with pytest.raises(PersistentSensorFailureError, match="No value available"):
+            read_value(store_path, PythonVersion())
+
+    def test_old_values_are_missing(self, store_path, writer):
+        collected_at = datetime.datetime.now() - datetime.timedelta(minutes=2)
+        writer.write_value(PythonVersion(), PythonVersion().value(), collected_at)
+
+        assert read_value(store_path, PythonVersion())[0] == collected_at
+        with pytest.raises(PersistentSensorFailureError, match="No value available"):
+            read_value(store_path, PythonVersion(), max_age=60)
+
+    def test_replaced_store_is_remapped(self, store_path, writer):
+        writer.write_value(PythonVersion(), PythonVersion().value())
+        read_value(store_path, PythonVersion())
+        writer.close()
+
+        # A different layout replaces the file the reader has mapped
+        restarted = SharedValueStore(store_path, writable=True, slot_count=8)
+        restarted.write_error(PythonVersion(), "Restarted")
+        with pytest.raises(IntermittentSensorFailureError, match="Restarted"):
+            read_value(store_path, PythonVersion())
+        assert readers[store_path].slot_count == 8
+        restarted.close()
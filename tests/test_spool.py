@@ -0,0 +1,129 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from apd.sensors.spool import Spool, SpoolFullError
+
+
+def rows(*values):
+    return [
+        {
+            "sensor_name": "Sensor",
+            "collected_at": datetime.datetime(2020, 1, 1, 12, value),
+            "data": value,
+        }
+        for value in values
+    ]
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = Spool(tmp_path / "readings.spool", sync_every=2)
+    yield spool
+    spool.close()
+
+
+def test_empty_spool_has_no_backlog(spool):
+    assert spool.backlog() == (0, 0)
+    assert spool.oldest() is None
+    assert spool.drain(pytest.fail) == 0
+
+
+def test_drain_stores_readings_in_batches(spool):
+    spool.append(rows(1, 2, 3))
+    assert spool.backlog().readings == 3
+    assert spool.oldest() == datetime.datetime(2020, 1, 1, 12, 1)
+    batches = []
+    assert spool.drain(batches.append, batch_size=2) == 3
+    assert batches == [rows(1, 2), rows(3)]
+    assert spool.backlog() == (0, 0)
+    assert spool.path.stat().st_size == 0
+
+
+def test_failed_drain_continues_from_last_stored_batch(spool):
+    spool.append(rows(1, 2, 3))
+    batches = []
+
+    def fail_second_batch(batch):
+        if batches:
+            raise RuntimeError("Database is locked")
+        batches.append(batch)
+
+    with pytest.raises(RuntimeError):
+        spool.drain(fail_second_batch, batch_size=2)
+    assert spool.backlog().readings == 1
+    remaining = []
+    assert spool.drain(remaining.append) == 1
+    assert remaining == [rows(3)]
+
+
+def test_offset_is_written_beside_the_spool(spool):
+    unrelated = spool.path.with_name(spool.path.name + ".tmp")
+    unrelated.write_text("Unrelated")
+    spool.write_offset(10)
+    assert spool.read_offset() == 10
+    assert unrelated.read_text() == "Unrelated"
+    assert sorted(path.name for path in spool.path.parent.iterdir()) == [
+        "readings.spool.offset",
+        "readings.spool.tmp",
+    ]
+
+
+def test_readings_are_synced_in_batches(spool, monkeypatch):
+    synced = []
+    monkeypatch.setattr("os.fsync", synced.append)
+    spool.append(rows(1))
+    assert not synced
+    spool.append(rows(2))
+    assert len(synced) == 1
+    spool.append(rows(3))
+    spool.close()
+    assert len(synced) == 2
+
+
+def test_full_spool_rejects_readings(tmp_path):
+    spool = Spool(tmp_path / "readings.spool", max_size=100)
+    spool.append(rows(1))
+    with pytest.raises(SpoolFullError):
+        spool.append(rows(2, 3))
+    spool.close()
+    assert spool.backlog().readings == 1
+
+
+def test_partial_line_is_discarded(spool):
+    spool.append(rows(1))
+    spool.close()
+    with open(spool.path, "ab") as spool_file:
+        spool_file.write(b'{"id":"Sens')
+    assert spool.backlog().readings == 1
+    spool.append(rows(2))
+    batches = []
+    spool.drain(batches.append)
+    assert batches == [rows(1, 2)]
+
+
+def test_spools_can_be_shared(spool):
+    other = Spool(spool.path)
+    spool.append(rows(1))
+    other.append(rows(2))
+    appended = threading.Event()
+    batches = []
+
+    def append_during_drain(batch):
+        batches.append(batch)
+        thread = threading.Thread(
+            target=lambda: (other.append(rows(3)), appended.set())
+        )
+        thread.start()
+        # The append waits until the drain has emptied the spool
+        time.sleep(0.2)
+        assert not appended.is_set()
+
+    assert spool.drain(append_during_drain) == 2
+    assert batches == [rows(1, 2)]
+    assert appended.wait(5)
+    assert other.drain(batches.append) == 1
+    assert batches[-1] == rows(3)
+    other.close()
@@ -0,0 +1,191 @@
+import datetime
+import threading
+
+import pytest
+
+from apd.sensors import timeseries
+
+
+BASE = datetime.datetime(2020, 1, 1)
+
+
+def minutes(count):
+    return BASE + datetime.timedelta(minutes=count)
+
+
+@pytest.fixture
+def subject(tmp_path):
+    store = timeseries.TimeSeriesStore(tmp_path / "timeseries", segment_records=4)
+    yield store
+    store.close()
+
+
+def test_read_range(subject):
+    subject.append_many("CPULoad", [(minutes(i), i / 10) for i in range(10)])
+    assert list(subject.read("CPULoad", minutes(3), minutes(5))) == [
+        (minutes(3), 0.3),
+        (minutes(4), 0.4),
+        (minutes(5), 0.5),
+    ]
+    assert list(subject.read("CPULoad", minutes(20), minutes(30))) == []
+    assert list(subject.read("Unknown", minutes(0), minutes(30))) == []
+
+
+def test_segments_are_limited_in_size(subject):
+    subject.append_many("CPULoad", [(minutes(i), 0.5) for i in range(10)])
+    assert len(subject.segment_paths("CPULoad")) == 3
+    assert len(list(subject.read("CPULoad", minutes(0), minutes(9)))) == 10
+
+
+def test_value_types_are_preserved(subject):
+    subject.append("ACStatus", minutes(0), True)
+    subject.append("RAMAvailable", minutes(0), 2 ** 40 + 1)
+    subject.append("RAMAvailable", minutes(1), 0.5)
+    [(collected_at, status)] = subject.read("ACStatus", minutes(0), minutes(1))
+    assert status is True
+    values = [
+        value for _, value in subject.read("RAMAvailable", minutes(0), minutes(1))
+    ]
+    assert values == [2 ** 40 + 1, 0.5]
+    assert isinstance(values[0], int)
+
+
+def test_non_numeric_values_are_rejected(subject):
+    with pytest.raises(timeseries.UnsupportedValueError):
+        subject.append("PythonVersion", minutes(0), [3, 8, 0, "final", 0])
+
+
+def test_quantities_are_stored_with_their_unit(subject):
+    celsius = {"magnitude": 21.5, "unit": "degree_Celsius"}
+    fahrenheit = {"magnitude": 70.7, "unit": "degree_Fahrenheit"}
+    subject.append_many("Temperature", [(minutes(0), celsius), (minutes(1), celsius)])
+    subject.append("Temperature", minutes(2), fahrenheit)
+    assert list(subject.read("Temperature", minutes(0), minutes(2))) == [
+        (minutes(0), celsius),
+        (minutes(1), celsius),
+        (minutes(2), fahrenheit),
+    ]
+    # A change of unit starts a new segment
+    assert len(subject.segment_paths("Temperature")) == 2
+    assert subject.latest("Temperature") == (minutes(2), fahrenheit)
+
+
+def test_integers_must_fit_in_64_bits(subject):
+    subject.append("RAMAvailable", minutes(0), 2 ** 63 - 1)
+    with pytest.raises(timeseries.UnsupportedValueError):
+        subject.append("RAMAvailable", minutes(1), 2 ** 63)
+
+
+def test_segments_outside_the_range_are_skipped(subject, monkeypatch):
+    subject.append_many("CPULoad", [(minutes(i), i / 10) for i in range(10)])
+    list(subject.read("CPULoad", minutes(0), minutes(9)))
+    read = []
+    original_read = timeseries.Segment.read
+
+    def record_reads(segment, start, end):
+        read.append(segment.path.name)
+        return original_read(segment, start, end)
+
+    monkeypatch.setattr(timeseries.Segment, "read", record_reads)
+    values = [value for _, value in subject.read("CPULoad", minutes(5), minutes(6))]
+    assert values == [0.5, 0.6]
+    # The second segment, and the last one, which may still be growing
+    assert read == ["00000002.seg", "00000003.seg"]
+
+
+def test_readings_out_of_order_are_merged(subject):
+    subject.append_many("CPULoad", [(minutes(0), 0.0), (minutes(2), 0.2)])
+    # For example, when the clocks go back
+    subject.append("CPULoad", minutes(1), 0.1)
+    assert [value for _, value in subject.read("CPULoad", minutes(0), minutes(2))] == [
+        0.0,
+        0.1,
+        0.2,
+    ]
+
+
+def test_appends_continue_existing_segments(subject, tmp_path):
+    subject.append("CPULoad", minutes(0), 0.0)
+    reopened = timeseries.TimeSeriesStore(tmp_path / "timeseries", segment_records=4)
+    reopened.append("CPULoad", minutes(1), 0.1)
+    assert len(reopened.segment_paths("CPULoad")) == 1
+    # Readers see values appended by other writers
+    assert len(list(subject.read("CPULoad", minutes(0), minutes(1)))) == 2
+
+
+def test_writers_share_a_store(subject, tmp_path):
+    other = timeseries.TimeSeriesStore(tmp_path / "timeseries", segment_records=4)
+    subject.append("CPULoad", minutes(0), 0.0)
+    other.append_many("CPULoad", [(minutes(i), i / 10) for i in (2, 3, 4, 5)])
+    # Appending after the other writer's readings, which fill the segment,
+    # and before them in time
+    subject.append("CPULoad", minutes(1), 0.1)
+    subject.append("CPULoad", minutes(6), 0.6)
+    assert [value for _, value in subject.read("CPULoad", minutes(0), minutes(6))] == [
+        i / 10 for i in range(7)
+    ]
+    for path in subject.segment_paths("CPULoad"):
+        segment = timeseries.Segment(path)
+        timestamps = segment.timestamps()
+        timestamps = [timestamps[i] for i in range(len(timestamps))]
+        assert timestamps == sorted(timestamps)
+        segment.close()
+    other.close()
+
+
+def test_partial_records_are_ignored(subject):
+    subject.append("CPULoad", minutes(0), 0.0)
+    [path] = subject.segment_paths("CPULoad")
+    with open(path, "ab") as segment_file:
+        segment_file.write(b"\0\0\0")
+    assert list(subject.read("CPULoad", minutes(0), minutes(1))) == [(minutes(0), 0.0)]
+
+
+def test_values_of_many_sensors_are_in_time_order(subject):
+    subject.append_many("CPULoad", [(minutes(0), 0.0), (minutes(2), 0.2)])
+    subject.append_many("ACStatus", [(minutes(1), True)])
+    assert list(subject.values(minutes(0), minutes(2))) == [
+        ("CPULoad", minutes(0), 0.0),
+        ("ACStatus", minutes(1), True),
+        ("CPULoad", minutes(2), 0.2),
+    ]
+    assert list(subject.values(minutes(0), minutes(2), ["ACStatus"])) == [
+        ("ACStatus", minutes(1), True)
+    ]
+
+
+def test_reads_during_appends(subject):
+    subject.append("CPULoad", minutes(0), 0.0)
+    errors = []
+
+    def read():
+        try:
+            for _ in range(50):
+                list(subject.read("CPULoad", minutes(0), minutes(1000)))
+        except Exception as err:
+            errors.append(err)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(1, 200):
+        subject.append("CPULoad", minutes(i), 0.5)
+    reader.join()
+    assert errors == []
+
+
+def test_latest_values(subject):
+    assert subject.latest_values() == []
+    subject.append_many("CPULoad", [(minutes(i), i / 10) for i in range(5)])
+    subject.append("RAMAvailable", minutes(2), 1024)
+    assert subject.latest_values() == [
+        ("CPULoad", minutes(4), 0.4),
+        ("RAMAvailable", minutes(2), 1024),
+    ]
+    assert subject.latest_values(["RAMAvailable", "Unknown"]) == [
+        ("RAMAvailable", minutes(2), 1024)
+    ]
+
+
+def test_invalid_sensor_name(subject):
+    with pytest.raises(ValueError):
+        subject.append("../CPULoad", minutes(0), 0.0)
@@ -0,0 +1,30 @@
+from unittest import mock
+
+from apd.sensors import timing
+
+
+def test_phases_do_nothing_without_timings():
+    with timing.phase("rows"):
+        timing.record("db", 1.0)
+    assert timing.current.get() is None
+
+
+def test_nested_phases_are_excluded():
+    timings = timing.Timings()
+    token = timing.current.set(timings)
+    try:
+        with mock.patch("time.perf_counter", side_effect=[0.0, 1.0, 2.0, 5.0]):
+            with timing.phase("rows"):
+                with timing.phase("format"):
+                    pass
+                timing.record("db", 0.5)
+    finally:
+        timing.current.reset(token)
+    assert timings.durations == {"format": 1.0, "db": 0.5, "rows": 3.5}
+
+
+def test_header():
+    timings = timing.Timings()
+    timings.add("db", 0.0125)
+    with mock.patch("time.perf_counter", return_value=timings.started + 0.05):
+        assert timings.header() == "db;dur=12.50, total;dur=50.00"
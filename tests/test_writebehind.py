@@ -0,0 +1,138 @@
+import datetime
+import threading
+
+import pytest
+
+from apd.sensors.writebehind import WriteBehindQueue, get_queue, queues
+
+
+START = datetime.datetime(2020, 1, 1, 12)
+
+
+def at(seconds):
+    return START + datetime.timedelta(seconds=seconds)
+
+
+class Recorder:
+    def __init__(self):
+        self.batches = []
+        self.stored = threading.Event()
+
+    def __call__(self, rows):
+        self.batches.append([(row["sensor_name"], row["data"]) for row in rows])
+        self.stored.set()
+
+
+@pytest.fixture
+def storage():
+    return Recorder()
+
+
+def test_readings_are_stored_in_batches(storage):
+    queue = WriteBehindQueue(storage, batch_size=2, min_interval=0)
+    queue.start()
+    for i in range(5):
+        assert queue.put("Sensor", at(i), i)
+    queue.close()
+    assert storage.batches == [
+        [("Sensor", 0), ("Sensor", 1)],
+        [("Sensor", 2), ("Sensor", 3)],
+        [("Sensor", 4)],
+    ]
+    assert queue.stored == 5
+
+
+def test_full_batch_is_written_without_waiting(storage):
+    queue = WriteBehindQueue(storage, batch_size=2, min_interval=0, flush_interval=60)
+    queue.start()
+    queue.put("Sensor", at(0), 0)
+    queue.put("Sensor", at(1), 1)
+    assert storage.stored.wait(5)
+    queue.close()
+
+
+def test_readings_within_min_interval_are_skipped(storage):
+    queue = WriteBehindQueue(storage, min_interval=60)
+    assert queue.put("Sensor", at(0), 0)
+    assert not queue.put("Sensor", at(30), 1)
+    assert queue.put("Other", at(30), 2)
+    assert queue.put("Sensor", at(60), 3)
+    queue.close()
+    assert storage.batches == [[("Sensor", 0), ("Other", 2), ("Sensor", 3)]]
+
+
+def test_coalesce_replaces_queued_reading_when_full(storage):
+    queue = WriteBehindQueue(storage, max_size=2, min_interval=0)
+    queue.put("Sensor", at(0), 0)
+    queue.put("Other", at(0), 1)
+    assert queue.put("Sensor", at(1), 2)
+    # There's no queued reading of this sensor to replace
+    assert not queue.put("Third", at(1), 3)
+    queue.close()
+    assert storage.batches == [[("Sensor", 2), ("Other", 1)]]
+    assert (queue.coalesced, queue.dropped) == (1, 1)
+
+
+def test_drop_policy_drops_new_readings_when_full(storage):
+    queue = WriteBehindQueue(storage, max_size=2, policy="drop", min_interval=0)
+    queue.put("Sensor", at(0), 0)
+    queue.put("Other", at(0), 1)
+    assert not queue.put("Sensor", at(1), 2)
+    queue.close()
+    assert storage.batches == [[("Sensor", 0), ("Other", 1)]]
+    assert queue.dropped == 1
+
+
+def test_unknown_policy_is_rejected(storage):
+    with pytest.raises(ValueError):
+        WriteBehindQueue(storage, policy="block")
+
+
+def test_storage_failures_are_counted(storage):
+    def failing(rows):
+        raise RuntimeError("Database unavailable")
+
+    queue = WriteBehindQueue(failing, min_interval=0)
+    queue.start()
+    queue.put("Sensor", at(0), 0)
+    queue.close()
+    assert (queue.stored, queue.failed) == (0, 1)
+
+
+def test_failed_readings_are_spooled_and_stored_later(storage, tmp_path):
+    from apd.sensors.spool import Spool
+
+    def failing(rows):
+        raise RuntimeError("Database is locked")
+
+    spool = Spool(tmp_path / "readings.spool")
+    queue = WriteBehindQueue(failing, min_interval=0, spool=spool)
+    queue.put("Sensor", at(0), 0)
+    queue.close()
+    assert spool.backlog().readings == 1
+
+    queue = WriteBehindQueue(storage, min_interval=0, spool=spool)
+    queue.put("Sensor", at(1), 1)
+    queue.close()
+    assert storage.batches == [[("Sensor", 1)], [("Sensor", 0)]]
+    assert queue.stored == 2
+    assert spool.backlog().readings == 0
+
+
+def test_closed_queue_rejects_readings(storage):
+    queue = WriteBehindQueue(storage)
+    queue.close()
+    assert not queue.put("Sensor", at(0), 0)
+
+
+def test_get_queue_is_opt_in(tmp_path):
+    config = {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'db.sqlite'}"}
+    assert get_queue(config) is None
+    config["APD_SENSORS_WRITE_BEHIND"] = "1"
+    queue = get_queue(config)
+    try:
+        assert queue is get_queue(config)
+        assert queue.thread.is_alive()
+    finally:
+        queue.close()
+        queues.clear()